@@ -24,11 +24,14 @@ function start() {
     started = true;
     startButton.disabled = true;
     var protocol = location.protocol == "http:" ? "ws://" : "wss://";
+    // Every browser registers with its own peer id, the server starts a
+    // separate session for each of them.
+    var peer_id = 1 + Math.floor(Math.random() * 1000000000);
     signalling = new WebRTCDemoSignalling(
         new URL(
             protocol + "localhost:100" + "/signalling/"
         ),
-        1
+        peer_id
     );
 
     webrtc = new WebRTCDemo(signalling, localVideoElement);
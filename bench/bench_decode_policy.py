@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmark of the CPU cost of the FrameTap decode policies
+
+A test stream is encoded once to an H264 file, then for each policy the file
+is parsed, payloaded as RTP and fed to a FrameTap branch as fast as it
+decodes, the way the webrtcbin src pad would. The process CPU time of each
+run is compared with the "all" policy. The stream has a keyframe every
+--gop frames, as a browser would send without PLIs.
+
+    python3 bench/bench_decode_policy.py --frames 900 --width 1280 --height 720 --gop 60
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from decode_policy import DecodePolicy, POLICY_ALL, POLICY_KEYFRAMES, POLICY_EVERY_NTH
+from frame_tap import FrameTap
+
+
+def run_pipeline(pipeline):
+    pipeline.set_state(Gst.State.PLAYING)
+    bus = pipeline.get_bus()
+    message = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise RuntimeError("%s: %s" % (err, debug))
+
+
+def encode(path, num_frames, width, height, gop):
+    pipeline = Gst.parse_launch(
+        "videotestsrc num-buffers=%d pattern=ball ! video/x-raw,width=%d,height=%d,framerate=30/1 "
+        "! x264enc tune=zerolatency speed-preset=veryfast key-int-max=%d "
+        "! video/x-h264,profile=constrained-baseline,stream-format=byte-stream ! filesink location=%s" % (
+            num_frames, width, height, gop, path))
+    run_pipeline(pipeline)
+
+
+def bench_policy(path, policy):
+    pipeline = Gst.parse_launch(
+        "filesrc location=%s ! h264parse ! rtph264pay config-interval=-1 name=pay" % path)
+    tap = FrameTap("bench", video_format="RGB", decode_policy=policy)
+    tap.on_frames = lambda frames: None
+    names = iter(range(1000))
+    tap.link(pipeline, pipeline.get_by_name("pay").get_static_pad("src"),
+             lambda name: "%s_%d" % (name, next(names)))
+
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    run_pipeline(pipeline)
+    stats = policy.stats()
+    tap.release()
+    return time.process_time() - start_cpu, time.perf_counter() - start, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=900)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--gop', type=int, default=60)
+    parser.add_argument('--every_nth', type=int, default=30)
+    args = parser.parse_args()
+
+    Gst.init(None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stream.h264")
+        encode(path, args.frames, args.width, args.height, args.gop)
+
+        # The fps policy paces keyframes by wall clock and PLIs, a file has
+        # no sender to ask, so it runs like keyframes here.
+        policies = [
+            DecodePolicy(POLICY_ALL),
+            DecodePolicy(POLICY_EVERY_NTH, every_nth=args.every_nth),
+            DecodePolicy(POLICY_KEYFRAMES),
+        ]
+        baseline = None
+        print("%d frames %dx%d, keyframe every %d" % (args.frames, args.width, args.height, args.gop))
+        for policy in policies:
+            cpu, elapsed, stats = bench_policy(path, policy)
+            if baseline is None:
+                baseline = cpu
+            print("%-16s cpu %.2fs (%3.0f%%)  wall %.2fs  decoded %4d  delivered %4d  branch cpu %.2fs  saved ~%.2fs" % (
+                policy.describe(), cpu, 100.0 * cpu / baseline, elapsed, stats["frames_decoded"],
+                stats["frames_delivered"], stats["branch_cpu_seconds"], stats["branch_cpu_saved_seconds"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmark of ICE candidate delivery from streaming threads
+
+Compares the previous approach of running every on_ice coroutine in a
+brand-new event loop on the emitting thread with LoopDispatcher, which
+batches the callbacks onto the main loop. Streaming threads are simulated
+with plain threads, no GStreamer is needed.
+
+    python3 bench/bench_ice_dispatch.py --threads 8 --candidates 2000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from loop_bridge import LoopDispatcher
+
+CANDIDATE = "candidate:1 1 UDP 2122252543 192.168.1.115 50123 typ host"
+
+
+def run_threads(num_threads, emit):
+    threads = [threading.Thread(target=emit) for _ in range(num_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return start
+
+
+def bench_new_loop(num_threads, num_candidates):
+    received = []
+
+    async def on_ice(mlineindex, candidate):
+        received.append(candidate)
+
+    def emit():
+        for i in range(num_candidates):
+            # What __send_ice used to do for every candidate. The loops are
+            # closed here, the old code leaked them.
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(on_ice(0, CANDIDATE))
+            loop.close()
+
+    start = run_threads(num_threads, emit)
+    elapsed = time.perf_counter() - start
+    assert len(received) == num_threads * num_candidates
+    return elapsed
+
+
+def bench_dispatcher(num_threads, num_candidates):
+    total = num_threads * num_candidates
+    loop = asyncio.new_event_loop()
+    done = loop.create_future()
+    received = []
+
+    async def on_ice(mlineindex, candidate):
+        received.append(candidate)
+        if len(received) == total:
+            done.set_result(None)
+
+    dispatcher = LoopDispatcher(loop)
+
+    def emit():
+        for i in range(num_candidates):
+            dispatcher.dispatch(on_ice, 0, CANDIDATE)
+
+    async def run():
+        return await loop.run_in_executor(None, run_threads, num_threads, emit)
+
+    start = loop.run_until_complete(run())
+    loop.run_until_complete(done)
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--threads', default=8, type=int, help='Number of emitting threads, one per session')
+    parser.add_argument('--candidates', default=2000, type=int, help='Candidates emitted per thread')
+    args = parser.parse_args()
+
+    total = args.threads * args.candidates
+    for name, bench in (("new event loop per candidate", bench_new_loop),
+                        ("LoopDispatcher", bench_dispatcher)):
+        elapsed = bench(args.threads, args.candidates)
+        print("%-30s %8d candidates in %.3fs: %10.0f candidates/s" % (name, total, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmark of the time to first frame with and without the pipeline pool
+
+Each session is a GSTWebRTCApp receiving from a local sending webrtcbin,
+videotestsrc -> x264enc -> rtph264pay -> webrtcbin, which stands in for the
+browser: it is built and PLAYING before the session starts, and sends its
+offer as soon as start_pipeline() returns, like a browser answering
+SESSION_OK. SDP and ICE are exchanged in process. The time from
+start_pipeline() to the first media buffer out of the receiving webrtcbin
+is reported for new pipelines and for pipelines taken from a pool.
+
+    python3 bench/bench_pipeline_pool.py --sessions 10 --pool 2
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version('GstWebRTC', '1.0')
+gi.require_version('GstSdp', '1.0')
+from gi.repository import Gst
+from gi.repository import GstWebRTC
+from gi.repository import GstSdp
+
+from gstwebrtc import GSTWebRTCApp, build_idle_pipeline
+from loop_bridge import LoopDispatcher
+from pipeline_pool import PipelinePool, startup_stats
+
+SENDER = ("videotestsrc is-live=true pattern=ball ! video/x-raw,width=640,height=360,framerate=30/1 "
+          "! x264enc tune=zerolatency speed-preset=ultrafast key-int-max=30 "
+          "! video/x-h264,profile=constrained-baseline ! rtph264pay config-interval=-1 pt=106 "
+          "! application/x-rtp,media=video,encoding-name=H264,payload=106 ! webrtcbin name=sender bundle-policy=max-compat")
+
+
+class Sender:
+    def __init__(self, loop):
+        self.loop = loop
+        self.pipeline = Gst.parse_launch(SENDER)
+        self.webrtcbin = self.pipeline.get_by_name("sender")
+        self.app = None
+        self.webrtcbin.connect('on-ice-candidate', lambda w, mlineindex, candidate:
+                               self.loop.call_soon_threadsafe(self.app.set_ice, mlineindex, candidate))
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def offer(self, app):
+        """Creates an offer and hands it to the receiving app.
+        """
+
+        self.app = app
+
+        def on_offer(promise):
+            offer = promise.get_reply().get_value("offer")
+            self.webrtcbin.emit('set-local-description', offer, None)
+            self.loop.call_soon_threadsafe(app.set_sdp, 'offer', offer.sdp.as_text())
+
+        self.webrtcbin.emit('create-offer', None, Gst.Promise.new_with_change_func(on_offer))
+
+    async def set_answer(self, sdp_type, sdp_text):
+        _, sdpmsg = GstSdp.SDPMessage.new_from_text(sdp_text)
+        answer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.ANSWER, sdpmsg)
+        self.webrtcbin.emit('set-remote-description', answer, None)
+
+    async def add_ice(self, mlineindex, candidate):
+        self.webrtcbin.emit('add-ice-candidate', mlineindex, candidate)
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+async def run_session(loop, dispatcher, pool, index, timeout):
+    sender = Sender(loop)
+    app = GSTWebRTCApp(encoder="x264enc", session_id="bench%d" % index, dispatcher=dispatcher,
+                       pipeline_pool=pool)
+    app.on_sdp = sender.set_answer
+    app.on_ice = sender.add_ice
+    before = {warm: (h.count, h.sum) for warm, h in startup_stats.first_frame.items()}
+
+    app.start_pipeline()
+    sender.offer(app)
+    # An empty pool makes the session build its own pipeline.
+    histogram = startup_stats.first_frame[app.warm]
+    seen, total = before[app.warm]
+    deadline = time.monotonic() + timeout
+    while histogram.count == seen and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+    app.stop_pipeline()
+    sender.stop()
+    if histogram.count == seen:
+        return None
+    return histogram.sum - total
+
+
+async def bench(loop, sessions, pool_size, timeout):
+    dispatcher = LoopDispatcher(loop)
+    pool = None
+    if pool_size:
+        pool = PipelinePool(pool_size, build_idle_pipeline)
+        pool.start(loop)
+        while len(pool.idle) < pool_size:
+            await asyncio.sleep(0.01)
+
+    results = []
+    for i in range(sessions):
+        results.append(await run_session(loop, dispatcher, pool, i, timeout))
+        # Browsers don't arrive back to back, give the pool time to refill.
+        await asyncio.sleep(0.5)
+    if pool is not None:
+        pool.stop()
+    return [r for r in results if r is not None], results.count(None)
+
+
+def report(name, results, failed):
+    if not results:
+        print("%-10s no session got a frame (%d timed out)" % (name, failed))
+        return
+    ms = sorted(r * 1000 for r in results)
+    print("%-10s median %6.1fms  min %6.1fms  max %6.1fms  (%d sessions, %d timed out)" % (
+        name, statistics.median(ms), ms[0], ms[-1], len(ms), failed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--pool', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    Gst.init(None)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    report("new", *loop.run_until_complete(bench(loop, args.sessions, 0, args.timeout)))
+    report("pre-built", *loop.run_until_complete(bench(loop, args.sessions, args.pool, args.timeout)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmark and equivalence check of the SDP munging
+
+Runs the previous chain of re.sub/str.replace rewrites and sdp_munger on
+the captured SDPs under sdp/, checks that both produce the same text and
+reports the time per SDP of each. Every SDP is also munged without the
+parameters the rules add, as webrtcbin writes its answers and offers.
+
+sdp_munger is timed on a fresh munger ("first", the first negotiation of a
+server) and on one that has munged the SDP before ("next", the same a=fmtp
+lines in later sessions).
+
+    python3 bench/bench_sdp_munge.py --iterations 5000
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from sdp_munger import SDPMunger, RTX_TIME_RULES, H264_RULES
+
+# Parameters the rules add, removed to get the SDPs before munging.
+MUNGED_PARAMS = (';rtx-time=125', 'profile-level-id=42e01f;', 'level-asymmetry-allowed=1;')
+
+
+def legacy_munge(sdp_text):
+    """The rewrites GSTWebRTCApp applied to every answer before sdp_munger.
+    """
+
+    if 'rtx-time' not in sdp_text:
+        sdp_text = re.sub(r'(apt=\d+)', r'\1;rtx-time=125', sdp_text)
+    elif 'rtx-time=125' not in sdp_text:
+        sdp_text = re.sub(r'rtx-time=\d+', r'rtx-time=125', sdp_text)
+    if 'profile-level-id' not in sdp_text:
+        sdp_text = sdp_text.replace('packetization-mode=1', 'profile-level-id=42e01f;packetization-mode=1')
+    if 'level-asymmetry-allowed' not in sdp_text:
+        sdp_text = sdp_text.replace('packetization-mode=1', 'level-asymmetry-allowed=1;packetization-mode=1')
+    return sdp_text
+
+
+def unmunged(sdp_text):
+    for param in MUNGED_PARAMS:
+        sdp_text = sdp_text.replace(param, '')
+    return sdp_text
+
+
+def per_run(func, iterations):
+    """Returns the best time of a run of func over 5 repeats, in microseconds.
+    """
+
+    return min(timeit.repeat(func, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--iterations', default=5000, type=int, help='Munging runs per SDP and implementation')
+    args = parser.parse_args()
+
+    rules = RTX_TIME_RULES + H264_RULES
+    munger = SDPMunger(rules)
+    failed = False
+    for path in sorted(glob.glob(os.path.join(ROOT, 'sdp', '*', '*.txt'))):
+        with open(path) as f:
+            captured = f.read()
+
+        for variant, sdp_text in (("captured", captured), ("unmunged", unmunged(captured))):
+            expected = legacy_munge(sdp_text)
+            munged = munger.munge(sdp_text)
+            same = munged == expected
+            failed = failed or not same
+
+            legacy = per_run(lambda: legacy_munge(sdp_text), args.iterations)
+            first = per_run(lambda: SDPMunger(rules).munge(sdp_text), args.iterations)
+            first -= per_run(lambda: SDPMunger(rules), args.iterations)
+            following = per_run(lambda: munger.munge(sdp_text), args.iterations)
+            print("%-45s %-8s %-9s legacy %6.1fus  sdp_munger first %6.1fus next %6.1fus" % (
+                os.path.relpath(path, ROOT), variant, "same" if same else "DIFFERENT", legacy, first, following))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
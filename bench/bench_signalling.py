@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Load generator and benchmark of the signalling server
+
+load: starts server/signalling.py in its own process, unless --url is
+given, and drives it with synthetic websocket peers: HELLO, SESSION pairing,
+an SDP offer and answer and ICE trickles in both directions of every
+session, then ROOM joins, room messages and leaves. Reports connections per
+second, relayed messages per second, p50/p99 relay latency and the server
+RSS per connection. Relayed messages carry their send time, the peers live
+in this process so the latency is measured on a single clock.
+
+Sessions are started as fast as --concurrency allows unless --rate paces
+them, the offered rate is reported next to the latency. Unpaced, the relay
+latency mostly measures the backlog of this generator. A few --probes pairs
+outside of the load relay one message at a time while it runs, their latency
+is what a lightly loaded peer sees.
+
+record: a websocket proxy in front of a server that writes the traffic of
+real clients to a JSON lines trace until interrupted.
+
+replay: plays the client side of a trace against a server at N times its
+recorded speed, and reports the same rates and the latency of the messages
+the server relayed, matched by content. A client message is only sent once
+the server sent as many messages as it had when it was recorded, so SESSION
+doesn't overtake the HELLO of its peer at high speeds.
+
+    python3 bench/bench_signalling.py load --sessions 1000 --ice 10 --room_peers 500
+    python3 bench/bench_signalling.py load --sessions 1000 --rate 200 --probes 4
+    python3 bench/bench_signalling.py record --listen_port 8081 --target ws://127.0.0.1:8080/ws --out trace.jsonl
+    python3 bench/bench_signalling.py replay trace.jsonl --speed 10
+"""
+
+import argparse
+import asyncio
+import base64
+import heapq
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'signalling.py')
+
+CANDIDATE = "candidate:%d 1 UDP 2122252543 192.168.1.115 %d typ host"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss_bytes(pid):
+    """Returns the RSS of a process and its descendants, from /proc.
+    """
+
+    total = 0
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(c) for c in f.read().split()]
+    except OSError:
+        return total
+    return total + sum(rss_bytes(c) for c in children)
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Stats:
+    def __init__(self):
+        self.received = 0
+        self.latencies = []
+
+    def observe(self, sent_at):
+        self.received += 1
+        self.latencies.append(time.perf_counter() - sent_at)
+
+
+class Peer:
+    def __init__(self, uid, stats):
+        """Synthetic signalling peer.
+
+        Messages with a "ts" field are relayed payloads, they are counted and
+        their latency observed in stats. Other messages are queued for
+        expect().
+        """
+
+        self.uid = uid
+        self.stats = stats
+        self.ws = None
+        self.inbox = asyncio.Queue()
+        self.reader = None
+        self.received = 0
+        self.expected = 0
+        self.done = None
+
+    async def connect(self, url):
+        self.ws = await websockets.connect(url, ping_interval=None, max_queue=None)
+        await self.ws.send('HELLO %s' % self.uid)
+        reply = await self.ws.recv()
+        if reply != 'HELLO':
+            raise Exception("peer %s: unexpected reply to HELLO: %s" % (self.uid, reply))
+        self.reader = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            async for msg in self.ws:
+                payload = msg
+                if msg.startswith('ROOM_PEER_MSG'):
+                    payload = msg.split(maxsplit=2)[2]
+                if payload.startswith('{'):
+                    sent_at = json.loads(payload).get('ts')
+                    if sent_at is not None:
+                        self.stats.observe(sent_at)
+                        self.received += 1
+                        if self.done is not None and self.received >= self.expected:
+                            self.done.set_result(None)
+                            self.done = None
+                        continue
+                self.inbox.put_nowait(msg)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def expect(self, prefix):
+        while True:
+            msg = await self.inbox.get()
+            if msg.startswith(prefix):
+                return msg
+            if msg.startswith('ERROR'):
+                raise Exception("peer %s: %s" % (self.uid, msg))
+
+    def wait_for(self, count):
+        """Returns a future done once count relayed payloads were received in total.
+        """
+
+        self.expected = count
+        self.done = asyncio.get_event_loop().create_future()
+        if self.received >= count:
+            self.done.set_result(None)
+        return self.done
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader is not None:
+            await self.reader
+
+
+def sdp_message(sdp_type, size):
+    body = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\n" + "a=x-pad:%s\r\n" % ("0" * max(0, size - 48))
+    return json.dumps({'sdp': {'type': sdp_type, 'sdp': body}, 'ts': time.perf_counter()})
+
+
+def ice_message(i):
+    return json.dumps({'ice': {'candidate': CANDIDATE % (i, 50000 + i), 'sdpMLineIndex': 0},
+                       'ts': time.perf_counter()})
+
+
+async def gather_limited(limit, coros, rate=0):
+    """Runs coros with at most limit of them in flight, starting rate per second unless rate is 0.
+    """
+
+    semaphore = asyncio.Semaphore(limit)
+    start = time.perf_counter()
+
+    async def run(i, coro):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(i, c) for i, c in enumerate(coros)))
+
+
+async def run_session(a, b, sdp_size, num_ice):
+    await a.ws.send('SESSION %s' % b.uid)
+    await a.expect('SESSION_OK')
+    # Offer, answer, then both sides trickle their candidates at once.
+    b_done = b.wait_for(1 + num_ice)
+    await a.ws.send(sdp_message('offer', sdp_size))
+    a_done = a.wait_for(1 + num_ice)
+    await b.ws.send(sdp_message('answer', sdp_size))
+    for i in range(num_ice):
+        await a.ws.send(ice_message(i))
+        await b.ws.send(ice_message(i))
+    await asyncio.gather(a_done, b_done)
+
+
+async def run_probe(a, b, interval, stopped):
+    """Relays one ICE message at a time from a to b until stopped is set.
+    """
+
+    await a.ws.send('SESSION %s' % b.uid)
+    await a.expect('SESSION_OK')
+    count = 0
+    while not stopped.is_set():
+        count += 1
+        b_done = b.wait_for(count)
+        await a.ws.send(ice_message(count))
+        await b_done
+        await asyncio.sleep(interval)
+
+
+async def run_room(peers, room_id, num_msgs):
+    for peer in peers:
+        await peer.ws.send('ROOM %s' % room_id)
+        await peer.expect('ROOM_OK')
+    # Each peer messages the next one around the room.
+    for i, peer in enumerate(peers):
+        sender = peers[i - 1]
+        peer_done = peer.wait_for(num_msgs)
+        for _ in range(num_msgs):
+            await sender.ws.send('ROOM_PEER_MSG %s %s' % (peer.uid, json.dumps({'ts': time.perf_counter()})))
+        await peer_done
+    for peer in peers:
+        await peer.close()
+
+
+def report(name, count, elapsed, unit):
+    print("%-22s %8d %-10s in %7.3fs  %10.1f/s" % (name, count, unit, elapsed, count / elapsed if elapsed else 0))
+
+
+def report_latency(name, stats):
+    ms = [l * 1000 for l in stats.latencies]
+    print("%-22s p50 %7.3fms  p99 %7.3fms  max %7.3fms  (%d messages)" % (
+        name, percentile(ms, 0.5), percentile(ms, 0.99), max(ms) if ms else float('nan'), len(ms)))
+
+
+class ServerProcess:
+    def __init__(self, workers):
+        self.port = free_port()
+        self.url = 'ws://127.0.0.1:%d/ws' % self.port
+        args = [sys.executable, SERVER, '--addr', '127.0.0.1', '--port', str(self.port), '--disable-ssl',
+                '--web_root', '', '--rtc_config_file', '', '--relay_log_interval', '0',
+                '--workers', str(workers)]
+        if workers > 1:
+            args += ['--registry_socket', '/tmp/bench-signalling-%d.sock' % self.port]
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    async def wait_ready(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                ws = await websockets.connect(self.url, ping_interval=None)
+                await ws.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    raise Exception("signalling server did not start")
+                await asyncio.sleep(0.05)
+
+    def rss(self):
+        return rss_bytes(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+async def load(args):
+    server = None
+    url = args.url
+    if url is None:
+        server = ServerProcess(args.workers)
+        await server.wait_ready()
+        url = server.url
+        # Let the server settle before the baseline.
+        await asyncio.sleep(0.2)
+    rss_before = server.rss() if server is not None else 0
+
+    session_stats = Stats()
+    room_stats = Stats()
+    pairs = [(Peer('a%d' % i, session_stats), Peer('b%d' % i, session_stats)) for i in range(args.sessions)]
+    room_peers = [Peer('r%d' % i, room_stats) for i in range(args.room_peers)]
+    probe_stats = Stats()
+    probe_pairs = [(Peer('pa%d' % i, probe_stats), Peer('pb%d' % i, probe_stats)) for i in range(args.probes)]
+    peers = [p for pair in pairs + probe_pairs for p in pair] + room_peers
+
+    start = time.perf_counter()
+    await gather_limited(args.concurrency, [p.connect(url) for p in peers])
+    connect_elapsed = time.perf_counter() - start
+    rss_after = server.rss() if server is not None else 0
+
+    probes_stopped = asyncio.Event()
+    probes = [asyncio.ensure_future(run_probe(a, b, args.probe_interval, probes_stopped)) for a, b in probe_pairs]
+
+    start = time.perf_counter()
+    await gather_limited(args.concurrency, [run_session(a, b, args.sdp_size, args.ice) for a, b in pairs],
+                         args.rate)
+    session_elapsed = time.perf_counter() - start
+
+    rooms = [room_peers[i:i + args.room_size] for i in range(0, len(room_peers), args.room_size)]
+    rooms = [room for room in rooms if len(room) > 1]
+    start = time.perf_counter()
+    await gather_limited(args.concurrency, [run_room(room, 'room%d' % i, args.room_msgs)
+                                            for i, room in enumerate(rooms)])
+    room_elapsed = time.perf_counter() - start
+
+    probes_stopped.set()
+    await asyncio.gather(*probes)
+    for a, b in pairs + probe_pairs:
+        await a.close()
+        await b.close()
+    if server is not None:
+        server.stop()
+
+    report("connections", len(peers), connect_elapsed, "peers")
+    report("session relays", session_stats.received, session_elapsed, "messages")
+    # Offer, answer and the candidates of both sides.
+    session_msgs = 2 + 2 * args.ice
+    if args.rate:
+        print("%-22s %8.1f sessions/s, %.1f messages/s (%.1f sessions/s achieved)" % (
+            "offered", args.rate, args.rate * session_msgs, len(pairs) / session_elapsed if session_elapsed else 0))
+    else:
+        print("%-22s unpaced, %d sessions in flight" % ("offered", args.concurrency))
+    report_latency("session relay latency", session_stats)
+    if probe_pairs:
+        report_latency("probe latency", probe_stats)
+    if rooms:
+        report("room joins", sum(len(r) for r in rooms), room_elapsed, "peers")
+        report("room messages", room_stats.received, room_elapsed, "messages")
+        report_latency("room message latency", room_stats)
+    if server is not None and peers:
+        print("%-22s %8.1f KiB per connection (%d peers, %.1f MiB total)" % (
+            "server RSS", (rss_after - rss_before) / 1024 / len(peers), len(peers), rss_after / 2 ** 20))
+
+
+class TraceWriter:
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.started = time.monotonic()
+
+    def write(self, conn, event, msg=None):
+        record = {'t': round(time.monotonic() - self.started, 6), 'conn': conn, 'event': event}
+        if isinstance(msg, bytes):
+            record['msg'] = base64.b64encode(msg).decode('ascii')
+            record['binary'] = True
+        elif msg is not None:
+            record['msg'] = msg
+        self.f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.f.close()
+
+
+async def record(args):
+    trace = TraceWriter(args.out)
+    connections = iter(range(sys.maxsize))
+
+    async def pump(conn, source, sink, event):
+        async for msg in source:
+            trace.write(conn, event, msg)
+            await sink.send(msg)
+
+    async def proxy(client, path):
+        conn = next(connections)
+        upstream = await websockets.connect(args.target, ping_interval=None)
+        trace.write(conn, 'open')
+        try:
+            up = asyncio.ensure_future(pump(conn, client, upstream, 'up'))
+            down = asyncio.ensure_future(pump(conn, upstream, client, 'down'))
+            await asyncio.wait([up, down], return_when=asyncio.FIRST_COMPLETED)
+            up.cancel()
+            down.cancel()
+        finally:
+            trace.write(conn, 'close')
+            await upstream.close()
+            await client.close()
+
+    server = await websockets.serve(proxy, '127.0.0.1', args.listen_port)
+    print("recording to %s, point clients at ws://127.0.0.1:%d/ws, Ctrl-C to stop" % (args.out, args.listen_port))
+    try:
+        await asyncio.Future()
+    finally:
+        server.close()
+        trace.close()
+
+
+def read_trace(path):
+    """Returns {conn: [records]} of a trace, in recorded order.
+
+    Times are moved to start at 0, and every record gets "deps", the number
+    of messages the server had sent to any client before it.
+    """
+
+    conns = dict()
+    sent_down = 0
+    first = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.pop('binary', False):
+                record['msg'] = base64.b64decode(record['msg'])
+            if first is None:
+                first = record['t']
+            record['t'] -= first
+            record['deps'] = sent_down
+            if record['event'] == 'down':
+                sent_down += 1
+            conns.setdefault(record['conn'], []).append(record)
+    return conns
+
+
+class ReceivedGate:
+    def __init__(self):
+        """Counts the messages received by all clients, and wakes up the ones waiting for a count.
+        """
+
+        self.received = 0
+        # Format: heap of (count, sequence number, Future)
+        self.waiters = []
+        self.sequence = 0
+
+    def add(self):
+        self.received += 1
+        while self.waiters and self.waiters[0][0] <= self.received:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, count, timeout):
+        """Returns False if count messages weren't received within timeout seconds.
+        """
+
+        if self.received >= count:
+            return True
+        future = asyncio.get_event_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.waiters, (count, self.sequence, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def relay_key(msg):
+    """Returns what a relayed message has in common with the one that was sent.
+    """
+
+    # ROOM_PEER_MSG <to> <msg> is delivered as ROOM_PEER_MSG <from> <msg>.
+    if isinstance(msg, str) and msg.startswith('ROOM_PEER_MSG'):
+        parts = msg.split(maxsplit=2)
+        if len(parts) == 3:
+            return parts[2]
+    return msg
+
+
+async def replay(args):
+    server = None
+    url = args.url
+    if url is None:
+        server = ServerProcess(args.workers)
+        await server.wait_ready()
+        url = server.url
+    conns = read_trace(args.trace)
+    stats = Stats()
+    gate = ReceivedGate()
+    # Format: {message: [perf_counter send times]}, to match relayed copies.
+    sent = dict()
+    expected = sum(1 for records in conns.values() for r in records if r['event'] == 'down')
+    connected = []
+    stalls = []
+    start = time.perf_counter()
+
+    async def play(records):
+        ws = None
+        try:
+            for r in records:
+                delay = start + r['t'] / args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # Causality: clients act on what the server sent them, such
+                # as HELLO before SESSION, whatever the speed.
+                if not await gate.wait(r['deps'], args.gate_timeout):
+                    stalls.append(r)
+                if r['event'] == 'open':
+                    ws = await websockets.connect(url, ping_interval=None, max_queue=None)
+                    connected.append(time.perf_counter() - start)
+                    asyncio.ensure_future(read(ws))
+                elif r['event'] == 'up' and ws is not None:
+                    sent.setdefault(relay_key(r['msg']), []).append(time.perf_counter())
+                    await ws.send(r['msg'])
+                elif r['event'] == 'close' and ws is not None:
+                    await ws.close()
+        except websockets.ConnectionClosed:
+            pass
+
+    async def read(ws):
+        try:
+            async for msg in ws:
+                times = sent.get(relay_key(msg))
+                if times:
+                    stats.observe(times.pop(0))
+                else:
+                    stats.received += 1
+                gate.add()
+        except websockets.ConnectionClosed:
+            pass
+
+    await asyncio.gather(*(play(records) for records in conns.values()))
+    # Let the last messages arrive.
+    await gate.wait(expected, args.gate_timeout)
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.stop()
+
+    report("connections", len(connected), connected[-1] if connected else 0, "peers")
+    report("received", stats.received, elapsed, "messages")
+    print("%-22s %8d recorded, %d waits for the server timed out" % ("", expected, len(stalls)))
+    report_latency("relay latency", stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    load_parser = commands.add_parser('load', help='drive a server with synthetic peers')
+    load_parser.add_argument('--url', default=None, help='server to benchmark, a new local one by default')
+    load_parser.add_argument('--workers', type=int, default=1, help='signalling workers of the local server')
+    load_parser.add_argument('--sessions', type=int, default=500, help='pairs of peers in a session')
+    load_parser.add_argument('--sdp_size', type=int, default=4000, help='bytes of the SDP offer and answer')
+    load_parser.add_argument('--ice', type=int, default=10, help='candidates trickled by each side')
+    load_parser.add_argument('--room_peers', type=int, default=200, help='peers joining rooms')
+    load_parser.add_argument('--room_size', type=int, default=10)
+    load_parser.add_argument('--room_msgs', type=int, default=5, help='messages received by each room peer')
+    load_parser.add_argument('--concurrency', type=int, default=200, help='handshakes, sessions and rooms in flight')
+    load_parser.add_argument('--rate', type=float, default=0,
+                             help='sessions started per second, 0 starts them as fast as --concurrency allows')
+    load_parser.add_argument('--probes', type=int, default=4,
+                             help='pairs relaying one message at a time to measure latency under the load')
+    load_parser.add_argument('--probe_interval', type=float, default=0.01, help='seconds between probe messages')
+
+    record_parser = commands.add_parser('record', help='record real traffic through a proxy')
+    record_parser.add_argument('--listen_port', type=int, default=8081)
+    record_parser.add_argument('--target', default='ws://127.0.0.1:8080/ws')
+    record_parser.add_argument('--out', default='signalling-trace.jsonl')
+
+    replay_parser = commands.add_parser('replay', help='replay a recorded trace')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='times the recorded speed')
+    replay_parser.add_argument('--url', default=None, help='server to replay against, a new local one by default')
+    replay_parser.add_argument('--workers', type=int, default=1, help='signalling workers of the local server')
+    replay_parser.add_argument('--gate_timeout', type=float, default=2.0,
+                               help='seconds a client waits for the server messages it saw in the recording')
+
+    args = parser.parse_args()
+    raise_fd_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete({'load': load, 'record': record, 'replay': replay}[args.command](args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger("connection_state")
+logger.setLevel(logging.INFO)
+
+"""Connection state event stream of a webrtcbin session
+
+The tracker is fed from the webrtcbin notify:: signals and records every
+transition with a monotonic timestamp, so connect latency can be measured
+per session. Subscribers either get a queue of events or await a state.
+
+    Usage example:
+    tracker = ConnectionStateTracker("1")
+    queue = tracker.subscribe()
+    event = await queue.get()
+    await tracker.wait_for("connection-state", "connected")
+
+"""
+
+ConnectionStateEvent = collections.namedtuple(
+    "ConnectionStateEvent", ["session_id", "prop", "old", "new", "timestamp"])
+
+
+class ConnectionStateTracker:
+    def __init__(self, session_id=None):
+        """Initialize the tracker.
+
+        Arguments:
+            session_id {string} -- id of the session the states belong to.
+        """
+
+        self.session_id = session_id
+        self.started_at = None
+        # Format: {prop: state}
+        self.states = dict()
+        self.transitions = []
+        self.subscribers = set()
+        # Format: {(prop, state): [futures]}
+        self.waiters = collections.defaultdict(list)
+
+    def reset(self):
+        """Forgets the recorded transitions and marks the start of a new negotiation.
+        """
+
+        self.started_at = time.monotonic()
+        self.states.clear()
+        self.transitions = []
+
+    def update(self, prop, state, timestamp=None):
+        """Records a state change and notifies the subscribers.
+
+        Must be called from the event loop thread.
+
+        Arguments:
+            prop {string} -- name of the webrtcbin property, for example "ice-connection-state".
+            state {string} -- nick of the new state, for example "checking".
+            timestamp {float} -- time.monotonic() of the change, now by default.
+        """
+
+        old = self.states.get(prop)
+        if old == state:
+            return
+        self.states[prop] = state
+        if timestamp is None:
+            timestamp = time.monotonic()
+        event = ConnectionStateEvent(self.session_id, prop, old, state, timestamp)
+        self.transitions.append(event)
+        logger.info("session %s: %s %s -> %s" % (self.session_id, prop, old, state))
+        if prop == "connection-state" and state == "connected" and self.started_at is not None:
+            logger.info("session %s: connected after %.3fs" % (self.session_id, event.timestamp - self.started_at))
+
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+        for future in self.waiters.pop((prop, state), []):
+            if not future.done():
+                future.set_result(event)
+
+    def subscribe(self):
+        """Returns a queue receiving every following ConnectionStateEvent.
+        """
+
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    async def wait_for(self, prop, state, timeout=None):
+        """Waits until prop reaches state.
+
+        Arguments:
+            prop {string} -- name of the webrtcbin property.
+            state {string} -- nick of the awaited state.
+            timeout {float} -- optional timeout in seconds.
+
+        Returns:
+            ConnectionStateEvent -- the transition, or None if already in that state.
+        """
+
+        if self.states.get(prop) == state:
+            return None
+        future = asyncio.get_event_loop().create_future()
+        waiters = self.waiters[(prop, state)]
+        waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # Timed out or cancelled, the state may never come.
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters and self.waiters.get((prop, state)) is waiters:
+                del self.waiters[(prop, state)]
+
+    def elapsed(self, prop, state):
+        """Returns the seconds from reset() to the first time prop reached state, or None.
+        """
+
+        if self.started_at is None:
+            return None
+        for event in self.transitions:
+            if event.prop == prop and event.new == state:
+                return event.timestamp - self.started_at
+        return None
+
+    def connect_latency(self):
+        """Returns the seconds from reset() until the peer connection was connected, or None.
+        """
+
+        return self.elapsed("connection-state", "connected")
@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version("GstVideo", "1.0")
+from gi.repository import Gst
+from gi.repository import GstVideo
+
+logger = logging.getLogger("decode_policy")
+logger.setLevel(logging.INFO)
+
+"""Decode policies of the FrameTap receive branch
+
+A policy decides which frames of the incoming H264 stream are decoded:
+
+    all        -- every frame is decoded.
+    keyframes  -- delta frames are dropped before the decoder, only keyframes
+                  are decoded. A keyframe can be requested every
+                  keyframe_interval seconds or on demand.
+    fps        -- keyframes only, requested from the sender at a target rate.
+    every-nth  -- every frame is decoded, P frames reference the previous
+                  ones, but only every Nth decoded frame is converted and
+                  delivered. The decoder skips B-frames, avdec's skip-frame=1
+                  (AVDISCARD_BIDIR); WebRTC senders rarely produce any.
+
+Keyframes are requested with an upstream force-key-unit event, sent by the
+rtpsession to the browser as an RTCP PLI, at most every min_pli_interval.
+
+The policy also measures the CPU time of the branch streaming thread, which
+runs depayloader, parser, decoder, converter and the frame consumers'
+callbacks, and estimates the branch time saved by the frames that weren't
+decoded. It's the cost of the branch, not of the decoder alone.
+
+    Usage example:
+    tap = FrameTap(session_id, decode_policy=DecodePolicy(POLICY_FPS, fps=1))
+    tap.decode_policy.request_keyframe()
+    logger.info(tap.decode_policy.stats())
+
+"""
+
+POLICY_ALL = "all"
+POLICY_KEYFRAMES = "keyframes"
+POLICY_FPS = "fps"
+POLICY_EVERY_NTH = "every-nth"
+
+POLICIES = (POLICY_ALL, POLICY_KEYFRAMES, POLICY_FPS, POLICY_EVERY_NTH)
+
+# skip-frame value of avdec decoders discarding B-frames, AVDISCARD_BIDIR.
+SKIP_B_FRAMES = 1
+
+
+class DecodePolicyError(Exception):
+    pass
+
+
+class DecodePolicy:
+    def __init__(self, mode=POLICY_ALL, every_nth=1, fps=0, keyframe_interval=0, min_pli_interval=0.5,
+                 session_id=None):
+        """Initialize the policy.
+
+        Arguments:
+            mode {string} -- one of POLICIES.
+            every_nth {integer} -- every-nth: deliver one of every_nth decoded frames.
+            fps {float} -- fps: target rate of decoded keyframes.
+            keyframe_interval {float} -- keyframes: seconds between keyframe requests, 0 to
+                                    only request them on demand.
+            min_pli_interval {float} -- minimum seconds between two keyframe requests.
+            session_id {string} -- id of the session, used for logging.
+        """
+
+        if mode not in POLICIES:
+            raise DecodePolicyError("unknown decode policy %s, must be one of: %s" % (mode, ", ".join(POLICIES)))
+        if mode == POLICY_FPS and fps <= 0:
+            raise DecodePolicyError("the fps decode policy needs a target fps")
+
+        self.mode = mode
+        self.every_nth = max(1, every_nth)
+        self.fps = fps
+        self.keyframe_interval = 1.0 / fps if mode == POLICY_FPS else keyframe_interval
+        self.min_pli_interval = min_pli_interval
+        self.session_id = session_id
+
+        self.parse_src = None
+        self.lock = threading.Lock()
+        self.last_pli = 0.0
+        self.last_keyframe = 0.0
+
+        # Counters, updated on the branch streaming thread.
+        self.frames_in = 0
+        self.frames_dropped = 0
+        self.frames_decoded = 0
+        self.frames_delivered = 0
+        self.keyframe_requests = 0
+        self.branch_cpu_seconds = 0.0
+        self.cpu_thread = None
+        self.cpu_mark = 0.0
+        self.started_at = None
+
+    def attach(self, parse, decoder):
+        """Installs the policy on the parser and decoder of a FrameTap branch.
+
+        Arguments:
+            parse {Gst.Element} -- the h264parse feeding the decoder.
+            decoder {Gst.Element} -- the decoder.
+        """
+
+        self.parse_src = parse.get_static_pad("src")
+        self.started_at = time.monotonic()
+        self.parse_src.add_probe(Gst.PadProbeType.BUFFER, lambda pad, info: self.__on_encoded(info))
+        decoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, lambda pad, info: self.__on_decoded(info))
+
+        if self.mode != POLICY_ALL:
+            # Few frames are decoded, frame threading would only add latency
+            # and move decoding out of the measured streaming thread.
+            decoder.set_property("max-threads", 1)
+        if self.mode == POLICY_EVERY_NTH:
+            # Nothing refers to B-frames, the policy can do without them.
+            decoder.set_property("skip-frame", SKIP_B_FRAMES)
+
+        logger.info("session %s: decode policy %s" % (self.session_id, self.describe()))
+
+    def describe(self):
+        if self.mode == POLICY_EVERY_NTH:
+            return "%s (%d)" % (self.mode, self.every_nth)
+        if self.mode == POLICY_FPS:
+            return "%s (%g)" % (self.mode, self.fps)
+        if self.mode == POLICY_KEYFRAMES and self.keyframe_interval:
+            return "%s (every %gs)" % (self.mode, self.keyframe_interval)
+        return self.mode
+
+    def request_keyframe(self):
+        """Asks the sender for a keyframe, sent as RTCP PLI. Thread safe.
+
+        Returns:
+            bool -- False if a keyframe was requested less than min_pli_interval ago.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if self.parse_src is None or now - self.last_pli < self.min_pli_interval:
+                return False
+            self.last_pli = now
+            self.keyframe_requests += 1
+            pad = self.parse_src
+        event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+        pad.send_event(event)
+        return True
+
+    def __measure_cpu(self):
+        # The probes run on the branch streaming thread, the thread CPU time
+        # between two buffers is the cost of processing the previous one,
+        # including the consumers called with its decoded frame.
+        thread = threading.get_ident()
+        mark = time.thread_time()
+        if thread == self.cpu_thread:
+            self.branch_cpu_seconds += mark - self.cpu_mark
+        self.cpu_thread = thread
+        self.cpu_mark = mark
+
+    def __on_encoded(self, info):
+        self.__measure_cpu()
+        self.frames_in += 1
+        if self.mode in (POLICY_ALL, POLICY_EVERY_NTH):
+            return Gst.PadProbeReturn.OK
+
+        now = time.monotonic()
+        keyframe = not info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT)
+        if self.keyframe_interval and now - self.last_keyframe >= self.keyframe_interval:
+            self.request_keyframe()
+        if not keyframe:
+            self.frames_dropped += 1
+            return Gst.PadProbeReturn.DROP
+        if self.mode == POLICY_FPS and now - self.last_keyframe < self.keyframe_interval * 0.9:
+            # The sender sends keyframes on its own faster than the target rate.
+            self.frames_dropped += 1
+            return Gst.PadProbeReturn.DROP
+        self.last_keyframe = now
+        return Gst.PadProbeReturn.OK
+
+    def __on_decoded(self, info):
+        self.frames_decoded += 1
+        if self.mode == POLICY_EVERY_NTH and self.frames_decoded % self.every_nth != 0:
+            return Gst.PadProbeReturn.DROP
+        self.frames_delivered += 1
+        return Gst.PadProbeReturn.OK
+
+    def stats(self):
+        """Returns the counters of the policy and the CPU time of the branch.
+
+        branch_cpu_saved_seconds estimates the branch time of the dropped
+        frames from the average cost of a decoded one, conversion and
+        consumers included.
+        """
+
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        cpu_per_frame = self.branch_cpu_seconds / self.frames_decoded if self.frames_decoded else 0.0
+        return {
+            "policy": self.describe(),
+            "frames_in": self.frames_in,
+            "frames_dropped": self.frames_dropped,
+            "frames_decoded": self.frames_decoded,
+            "frames_delivered": self.frames_delivered,
+            "keyframe_requests": self.keyframe_requests,
+            "branch_cpu_seconds": self.branch_cpu_seconds,
+            "branch_cpu_load": self.branch_cpu_seconds / elapsed if elapsed else 0.0,
+            "branch_cpu_saved_seconds": cpu_per_frame * self.frames_dropped,
+        }
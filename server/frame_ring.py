@@ -0,0 +1,246 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import logging
+import re
+import struct
+
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("frame_ring")
+logger.setLevel(logging.INFO)
+
+"""Shared-memory ring buffer of the decoded frames of a session
+
+The writer copies each frame once into the next slot of a fixed-size
+multiprocessing.shared_memory block named after the session. Readers in
+other processes attach by session id and get NumPy views of the slots, so
+no frame is serialized or sent over a socket. The writer never waits for a
+reader: slots are overwritten in turn, and a reader checks with is_current()
+that the frame it looked at wasn't overwritten meanwhile.
+
+Layout, little-endian:
+
+    ring header  (64 bytes): magic "WRFR", version, slots, slot_size, write_seq
+    slot header  (64 bytes): seq, pts, width, height, channels, size, format
+    slot data    (slot_size bytes): rows of width * channels bytes, no padding
+
+A slot's seq is 0 while it's being written and the sequence number of the
+frame once it's complete. write_seq is the sequence number of the newest
+complete frame.
+
+    Usage example:
+    # in the session process
+    ring = FrameRingWriter(session_id)
+    tap.on_frames = ring.write_frames
+
+    # in a consumer process
+    reader = FrameRingReader(session_id)
+    frame = reader.latest()
+    result = model.predict(frame.array)
+    if not reader.is_current(frame):
+        pass  # overwritten while in use, discard the result
+
+"""
+
+MAGIC = b"WRFR"
+VERSION = 1
+
+RING_HEADER = struct.Struct("<4sIIIQ")
+RING_HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QQIIII8s")
+SLOT_HEADER_SIZE = 64
+# Offset of write_seq in the ring header.
+WRITE_SEQ_OFFSET = 16
+
+DEFAULT_SLOT_SIZE = 1920 * 1080 * 4
+
+RingFrame = collections.namedtuple("RingFrame", ["seq", "pts", "width", "height", "format", "array"])
+
+
+class FrameRingError(Exception):
+    pass
+
+
+def ring_name(session_id):
+    """Returns the shared memory name of the ring of a session.
+    """
+
+    return "webrtc_frames_" + re.sub(r'[^A-Za-z0-9_.-]', '_', str(session_id))
+
+
+class FrameRingWriter:
+    def __init__(self, session_id, slots=4, slot_size=DEFAULT_SLOT_SIZE):
+        """Creates the ring of a session, replacing a stale one of the same name.
+
+        Arguments:
+            session_id {string} -- id of the session, readers attach with it.
+            slots {integer} -- number of frames kept.
+            slot_size {integer} -- maximum size of a frame in bytes, larger frames are dropped.
+        """
+
+        if np is None:
+            raise FrameRingError("numpy is required for the frame ring")
+
+        self.session_id = session_id
+        self.slots = slots
+        self.slot_size = slot_size
+        self.slot_stride = SLOT_HEADER_SIZE + slot_size
+        self.seq = 0
+        self.dropped = 0
+
+        name = ring_name(session_id)
+        size = RING_HEADER_SIZE + slots * self.slot_stride
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a crashed process.
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.buf = self.shm.buf
+        RING_HEADER.pack_into(self.buf, 0, MAGIC, VERSION, slots, slot_size, 0)
+        logger.info("frame ring %s: %d slots of %d bytes" % (name, slots, slot_size))
+
+    def write(self, array, pts, video_format):
+        """Copies a frame into the next slot.
+
+        Arguments:
+            array {numpy.ndarray} -- frame of shape (height, width[, channels]), may be strided.
+            pts {integer} -- presentation timestamp of the frame.
+            video_format {string} -- colorspace of the frame, such as "RGB".
+
+        Returns:
+            integer -- sequence number of the frame, 0 if it was dropped.
+        """
+
+        height, width = array.shape[:2]
+        channels = array.shape[2] if array.ndim == 3 else 1
+        size = width * height * channels
+        if size > self.slot_size:
+            self.dropped += 1
+            if self.dropped == 1:
+                logger.warning("frame ring %s: dropping %dx%d frames larger than the %d byte slots" % (
+                    self.session_id, width, height, self.slot_size))
+            return 0
+
+        seq = self.seq + 1
+        offset = RING_HEADER_SIZE + (seq % self.slots) * self.slot_stride
+        # Mark the slot as being written, then fill it and publish the seq last.
+        struct.pack_into("<Q", self.buf, offset, 0)
+        data = np.ndarray(array.shape, dtype=np.uint8, buffer=self.buf,
+                          offset=offset + SLOT_HEADER_SIZE)
+        np.copyto(data, array)
+        SLOT_HEADER.pack_into(self.buf, offset, 0, pts & 0xffffffffffffffff, width, height, channels, size,
+                              video_format.encode()[:8])
+        struct.pack_into("<Q", self.buf, offset, seq)
+        struct.pack_into("<Q", self.buf, WRITE_SEQ_OFFSET, seq)
+        self.seq = seq
+        return seq
+
+    def write_frames(self, frames):
+        """Writes a batch of frame_tap.Frame, usable as FrameTap.on_frames.
+        """
+
+        for frame in frames:
+            self.write(frame.array, frame.pts, frame.format)
+
+    def close(self):
+        """Removes the ring, attached readers keep their mapping until they close.
+        """
+
+        self.buf = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class FrameRingReader:
+    def __init__(self, session_id):
+        """Attaches to the ring of a session.
+
+        Arguments:
+            session_id {string} -- id of the session.
+
+        Raises:
+            FileNotFoundError -- if the session has no ring.
+            FrameRingError -- if the memory isn't a frame ring of this version.
+        """
+
+        if np is None:
+            raise FrameRingError("numpy is required for the frame ring")
+
+        name = ring_name(session_id)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 tracks attached memory too and would unlink the
+            # ring when this process exits.
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+        magic, version, self.slots, self.slot_size, _ = RING_HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.shm.close()
+            raise FrameRingError("%s is not a version %d frame ring" % (name, VERSION))
+        self.slot_stride = SLOT_HEADER_SIZE + self.slot_size
+
+    def write_seq(self):
+        """Returns the sequence number of the newest frame, 0 if there is none yet.
+        """
+
+        return struct.unpack_from("<Q", self.buf, WRITE_SEQ_OFFSET)[0]
+
+    def frame(self, seq):
+        """Returns a view of frame seq, or None if it was overwritten or isn't written yet.
+        """
+
+        if seq <= 0:
+            return None
+        offset = RING_HEADER_SIZE + (seq % self.slots) * self.slot_stride
+        slot_seq, pts, width, height, channels, size, video_format = SLOT_HEADER.unpack_from(self.buf, offset)
+        if slot_seq != seq:
+            return None
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        array = np.ndarray(shape, dtype=np.uint8, buffer=self.buf, offset=offset + SLOT_HEADER_SIZE)
+        frame = RingFrame(seq, pts, width, height, video_format.rstrip(b"\0").decode(), array)
+        # The header may have been read while the writer took the slot over.
+        return frame if self.is_current(frame) else None
+
+    def latest(self):
+        """Returns a view of the newest complete frame, or None if there is none.
+        """
+
+        return self.frame(self.write_seq())
+
+    def frames_since(self, seq):
+        """Returns views of the frames newer than seq that are still in the ring, oldest first.
+        """
+
+        newest = self.write_seq()
+        first = max(seq + 1, newest - self.slots + 2)
+        return [frame for frame in (self.frame(s) for s in range(first, newest + 1)) if frame is not None]
+
+    def is_current(self, frame):
+        """Returns True if the slot of a frame still holds it.
+
+        The view of a frame is overwritten by the writer after slots - 1 newer
+        frames, check this after using it, or copy the array.
+        """
+
+        offset = RING_HEADER_SIZE + (frame.seq % self.slots) * self.slot_stride
+        return struct.unpack_from("<Q", self.buf, offset)[0] == frame.seq
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
@@ -0,0 +1,254 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import logging
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version("GstVideo", "1.0")
+from gi.repository import Gst
+from gi.repository import GstVideo
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from decode_policy import DecodePolicy
+
+logger = logging.getLogger("frame_tap")
+logger.setLevel(logging.INFO)
+
+"""Decoded frames of the incoming video as NumPy arrays
+
+The H264 stream is decoded and converted to a packed colorspace, then pulled
+from an appsink:
+
+    webrtcbin -> queue -> rtph264depay -> h264parse -> avdec_h264
+              -> videorate -> videoconvert -> capsfilter -> appsink
+
+The DecodePolicy of the tap decides which frames reach the decoder, see
+decode_policy.py.
+
+Each array is a view of the mapped Gst.Buffer memory, no frame is copied.
+Frames are handed to on_frames in batches, on the streaming thread of the
+branch, and the buffers are unmapped when the callback returns: copy an
+array to keep it longer. A callback slower than the stream makes the appsink
+drop the oldest frames, it never stalls the pipeline.
+
+    Usage example:
+    tap = FrameTap(session_id, batch_size=4, max_fps=5, video_format="RGB")
+    tap.on_frames = lambda frames: model.predict([f.array for f in frames])
+    app = GSTWebRTCApp(receive_branch=tap)
+
+"""
+
+# Packed formats the arrays can be delivered in, with their bytes per pixel.
+FORMAT_CHANNELS = {
+    "RGB": 3,
+    "BGR": 3,
+    "RGBA": 4,
+    "BGRA": 4,
+    "RGBx": 4,
+    "BGRx": 4,
+    "GRAY8": 1,
+}
+
+Frame = collections.namedtuple("Frame", ["array", "pts", "width", "height", "format"])
+
+
+class FrameTapError(Exception):
+    pass
+
+
+class FrameTap:
+    # Plugins of the elements used by the branch, checked by GSTWebRTCApp.
+    required_plugins = ["coreelements", "rtp", "videoparsersbad", "libav",
+                        "videorate", "videoconvert", "app"]
+
+    def __init__(self, session_id=None, batch_size=1, max_fps=0, video_format="RGB", max_pending=2,
+                 decode_policy=None):
+        """Initialize the frame tap.
+
+        Arguments:
+            session_id {string} -- id of the session, used for logging.
+            batch_size {integer} -- number of frames handed to on_frames at once.
+            max_fps {integer} -- maximum frame rate delivered, frames above it are dropped
+                                    before conversion, 0 for no limit.
+            video_format {string} -- colorspace of the arrays, one of FORMAT_CHANNELS.
+            max_pending {integer} -- batches queued in the appsink before the oldest
+                                    frames are dropped.
+            decode_policy {DecodePolicy} -- frames decoded, default: all of them.
+        """
+
+        if np is None:
+            raise FrameTapError("numpy is required for frame access")
+        if video_format not in FORMAT_CHANNELS:
+            raise FrameTapError("unsupported video format %s, must be one of: %s" % (
+                video_format, ", ".join(FORMAT_CHANNELS)))
+
+        self.session_id = session_id
+        self.batch_size = max(1, batch_size)
+        self.max_fps = max_fps
+        self.video_format = video_format
+        self.channels = FORMAT_CHANNELS[video_format]
+        self.max_pending = max_pending
+        self.decode_policy = decode_policy or DecodePolicy()
+        if self.decode_policy.session_id is None:
+            self.decode_policy.session_id = session_id
+        self.elements = []
+        self.appsink = None
+
+        # Samples mapped for the batch being collected, with their map infos.
+        self.batch = []
+        # Caps of the last sample and the frame layout they imply.
+        self.caps = None
+        self.width = 0
+        self.height = 0
+        self.stride = 0
+        self.frames = 0
+        self.copies_warned = False
+
+        # Frame batches, fired on the streaming thread of the branch.
+        self.on_frames = lambda frames: logger.warn("unhandled frames")
+
+    def accepts(self, caps):
+        """Returns True if the branch can handle a webrtcbin src pad with these caps.
+        """
+
+        s = caps.get_structure(0)
+        return s.get_value("media") == "video" and s.get_value("encoding-name") == "H264"
+
+    def link(self, pipeline, pad, element_name):
+        """Builds the decode branch and links it to a webrtcbin src pad.
+
+        Arguments:
+            pipeline {Gst.Pipeline} -- pipeline of the webrtcbin.
+            pad {Gst.Pad} -- the webrtcbin src pad carrying the H264 RTP stream.
+            element_name {function} -- returns a name unique to the session for an element name.
+        """
+
+        queue = Gst.ElementFactory.make("queue", element_name("frames_queue"))
+        queue.set_property("leaky", "downstream")
+        depay = Gst.ElementFactory.make("rtph264depay", element_name("frames_depay"))
+        parse = Gst.ElementFactory.make("h264parse", element_name("frames_parse"))
+        decoder = Gst.ElementFactory.make("avdec_h264", element_name("frames_decoder"))
+
+        # Drop frames above max_fps before they are converted, never duplicate.
+        rate = Gst.ElementFactory.make("videorate", element_name("frames_rate"))
+        rate.set_property("drop-only", True)
+        if self.max_fps:
+            rate.set_property("max-rate", self.max_fps)
+
+        convert = Gst.ElementFactory.make("videoconvert", element_name("frames_convert"))
+        capsfilter = Gst.ElementFactory.make("capsfilter", element_name("frames_caps"))
+        capsfilter.set_property("caps", Gst.caps_from_string("video/x-raw,format=%s" % self.video_format))
+
+        self.appsink = Gst.ElementFactory.make("appsink", element_name("frames_sink"))
+        self.appsink.set_property("emit-signals", True)
+        self.appsink.set_property("sync", False)
+        self.appsink.set_property("max-buffers", self.batch_size * self.max_pending)
+        self.appsink.set_property("drop", True)
+        self.appsink.connect("new-sample", lambda sink: self.__on_new_sample(sink))
+
+        self.elements = [queue, depay, parse, decoder, rate, convert, capsfilter, self.appsink]
+        for element in self.elements:
+            pipeline.add(element)
+        if pad.link(queue.get_static_pad("sink")) != Gst.PadLinkReturn.OK:
+            raise FrameTapError("Failed to link webrtcbin -> frames queue")
+        for upstream, downstream in zip(self.elements, self.elements[1:]):
+            if not upstream.link(downstream):
+                raise FrameTapError("Failed to link %s -> %s" % (upstream.get_name(), downstream.get_name()))
+        self.decode_policy.attach(parse, decoder)
+        for element in self.elements:
+            element.sync_state_with_parent()
+
+        logger.info("delivering %s frames of session %s in batches of %d" % (
+            self.video_format, self.session_id, self.batch_size))
+
+    def __on_new_sample(self, sink):
+        sample = sink.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.EOS
+
+        buf = sample.get_buffer()
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            logger.warning("session %s: failed to map frame buffer" % self.session_id)
+            return Gst.FlowReturn.OK
+        # Keep the sample referenced while its memory is mapped.
+        self.batch.append((sample, buf, info))
+        if len(self.batch) >= self.batch_size:
+            self.__deliver()
+        return Gst.FlowReturn.OK
+
+    def __deliver(self):
+        batch, self.batch = self.batch, []
+        try:
+            frames = [self.__frame(sample, buf, info) for sample, buf, info in batch]
+            self.frames += len(frames)
+            self.on_frames(frames)
+        except Exception as e:
+            logger.error("session %s: frame callback failed: %s" % (self.session_id, e))
+        finally:
+            for _, buf, info in batch:
+                buf.unmap(info)
+
+    def __frame(self, sample, buf, info):
+        caps = sample.get_caps()
+        if self.caps is None or not caps.is_equal(self.caps):
+            self.__update_caps(caps)
+        data = info.data
+        if not isinstance(data, memoryview) and not self.copies_warned:
+            # Older gst-python returns the mapped memory as a bytes copy.
+            logger.warning("Gst.Buffer.map() returns copies, gst-python >= 1.18 is needed for zero-copy frames")
+            self.copies_warned = True
+        # Decoders with padded buffers attach the actual layout as a video
+        # meta, the caps only describe the default one.
+        stride, offset = self.stride, 0
+        meta = GstVideo.buffer_get_video_meta(buf)
+        if meta is not None:
+            stride, offset = meta.stride[0], meta.offset[0]
+        array = np.ndarray(shape=(self.height, self.width, self.channels), dtype=np.uint8, buffer=data,
+                           offset=offset, strides=(stride, self.channels, 1))
+        if self.channels == 1:
+            array = array[:, :, 0]
+        return Frame(array, buf.pts, self.width, self.height, self.video_format)
+
+    def __update_caps(self, caps):
+        self.caps = caps
+        try:
+            video_info = GstVideo.VideoInfo.new_from_caps(caps)
+        except AttributeError:
+            # GStreamer < 1.20
+            video_info = GstVideo.VideoInfo()
+            video_info.from_caps(caps)
+        self.width = video_info.width
+        self.height = video_info.height
+        self.stride = video_info.stride[0]
+        logger.info("session %s: frames are %dx%d %s, stride %d" % (
+            self.session_id, self.width, self.height, self.video_format, self.stride))
+
+    def request_keyframe(self):
+        """Asks the sender for a keyframe, see DecodePolicy.request_keyframe.
+        """
+
+        return self.decode_policy.request_keyframe()
+
+    def handle_message(self, message):
+        return False
+
+    def release(self):
+        """Forgets the elements and unmaps the frames of an incomplete batch.
+        """
+
+        for _, buf, info in self.batch:
+            buf.unmap(info)
+        self.batch = []
+        self.elements = []
+        self.appsink = None
+        self.caps = None
+        self.decode_policy.parse_src = None
+        logger.info("session %s: decode stats %s" % (self.session_id, self.decode_policy.stats()))
@@ -23,7 +23,7 @@ import asyncio
 import base64
 import json
 import logging
-import re
+import time
 from subprocess import Popen, PIPE
 
 import gi
@@ -34,6 +34,14 @@ from gi.repository import Gst
 from gi.repository import GstWebRTC
 from gi.repository import GstSdp
 
+from connection_state import ConnectionStateTracker
+from latency_trace import LatencyTracer, rtp_seq_key
+from pipeline_pool import startup_stats
+from loop_bridge import LoopDispatcher
+from negotiation import WebRTCNegotiation, WebRTCNegotiationError
+from jitter_tuning import DEFAULT_LATENCY, JitterBufferTuning
+from startup import init_gstreamer, plugin_cache
+
 logger = logging.getLogger("gstwebrtc_app")
 logger.setLevel(logging.INFO)
 
@@ -41,8 +49,75 @@ class GSTWebRTCAppError(Exception):
     pass
 
 
+# The bundle policy affects how the SDP is generated.
+# This will ultimately determine how many tracks the browser receives.
+# Setting this to max-compat will generate separate tracks for
+# audio and video.
+# See also: https://webrtcstandards.info/sdp-bundle/
+BUNDLE_POLICY = "max-compat"
+
+# Plugins every session needs, receive branches add their own.
+REQUIRED_PLUGINS = ["opus", "nice", "webrtc", "dtls", "srtp", "rtp", "sctp", "rtpmanager"]
+
+
+def video_codec_caps():
+    """Returns the caps of the H264 video the receive transceiver is created with.
+    """
+
+    codec_caps = Gst.caps_from_string("application/x-rtp")
+    codec_caps.set_value("media", "video")
+    codec_caps.set_value("encoding-name", "H264")
+    codec_caps.set_value("payload", 106)
+    # codec_caps.set_value("retransmission-name", "RTX")
+    # codec_caps.set_value("payload", 107)
+    codec_caps.set_value("clock-rate", 90000)
+    codec_caps.set_value("profile", "constrained-baseline")
+    return codec_caps
+
+
+def prepare_gstreamer():
+    """Initializes GStreamer and checks the plugins of every session ahead of the first one.
+
+    Returns:
+        list of string -- the missing plugins.
+    """
+
+    init_gstreamer()
+    missing = plugin_cache.missing(REQUIRED_PLUGINS)
+    if missing:
+        logger.error("missing gstreamer plugins: %s" % missing)
+    return missing
+
+
+def build_idle_pipeline(name):
+    """Builds a PLAYING pipeline with a webrtcbin and its receive transceiver, not bound to a session.
+
+    Used by pipeline_pool.PipelinePool, GSTWebRTCApp.start_pipeline() adopts
+    it with configure_webrtcbin().
+
+    Arguments:
+        name {string} -- suffix of the element names.
+
+    Returns:
+        tuple -- (Gst.Pipeline, webrtcbin)
+    """
+
+    init_gstreamer()
+    pipeline = Gst.Pipeline.new("pipeline_%s" % name)
+    webrtcbin = Gst.ElementFactory.make("webrtcbin", "app_%s" % name)
+    webrtcbin.set_property("bundle-policy", BUNDLE_POLICY)
+    pipeline.add(webrtcbin)
+    webrtcbin.emit("add-transceiver", GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY, video_codec_caps())
+    res = pipeline.set_state(Gst.State.PLAYING)
+    if res == Gst.StateChangeReturn.FAILURE:
+        pipeline.set_state(Gst.State.NULL)
+        raise GSTWebRTCAppError("Failed to transition idle pipeline to PLAYING")
+    return pipeline, webrtcbin
+
+
 class GSTWebRTCApp:
-    def __init__(self, stun_servers=None, turn_servers=None, encoder=None):
+    def __init__(self, stun_servers=None, turn_servers=None, encoder=None, session_id=None, dispatcher=None,
+                 receive_branch=None, jitter_tuning=None, pipeline_pool=None):
         """Initialize GStreamer WebRTC app.
 
         Initializes GObjects and checks for required plugins.
@@ -52,19 +127,52 @@ class GSTWebRTCApp:
                                     stun:<host>:<port>
             turn_servers {[list of strings]} -- Optional TURN server uris in the form of:
                                     turn://<user>:<password>@<host>:<port>
+            session_id {string} -- Optional id of the session this app serves, used to give
+                                    the pipeline elements unique names.
+            dispatcher {LoopDispatcher} -- Optional dispatcher shared between apps, used to run
+                                    webrtcbin callbacks on the event loop.
+            receive_branch {object} -- Optional consumer of the incoming video, such as a
+                                    recording.SegmentedRecorder. Streams it doesn't accept
+                                    go to a fakesink.
+            jitter_tuning {JitterBufferTuning} -- Optional jitterbuffer and retransmission
+                                    settings, see tune().
+            pipeline_pool {PipelinePool} -- Optional pool of pre-built pipelines, start_pipeline()
+                                    takes one from it instead of building its own when it can.
         """
 
+        self.session_id = session_id
+        self.dispatcher = dispatcher
         self.stun_servers = stun_servers
         self.turn_servers = turn_servers
         self.pipeline = None
         self.webrtcbin = None
         self.encoder = encoder
+        self.receive_branch = receive_branch
+
+        # Offer/answer negotiation of the current pipeline, see set_sdp()
+        self.negotiation = None
+        self.answer_task = None
 
-        self.peer_connection_state = None
-        self.ice_connection_state = None
+        # Connection state event stream, fed from the webrtcbin notify:: signals.
+        self.state_tracker = ConnectionStateTracker(session_id)
 
-        self.fakesink_state = None
         self.fakesink = None
+        # Jitterbuffers of the incoming streams, read for their stats.
+        self.jitterbuffers = []
+
+        # Per-element latency of the receive path, disabled until enabled.
+        self.latency_tracer = LatencyTracer(session_id)
+
+        # Jitterbuffer settings, and the task resizing the jitterbuffers in adaptive mode.
+        self.jitter_tuning = jitter_tuning or JitterBufferTuning(session_id=session_id)
+        self.adaptive_latency = None
+        self.adapt_task = None
+
+        # Pre-built pipelines, and startup timing of the current pipeline.
+        self.pipeline_pool = pipeline_pool
+        self.warm = False
+        self.started_at = None
+        self.first_frame_seen = False
         # self.rtpqueue_state = None
         # self.rtpqueue = None
 
@@ -73,12 +181,31 @@ class GSTWebRTCApp:
             'unhandled ice event')
         self.on_sdp = lambda sdp_type, sdp: logger.warn('unhandled sdp event')
 
-        Gst.init(None)
+        # Pipeline error event, fired from the bus watch as soon as the error is posted.
+        self.on_bus_error = lambda err: logger.warn('unhandled bus error event')
+
+        # Bus watch state, see watch_bus()
+        self.loop = None
+        self.bus = None
+        self.bus_fd = None
+
+        init_gstreamer()
 
         self.check_plugins()
 
         self.pipeline = None
 
+    def element_name(self, name):
+        """Returns an element name that is unique to this session.
+
+        Arguments:
+            name {string} -- base name of the element
+        """
+
+        if self.session_id is None:
+            return name
+        return "%s_%s" % (name, self.session_id)
+
     # [START build_webrtcbin_pipeline]
     def build_webrtcbin_pipeline(self):
         """Adds the webrtcbin elments to the pipeline.
@@ -88,14 +215,21 @@ class GSTWebRTCApp:
         """
 
         # Create webrtcbin element named app
-        self.webrtcbin = Gst.ElementFactory.make("webrtcbin", "app")
+        self.webrtcbin = Gst.ElementFactory.make("webrtcbin", self.element_name("app"))
+        self.webrtcbin.set_property("bundle-policy", BUNDLE_POLICY)
+
+        self.configure_webrtcbin()
+
+        # Add element to the pipeline.
+        self.pipeline.add(self.webrtcbin)
+    # [END build_webrtcbin_pipeline]
 
-        # The bundle policy affects how the SDP is generated.
-        # This will ultimately determine how many tracks the browser receives.
-        # Setting this to max-compat will generate separate tracks for
-        # audio and video.
-        # See also: https://webrtcstandards.info/sdp-bundle/
-        self.webrtcbin.set_property("bundle-policy", "max-compat")
+    def configure_webrtcbin(self):
+        """Connects the signal handlers and sets the servers and settings of this session.
+
+        Also used for the webrtcbin of a pre-built pipeline, so only what can
+        still change before negotiation is done here.
+        """
 
         # Connect signal handlers
         # self.webrtcbin.connect(
@@ -106,6 +240,9 @@ class GSTWebRTCApp:
     
         self.webrtcbin.connect('pad-added', lambda webrtcbin, pad: self.handle_webcam_stream(webrtcbin, pad))
 
+        for prop in ("connection-state", "ice-connection-state", "ice-gathering-state"):
+            self.webrtcbin.connect('notify::' + prop, lambda webrtcbin, pspec: self.__on_state_notify(webrtcbin, pspec))
+
        # self.webrtcbin.connect('on-new-transceiver', lambda webrtcbin, candidate: self.transceiver(webrtcbin, candidate))
 
         # Add STUN server
@@ -119,9 +256,22 @@ class GSTWebRTCApp:
                 logger.info("adding TURN server: %s" % turn_server)
                 self.webrtcbin.emit("add-turn-server", turn_server)
 
-        # Add element to the pipeline.
-        self.pipeline.add(self.webrtcbin)
-    # [END build_webrtcbin_pipeline]
+        self.jitter_tuning.apply_webrtcbin(self.webrtcbin)
+
+        # Keep the jitterbuffers rtpbin creates for the incoming streams.
+        rtpbin = self.webrtcbin.get_by_name("rtpbin")
+        if rtpbin is not None:
+            rtpbin.connect('new-jitterbuffer', lambda rtpbin, jitterbuffer, session, ssrc:
+                           self.__on_new_jitterbuffer(jitterbuffer))
+
+    def __on_new_jitterbuffer(self, jitterbuffer):
+        self.jitter_tuning.apply_jitterbuffer(jitterbuffer)
+        if self.adaptive_latency is not None:
+            jitterbuffer.set_property("latency", self.adaptive_latency.latency)
+        self.jitterbuffers.append(jitterbuffer)
+        # PTS are only assigned by the jitterbuffer, match packets by seqnum.
+        self.latency_tracer.add_span("rtpjitterbuffer", jitterbuffer.get_static_pad("sink"),
+                                     jitterbuffer.get_static_pad("src"), key=rtp_seq_key)
         
 
 
@@ -132,8 +282,9 @@ class GSTWebRTCApp:
             GSTWebRTCAppError -- thrown if any plugins are missing.
         """
 
-        required = ["opus", "nice", "webrtc", "dtls", "srtp", "rtp", "sctp",
-                    "rtpmanager"]
+        required = list(REQUIRED_PLUGINS)
+        if self.receive_branch is not None:
+            required += [p for p in self.receive_branch.required_plugins if p not in required]
 
         # supported = ["nvh264enc", "vp8enc", "vp9enc", "x264enc"]
         # if self.encoder not in supported:
@@ -145,44 +296,32 @@ class GSTWebRTCApp:
         # if self.encoder.startswith("vp"):
         #     required.append("vpx")
         logger.info("required plugins: " + str(required))
-        missing = list(
-            filter(lambda p: Gst.Registry.get().find_plugin(p) is None, required))
+        missing = plugin_cache.missing(required)
         if missing:
             raise GSTWebRTCAppError('Missing gstreamer plugins:', missing)
     
-    def __generate_answer(self, promise):
-        reply = promise.get_reply()
-        answer = reply.get_value("answer")
+    async def __send_answer(self, negotiation):
+        """Waits for the local answer, munges it and sends it to the peer.
 
-        logger.info("Setting local description")
+        Arguments:
+            negotiation {asyncio.Task} -- task returned by WebRTCNegotiation.answer()
+        """
 
-        promise = Gst.Promise.new()
-        self.webrtcbin.emit('set-local-description', answer, promise)
-        promise.interrupt()
+        try:
+            answer = await negotiation
+        except WebRTCNegotiationError as e:
+            logger.error("negotiation failed: %s" % e)
+            return
 
         sdp_text = answer.sdp.as_text()
         logger.info("SDP Answer from server before munged: "+ str(sdp_text))
 
-        if 'rtx-time' not in sdp_text:
-            logger.warning("injecting rtx-time to SDP")
-            sdp_text = re.sub(r'(apt=\d+)', r'\1;rtx-time=125', sdp_text)
-        elif 'rtx-time=125' not in sdp_text:
-            logger.warning("injecting modified rtx-time to SDP")
-            sdp_text = re.sub(r'rtx-time=\d+', r'rtx-time=125', sdp_text)
-        # x264
-        if 'profile-level-id' not in sdp_text:
-            logger.warning("injecting profile-level-id to SDP")
-            sdp_text = sdp_text.replace('packetization-mode=1', 'profile-level-id=42e01f;packetization-mode=1')
-        if 'level-asymmetry-allowed' not in sdp_text:
-            logger.warning("injecting level-asymmetry-allowed to SDP")
-            sdp_text = sdp_text.replace('packetization-mode=1', 'level-asymmetry-allowed=1;packetization-mode=1')
+        sdp_text = self.jitter_tuning.h264_munger().munge(sdp_text)
 
         logger.info("SDP Answer from server after munged: "+ str(sdp_text))
         logger.info("Sending the answer to remote PEER")
-        
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.on_sdp('answer', sdp_text))
 
+        await self.on_sdp('answer', sdp_text)
 
     def set_sdp(self, sdp_type, sdp):
         """Sets remote SDP received by peer.docker run -d --privileged -p 100:8080 -e TURN_HOST='192.168.1.115' -e TURN_PORT='3478' -e TURN_USERNAME='yourusername' -e TURN_PASSWORD='yourpassword' recruitment-offer:latest
@@ -207,14 +346,11 @@ class GSTWebRTCApp:
         _, sdpmsg = GstSdp.SDPMessage.new_from_text(sdp)
         offer = GstWebRTC.WebRTCSessionDescription.new(
             GstWebRTC.WebRTCSDPType.OFFER, sdpmsg)
-        promise = Gst.Promise.new()
-        self.webrtcbin.emit('set-remote-description', offer, promise)
-        promise.interrupt()
 
-        logger.info("Generating anwser for peer")
-        promisee_ans = Gst.Promise.new_with_change_func(
-            self.__generate_answer)
-        self.webrtcbin.emit('create-answer', None, promisee_ans)
+        # set-remote, create-answer and set-local are awaited and timed in order,
+        # the phase durations end up in self.negotiation.timings.
+        self.negotiation = WebRTCNegotiation(self.webrtcbin, self.loop, self.session_id)
+        self.answer_task = self.loop.create_task(self.__send_answer(self.negotiation.answer(offer)))
 
     def set_ice(self, mlineindex, candidate):
         """Adds ice candidate received from signalling server
@@ -254,26 +390,14 @@ class GSTWebRTCApp:
         promise = Gst.Promise.new()
         self.webrtcbin.emit('set-local-description', offer, promise)
         promise.interrupt()
-        loop = asyncio.new_event_loop()
         sdp_text = offer.sdp.as_text()
-        # rtx-time needs to be set to 125 milliseconds for optimal performance
-        if 'rtx-time' not in sdp_text:
-            logger.warning("injecting rtx-time to SDP")
-            sdp_text = re.sub(r'(apt=\d+)', r'\1;rtx-time=125', sdp_text)
-        elif 'rtx-time=125' not in sdp_text:
-            logger.warning("injecting modified rtx-time to SDP")
-            sdp_text = re.sub(r'rtx-time=\d+', r'rtx-time=125', sdp_text)
-        #Firefox needs profile-level-id=42e01f in the offer, but webrtcbin does not add this.
-        #TODO: Remove when fixed in webrtcbin.
-        # https://gitlab.freedesktop.org/gstreamer/gstreamer/-/issues/1106
+        # rtx-time comes from the jitter tuning, 125 milliseconds by default,
+        # Firefox also needs profile-level-id=42e01f in the offer, see sdp_munger.
         if '264' in self.encoder:
-            if 'profile-level-id' not in sdp_text:
-                logger.warning("injecting profile-level-id to SDP")
-                sdp_text = sdp_text.replace('packetization-mode=1', 'profile-level-id=42e01f;packetization-mode=1')
-            if 'level-asymmetry-allowed' not in sdp_text:
-                logger.warning("injecting level-asymmetry-allowed to SDP")
-                sdp_text = sdp_text.replace('packetization-mode=1', 'level-asymmetry-allowed=1;packetization-mode=1')
-        loop.run_until_complete(self.on_sdp('offer', sdp_text))
+            sdp_text = self.jitter_tuning.h264_munger().munge(sdp_text)
+        else:
+            sdp_text = self.jitter_tuning.rtx_munger().munge(sdp_text)
+        self.dispatcher.dispatch(self.on_sdp, 'offer', sdp_text, key=self)
 
     def __on_negotiation_needed(self, webrtcbin):
         """Handles on-negotiation-needed signal, generates create-offer action
@@ -297,8 +421,7 @@ class GSTWebRTCApp:
         """
 
         logger.debug("received ICE candidate: %d %s", mlineindex, candidate)
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.on_ice(mlineindex, candidate))
+        self.dispatcher.dispatch(self.on_ice, mlineindex, candidate, key=self)
     
     def transceiver(self, webrtcbin, candidate):
         logger.info(candidate)
@@ -331,18 +454,9 @@ class GSTWebRTCApp:
            Remember, only after adding the media/tracks to webrtc then the negotiation starts thus generation of SD begins.
            If you remember the logs of webrtcbin(debug) it showed the sdp media was begin gathered from a transceiver.
         """
-        codec_caps = Gst.caps_from_string("application/x-rtp")
-        codec_caps.set_value("media", "video")
-        codec_caps.set_value("encoding-name", "H264")
-        codec_caps.set_value("payload", 106)
-        # codec_caps.set_value("retransmission-name", "RTX")
-        # codec_caps.set_value("payload", 107)
-        codec_caps.set_value("clock-rate", 90000)
-        codec_caps.set_value("profile", "constrained-baseline")
-
         # add the transceivernput:There's a mismatch; the columns could be misaligned with headers
 
-        self.webrtcbin.emit("add-transceiver", GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY, codec_caps)
+        self.webrtcbin.emit("add-transceiver", GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY, video_codec_caps())
 
     def handle_webcam_stream(self, webrtcbin, pad):
         pad_name = pad.get_name()
@@ -350,15 +464,48 @@ class GSTWebRTCApp:
         if "sink" not in pad_name:
             caps = pad.get_current_caps()
             logger.info("webrtcbin src pad caps: " + str(caps))
+            if not self.first_frame_seen:
+                pad.add_probe(Gst.PadProbeType.BUFFER, lambda pad, info: self.__on_first_buffer())
+
+            if self.receive_branch is not None and caps is not None and self.receive_branch.accepts(caps):
+                self.receive_branch.link(self.pipeline, pad, self.element_name)
+                self.trace_branch(pad, self.receive_branch.elements)
+                return
 
-            queue = Gst.ElementFactory.make("queue", "fakequeue")
-            self.fakesink = Gst.ElementFactory.make("fakesink", "fakesinkbroo")
+            queue = Gst.ElementFactory.make("queue", self.element_name("queue_%s" % pad_name))
+            self.fakesink = Gst.ElementFactory.make("fakesink", self.element_name("fakesink_%s" % pad_name))
             self.pipeline.add(self.fakesink)
             self.pipeline.add(queue)
-            if not Gst.Element.link(self.webrtcbin, queue):
+            # Link the pad that was just added rather than the first free
+            # one, so each incoming stream gets its own branch.
+            if pad.link(queue.get_static_pad("sink")) != Gst.PadLinkReturn.OK:
                 raise GSTWebRTCAppError("Failed to link webrtcbin -> queue")
             if not Gst.Element.link(queue, self.fakesink):
                 raise GSTWebRTCAppError("Failed to link queue -> fakesink")
+            queue.sync_state_with_parent()
+            self.fakesink.sync_state_with_parent()
+            self.trace_branch(pad, [queue, self.fakesink])
+
+    def __on_first_buffer(self):
+        # First media out of the webrtcbin, on a streaming thread.
+        if not self.first_frame_seen and self.started_at is not None:
+            self.first_frame_seen = True
+            elapsed = time.monotonic() - self.started_at
+            logger.info("session %s: first frame %.0fms after the session started (%s pipeline)" % (
+                self.session_id, elapsed * 1000, "pre-built" if self.warm else "new"))
+            self.dispatcher.dispatch(startup_stats.record_first_frame, self.warm, elapsed, key=self)
+        return Gst.PadProbeReturn.REMOVE
+
+    def trace_branch(self, pad, elements):
+        """Registers the latency spans of a receive branch linked to a webrtcbin src pad.
+
+        Every element with a sink and a src pad gets a span, and the
+        receive-branch span runs from the webrtcbin pad to the last element.
+        """
+
+        for element in elements:
+            self.latency_tracer.add_element(element)
+        self.latency_tracer.add_span("receive-branch", pad, elements[-1].get_static_pad("sink"))
 
     def start_pipeline(self):
         """Starts the GStreamer pipeline
@@ -366,22 +513,102 @@ class GSTWebRTCApp:
 
         logger.info("starting pipeline")
 
-        self.pipeline = Gst.Pipeline.new()
-
-        # Construct the webrtcbin pipeline with video and audio.
-        self.build_webrtcbin_pipeline()
-        self.build_video_pipeline()
-
-        # Advance the state of the pipeline to PLAYING.
-        res = self.pipeline.set_state(Gst.State.PLAYING)
-        if res.value_name != 'GST_STATE_CHANGE_SUCCESS':
-            raise GSTWebRTCAppError(
-                "Failed to transition pipeline to PLAYING: %s" % res)
+        self.loop = asyncio.get_event_loop()
+        if self.dispatcher is None:
+            self.dispatcher = LoopDispatcher(self.loop)
+        self.state_tracker.reset()
+        self.started_at = time.monotonic()
+        self.first_frame_seen = False
+
+        warm = self.pipeline_pool.acquire() if self.pipeline_pool is not None else None
+        self.warm = warm is not None
+        if warm is not None:
+            # Already PLAYING with its transceiver, only this session's part is left.
+            self.pipeline, self.webrtcbin = warm.pipeline, warm.webrtcbin
+            self.watch_bus()
+            self.configure_webrtcbin()
+        else:
+            self.pipeline = Gst.Pipeline.new(self.element_name("pipeline"))
+            self.watch_bus()
+
+            # Construct the webrtcbin pipeline with video and audio.
+            self.build_webrtcbin_pipeline()
+            self.build_video_pipeline()
+
+            # Advance the state of the pipeline to PLAYING.
+            res = self.pipeline.set_state(Gst.State.PLAYING)
+            if res.value_name != 'GST_STATE_CHANGE_SUCCESS':
+                raise GSTWebRTCAppError(
+                    "Failed to transition pipeline to PLAYING: %s" % res)
         
         transceiver = self.webrtcbin.emit("get-transceiver", 0)
-        transceiver.set_property("do-nack", True)
+        self.jitter_tuning.apply_transceiver(transceiver)
+        self.start_adapting()
+
+        startup_stats.record_start(self.warm, time.monotonic() - self.started_at)
+        logger.info("pipeline started%s" % (" from the pool" if self.warm else ""))
+
+    def tune(self, **settings):
+        """Changes the jitterbuffer and retransmission settings of the session.
+
+        The settings are those of JitterBufferTuning. Latency, drop and
+        retransmission settings apply to the running jitterbuffers right
+        away, rtx_time to the next SDP answer.
+
+        Raises:
+            JitterTuningError -- if a setting is unknown or inconsistent.
+        """
+
+        self.jitter_tuning.update(**settings)
+        if self.webrtcbin is None:
+            return
+        self.jitter_tuning.apply_webrtcbin(self.webrtcbin)
+        self.jitter_tuning.apply_transceiver(self.webrtcbin.emit("get-transceiver", 0))
+        for jitterbuffer in list(self.jitterbuffers):
+            self.jitter_tuning.apply_jitterbuffer(jitterbuffer)
+        self.stop_adapting()
+        self.start_adapting()
+        logger.info("session %s: jitterbuffer settings changed: %s" % (self.session_id, settings))
+
+    def start_adapting(self):
+        if not self.jitter_tuning.adaptive or self.adapt_task is not None:
+            return
+        self.adaptive_latency = self.jitter_tuning.adaptive_latency()
+        self.adapt_task = self.loop.create_task(self.__adapt_latency())
+
+    def stop_adapting(self):
+        """Stops resizing the jitterbuffers and puts the configured latency back.
+        """
 
-        logger.info("pipeline started")
+        if self.adapt_task is not None:
+            self.adapt_task.cancel()
+            self.adapt_task = None
+        if self.adaptive_latency is None:
+            return
+        self.adaptive_latency = None
+        latency = self.jitter_tuning.latency if self.jitter_tuning.latency is not None else DEFAULT_LATENCY
+        if self.webrtcbin is not None:
+            self.webrtcbin.set_property("latency", latency)
+        for jitterbuffer in list(self.jitterbuffers):
+            jitterbuffer.set_property("latency", latency)
+
+    async def __adapt_latency(self):
+        """Resizes the jitterbuffers from their stats, see jitter_tuning.AdaptiveLatency.
+        """
+
+        while True:
+            await asyncio.sleep(self.jitter_tuning.adapt_interval)
+            stats = []
+            for jitterbuffer in list(self.jitterbuffers):
+                s = jitterbuffer.get_property("stats")
+                stats.append({field: s.get_value(field)
+                              for field in ("num-late", "num-lost", "avg-jitter", "rtx-rtt") if s.has_field(field)})
+            latency = self.adaptive_latency.update(stats)
+            if latency is None:
+                continue
+            logger.info("session %s: jitterbuffer latency %dms" % (self.session_id, latency))
+            for jitterbuffer in list(self.jitterbuffers):
+                jitterbuffer.set_property("latency", latency)
 
     def bus_call(self, message):
         t = message.type
@@ -391,6 +618,7 @@ class GSTWebRTCApp:
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             logger.error("Error: %s: %s\n" % (err, debug))
+            self.on_bus_error(err)
             return False
         elif t == Gst.MessageType.STATE_CHANGED:
             if isinstance(message.src, Gst.Pipeline):
@@ -400,6 +628,13 @@ class GSTWebRTCApp:
                 if (old_state.value_nick == "paused" and new_state.value_nick == "ready"):
                     logger.info("stopping bus message loop")
                     return False
+            elif self.fakesink is not None and message.src == self.fakesink:
+                old_state, new_state, pending_state = message.parse_state_changed()
+                logger.info("fakesink state changed from %s to %s, pending: %s" %
+                    (old_state.value_nick, new_state.value_nick, pending_state.value_nick))
+        elif t == Gst.MessageType.ELEMENT:
+            if self.receive_branch is not None:
+                self.receive_branch.handle_message(message)
         elif t == Gst.MessageType.LATENCY:
             if self.pipeline:
                 try:
@@ -409,48 +644,63 @@ class GSTWebRTCApp:
 
         return True
 
-    async def handle_bus_calls(self):
-        # Start bus call loop
-        running = True
-        bus = None
-        while running:
-            if self.pipeline is not None:
-                bus = self.pipeline.get_bus()
-            if bus is not None:
-                while bus.have_pending():
-                    msg = bus.pop()
-                    if not self.bus_call(msg):
-                        running = False
-            await asyncio.sleep(0.1)
-
-    async def check_property(self):
-        while True:
-            if self.pipeline is not None:
-                if self.webrtcbin is not None:
-
-                    curr_ice_state = self.webrtcbin.get_property("ice-connection-state")
-                    if curr_ice_state.value_name != self.ice_connection_state:
-                        logger.info("Ice connection state: " + str(curr_ice_state.value_name))
-                        self.ice_connection_state = curr_ice_state.value_name
-
-                    curr_state = self.webrtcbin.get_property("connection-state")
-                    if curr_state.value_name != self.peer_connection_state:
-                        logger.info("Peer connection state: " + str(curr_state.value_name))
-                        self.peer_connection_state = curr_state.value_name
-                    
-                    if self.fakesink is not None:
-                        state_change_return, fakesink_curr_state, pending_state = self.fakesink.get_state(Gst.CLOCK_TIME_NONE)
-                        if self.fakesink_state != fakesink_curr_state:
-                            logger.info("Current state:" + str(fakesink_curr_state.value_nick))
-                            logger.info("state change return: " + str(state_change_return.value_nick))
-                            logger.info("pending state: " + str(pending_state.value_nick))
-
-                            self.fakesink_state = fakesink_curr_state
-
-            await asyncio.sleep(0.1)
+    def watch_bus(self):
+        """Delivers the pipeline bus messages into the event loop as they are posted.
+
+        The bus poll fd is registered with the asyncio loop, so the loop only
+        wakes up when a message is pending and an idle session costs no
+        wakeups at all.
+        """
+
+        self.bus = self.pipeline.get_bus()
+        self.bus_fd = self.bus.get_pollfd().fd
+        self.loop.add_reader(self.bus_fd, self.__on_bus_readable)
+
+    def unwatch_bus(self):
+        """Stops delivering bus messages.
+        """
+
+        if self.bus_fd is not None:
+            self.loop.remove_reader(self.bus_fd)
+            self.bus_fd = None
+        self.bus = None
+
+    def __on_bus_readable(self):
+        # Drain everything pending, pop() also clears the poll fd.
+        while self.bus is not None:
+            msg = self.bus.pop()
+            if msg is None:
+                break
+            if not self.bus_call(msg):
+                logger.info("stopping bus message watch")
+                self.unwatch_bus()
+
+    def __on_state_notify(self, webrtcbin, pspec):
+        """Handles notify:: signals of the webrtcbin connection state properties.
+
+        Fired from a webrtcbin thread, the value is read here and handed over
+        to the event loop.
+
+        Arguments:
+            webrtcbin {GstWebRTCBin gobject} -- webrtcbin gobject
+            pspec {GParamSpec} -- spec of the changed property
+        """
+
+        # Timestamped here, the loop may be busy with the sends of the session.
+        timestamp = time.monotonic()
+        state = webrtcbin.get_property(pspec.name).value_nick
+        if self.dispatcher is not None:
+            # Own key, a state change doesn't wait for an ICE or SDP send.
+            self.dispatcher.dispatch(self.state_tracker.update, pspec.name, state, timestamp,
+                                     key=(self, "state"))
 
     def stop_pipeline(self):
         logger.info("stopping pipeline")
+        self.unwatch_bus()
+        self.stop_adapting()
+        if self.answer_task is not None:
+            self.answer_task.cancel()
+            self.answer_task = None
         if self.pipeline:
             logger.info("setting pipeline state to NULL")
             self.pipeline.set_state(Gst.State.NULL)
@@ -467,4 +717,10 @@ class GSTWebRTCApp:
             self.fakesink.unparent()
             self.fakesink = None
             logger.info("fakesink set to state NULL")
+        if self.receive_branch is not None:
+            self.receive_branch.release()
+        self.jitterbuffers = []
+        if self.latency_tracer.enabled:
+            logger.info("session %s: receive latency %s" % (self.session_id, self.latency_tracer.summary()))
+        self.latency_tracer.clear_spans()
         logger.info("pipeline stopped")
@@ -0,0 +1,246 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import functools
+import logging
+
+from sdp_munger import SDPMunger, H264_RULES, rtx_time_rules
+
+logger = logging.getLogger("jitter_tuning")
+logger.setLevel(logging.INFO)
+
+"""Jitterbuffer and retransmission settings of a session
+
+JitterBufferTuning holds the receive settings of one GSTWebRTCApp and
+applies them where webrtcbin takes them: the latency on the webrtcbin, NACKs
+on the transceiver, drop-on-latency and the retransmission timers on every
+rtpjitterbuffer rtpbin creates, and rtx-time in the SDP answer. Settings
+left to None keep the webrtcbin defaults.
+
+With adaptive set, AdaptiveLatency sizes the jitterbuffers from their own
+stats every adapt_interval seconds: it grows them right away when packets
+arrive too late to be played and shrinks them slowly, towards a few times
+the observed jitter plus time for a retransmission while there is loss,
+once the stream has been clean for a while.
+
+    Usage example:
+    tuning = JitterBufferTuning(latency=100, drop_on_latency=True, adaptive=True)
+    app = GSTWebRTCApp(jitter_tuning=tuning)
+    app.tune(max_latency=300)
+
+"""
+
+# Settings set on every rtpjitterbuffer, with their property names.
+JITTERBUFFER_PROPERTIES = (
+    ("latency", "latency"),
+    ("drop_on_latency", "drop-on-latency"),
+    ("rtx_delay", "rtx-delay"),
+    ("rtx_max_retries", "rtx-max-retries"),
+    ("rtx_retry_period", "rtx-retry-period"),
+    ("rtx_min_retry_timeout", "rtx-min-retry-timeout"),
+)
+
+
+# Latency of the webrtcbin jitterbuffers when it isn't set, in milliseconds.
+DEFAULT_LATENCY = 200
+
+# Names accepted by JitterBufferTuning.update().
+SETTINGS = ("latency", "drop_on_latency", "do_nack", "rtx_time", "rtx_delay", "rtx_max_retries",
+            "rtx_retry_period", "rtx_min_retry_timeout", "adaptive", "min_latency", "max_latency",
+            "adapt_interval")
+
+
+@functools.lru_cache(maxsize=16)
+def sdp_mungers(rtx_time):
+    """Returns the (rtx, h264) SDPMungers of an rtx-time, shared by the sessions using it.
+    """
+
+    return SDPMunger(rtx_time_rules(rtx_time)), SDPMunger(rtx_time_rules(rtx_time) + H264_RULES)
+
+
+class JitterTuningError(Exception):
+    pass
+
+
+class JitterBufferTuning:
+    def __init__(self, latency=None, drop_on_latency=None, do_nack=True, rtx_time=125,
+                 rtx_delay=None, rtx_max_retries=None, rtx_retry_period=None, rtx_min_retry_timeout=None,
+                 adaptive=False, min_latency=20, max_latency=1000, adapt_interval=2.0, session_id=None):
+        """Initialize the settings of a session.
+
+        Arguments:
+            latency {integer} -- jitterbuffer latency in milliseconds, the starting point in adaptive mode.
+            drop_on_latency {bool} -- drop packets that would exceed the latency instead of waiting.
+            do_nack {bool} -- send NACKs for lost packets.
+            rtx_time {integer} -- rtx-time in milliseconds announced in the SDP answer, None to keep
+                                    the one webrtcbin writes.
+            rtx_delay {integer} -- milliseconds to wait for a missing packet before asking for it,
+                                    -1 for automatic.
+            rtx_max_retries {integer} -- retransmission requests per packet, -1 for automatic.
+            rtx_retry_period {integer} -- milliseconds to keep asking for a packet, -1 for automatic.
+            rtx_min_retry_timeout {integer} -- minimum milliseconds between two requests, -1 for automatic.
+            adaptive {bool} -- size the jitterbuffers from the observed jitter and loss.
+            min_latency {integer} -- lower bound of the adaptive latency in milliseconds.
+            max_latency {integer} -- upper bound of the adaptive latency in milliseconds.
+            adapt_interval {float} -- seconds between two adaptive updates.
+            session_id {string} -- id of the session, used for logging.
+        """
+
+        self.latency = latency
+        self.drop_on_latency = drop_on_latency
+        self.do_nack = do_nack
+        self.rtx_time = rtx_time
+        self.rtx_delay = rtx_delay
+        self.rtx_max_retries = rtx_max_retries
+        self.rtx_retry_period = rtx_retry_period
+        self.rtx_min_retry_timeout = rtx_min_retry_timeout
+        self.adaptive = adaptive
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.adapt_interval = adapt_interval
+        self.session_id = session_id
+        self.check()
+
+    def check(self):
+        if self.min_latency > self.max_latency:
+            raise JitterTuningError("min_latency %d is above max_latency %d" % (self.min_latency, self.max_latency))
+        if self.latency is not None and self.latency < 0:
+            raise JitterTuningError("latency must not be negative")
+
+    def update(self, **settings):
+        """Changes settings, see __init__ for their names.
+
+        Raises:
+            JitterTuningError -- if a setting is unknown or the result is inconsistent.
+        """
+
+        for name in settings:
+            if name not in SETTINGS:
+                raise JitterTuningError("unknown jitterbuffer setting %s" % name)
+        previous = dict(self.__dict__)
+        self.__dict__.update(settings)
+        try:
+            self.check()
+        except JitterTuningError:
+            self.__dict__.update(previous)
+            raise
+
+    def rtx_munger(self):
+        """Returns the SDPMunger setting the rtx-time of this session.
+        """
+
+        return sdp_mungers(self.rtx_time)[0]
+
+    def h264_munger(self):
+        """Returns the SDPMunger setting the rtx-time of this session and the H264 parameters.
+        """
+
+        return sdp_mungers(self.rtx_time)[1]
+
+    def apply_webrtcbin(self, webrtcbin):
+        if self.latency is not None:
+            webrtcbin.set_property("latency", self.latency)
+
+    def apply_transceiver(self, transceiver):
+        transceiver.set_property("do-nack", self.do_nack)
+
+    def apply_jitterbuffer(self, jitterbuffer):
+        """Sets the jitterbuffer settings that aren't None on an rtpjitterbuffer.
+        """
+
+        for name, prop in JITTERBUFFER_PROPERTIES:
+            value = getattr(self, name)
+            if value is not None:
+                jitterbuffer.set_property(prop, value)
+
+    def adaptive_latency(self):
+        return AdaptiveLatency(self.latency if self.latency is not None else DEFAULT_LATENCY,
+                               self.min_latency, self.max_latency)
+
+
+class AdaptiveLatency:
+    def __init__(self, latency, min_latency, max_latency, jitter_factor=4, margin=10,
+                 grow_factor=1.5, shrink_step=0.1, stable_updates=3):
+        """Initialize the controller.
+
+        Arguments:
+            latency {integer} -- current latency in milliseconds.
+            min_latency {integer} -- lower bound in milliseconds.
+            max_latency {integer} -- upper bound in milliseconds.
+            jitter_factor {float} -- multiple of the average jitter the latency has to cover.
+            margin {integer} -- milliseconds added to the target.
+            grow_factor {float} -- latency growth when packets arrive too late.
+            shrink_step {float} -- fraction of the latency given up per update when it can shrink.
+            stable_updates {integer} -- updates without late packets before shrinking.
+        """
+
+        self.latency = max(min_latency, min(max_latency, latency))
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.jitter_factor = jitter_factor
+        self.margin = margin
+        self.grow_factor = grow_factor
+        self.shrink_step = shrink_step
+        self.stable_updates = stable_updates
+        self.stable = 0
+        # Totals of the previous update, the jitterbuffer counters are cumulative.
+        self.late = 0
+        self.lost = 0
+
+    def target(self, avg_jitter, rtx_rtt, lossy):
+        """Returns the latency the current conditions need, in milliseconds.
+
+        Arguments:
+            avg_jitter {float} -- average jitter in milliseconds.
+            rtx_rtt {float} -- round trip time of retransmissions in milliseconds.
+            lossy {bool} -- True if packets were lost since the previous update.
+        """
+
+        target = self.jitter_factor * avg_jitter + self.margin
+        if lossy:
+            # Leave time to get the lost packets retransmitted.
+            target += rtx_rtt
+        return target
+
+    def update(self, stats):
+        """Computes the new latency from the stats of the jitterbuffers of a session.
+
+        Arguments:
+            stats {list of dict} -- "avg-jitter" and "rtx-rtt" in nanoseconds, cumulative
+                                    "num-late" and "num-lost", of each jitterbuffer.
+
+        Returns:
+            integer -- the new latency in milliseconds, None if it doesn't change.
+        """
+
+        if not stats:
+            return None
+        late = sum(s.get("num-late", 0) for s in stats)
+        lost = sum(s.get("num-lost", 0) for s in stats)
+        avg_jitter = max(s.get("avg-jitter", 0) for s in stats) / 1e6
+        rtx_rtt = max(s.get("rtx-rtt", 0) for s in stats) / 1e6
+        new_late = late > self.late
+        lossy = lost > self.lost
+        self.late, self.lost = late, lost
+
+        target = self.target(avg_jitter, rtx_rtt, lossy)
+        latency = self.latency
+        if new_late:
+            # Packets are being thrown away, grow right away.
+            self.stable = 0
+            latency = max(target, latency * self.grow_factor)
+        elif target > latency:
+            self.stable = 0
+            latency = target
+        else:
+            self.stable += 1
+            if self.stable >= self.stable_updates:
+                latency = max(target, latency * (1 - self.shrink_step))
+
+        latency = int(max(self.min_latency, min(self.max_latency, latency)))
+        # Ignore changes too small to matter, each one disturbs the playout.
+        if abs(latency - self.latency) < max(5, self.latency * 0.05):
+            return None
+        self.latency = latency
+        return latency
@@ -0,0 +1,203 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import logging
+import threading
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version("GstRtp", "1.0")
+from gi.repository import Gst
+from gi.repository import GstRtp
+
+from metrics import Histogram, LATENCY_BUCKETS
+
+logger = logging.getLogger("latency_trace")
+logger.setLevel(logging.INFO)
+
+"""Per-element latency of the receive path, measured with pad probes
+
+A span is a pair of pads, such as the sink and src pad of an element. A
+buffer probe on the start pad notes when a buffer arrives, keyed by its PTS
+or RTP sequence number, and a probe on the end pad observes the time since
+then in the histogram of the span when the buffer with the same key leaves.
+Packets of the same frame share a PTS, so a depayloader span measures from
+the first packet of a frame to the frame.
+
+Spans are registered by GSTWebRTCApp as the elements appear, the probes are
+only installed while the tracer is enabled: a session that isn't traced
+pays nothing, and tracing can be switched on and off at any time. Buffers
+dropped inside a span, by videorate or a decode policy, are forgotten after
+max_pending newer ones.
+
+    Usage example:
+    tracer = LatencyTracer(session_id)
+    tracer.add_span("avdec_h264", decoder.get_static_pad("sink"), decoder.get_static_pad("src"))
+    tracer.enable()
+    logger.info(tracer.summary())
+
+"""
+
+
+def pts_key(buf):
+    return buf.pts if buf.pts != Gst.CLOCK_TIME_NONE else None
+
+
+def rtp_seq_key(buf):
+    ok, rtp = GstRtp.RTPBuffer.map(buf, Gst.MapFlags.READ)
+    if not ok:
+        return None
+    try:
+        return rtp.get_seq()
+    finally:
+        rtp.unmap()
+
+
+class LatencySpan:
+    def __init__(self, name, start_pad, end_pad, key, max_pending):
+        self.name = name
+        self.start_pad = start_pad
+        self.end_pad = end_pad
+        self.key = key
+        self.max_pending = max_pending
+        self.probes = []
+        # Format: {key: monotonic arrival time}, oldest first.
+        self.pending = collections.OrderedDict()
+
+
+class LatencyTracer:
+    def __init__(self, session_id=None, buckets=LATENCY_BUCKETS, max_pending=256):
+        """Initialize a disabled tracer.
+
+        Arguments:
+            session_id {string} -- id of the session, used for logging.
+            buckets {tuple of float} -- upper bounds of the histogram buckets in seconds.
+            max_pending {integer} -- buffers remembered per span while they are inside it.
+        """
+
+        self.session_id = session_id
+        self.buckets = buckets
+        self.max_pending = max_pending
+        self.enabled = False
+        self.lock = threading.Lock()
+        # The probes run on the streaming threads, this lock guards the
+        # pending buffers of the spans and the histograms. Never taken
+        # around pad calls, so a probe can't wait on a pad.
+        self.stats_lock = threading.Lock()
+        self.spans = []
+        # Format: {span name: metrics.Histogram}, kept when the pipeline stops.
+        self.histograms = dict()
+
+    def add_span(self, name, start_pad, end_pad, key=pts_key):
+        """Registers a span, its probes are installed right away if the tracer is enabled.
+
+        Arguments:
+            name {string} -- name of the span, spans of the same name share a histogram.
+            start_pad {Gst.Pad} -- pad the buffers enter the span through.
+            end_pad {Gst.Pad} -- pad the buffers leave the span through.
+            key {function} -- returns the key matching a buffer on both pads, None to ignore it.
+        """
+
+        if start_pad is None or end_pad is None:
+            return
+        span = LatencySpan(name, start_pad, end_pad, key, self.max_pending)
+        with self.lock:
+            self.spans.append(span)
+            with self.stats_lock:
+                self.histograms.setdefault(name, Histogram(self.buckets))
+            if self.enabled:
+                self.__install(span)
+
+    def add_element(self, element, name=None):
+        """Registers a span from the sink to the src pad of an element that has both.
+        """
+
+        sink = element.get_static_pad("sink")
+        src = element.get_static_pad("src")
+        if sink is not None and src is not None:
+            self.add_span(name or element.get_factory().get_name(), sink, src)
+
+    def enable(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.enabled = True
+            for span in self.spans:
+                self.__install(span)
+        logger.info("session %s: latency tracing enabled" % self.session_id)
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            for span in self.spans:
+                self.__uninstall(span)
+        logger.info("session %s: latency tracing disabled" % self.session_id)
+
+    def clear_spans(self):
+        """Removes the probes and forgets the spans of a stopped pipeline, the histograms are kept.
+        """
+
+        with self.lock:
+            for span in self.spans:
+                self.__uninstall(span)
+            self.spans = []
+
+    def __install(self, span):
+        span.probes = [
+            (span.start_pad, span.start_pad.add_probe(Gst.PadProbeType.BUFFER,
+                lambda pad, info: self.__on_start(span, info))),
+            (span.end_pad, span.end_pad.add_probe(Gst.PadProbeType.BUFFER,
+                lambda pad, info: self.__on_end(span, info))),
+        ]
+
+    def __uninstall(self, span):
+        for pad, probe_id in span.probes:
+            pad.remove_probe(probe_id)
+        span.probes = []
+        with self.stats_lock:
+            span.pending.clear()
+
+    def __on_start(self, span, info):
+        key = span.key(info.get_buffer())
+        if key is None:
+            return Gst.PadProbeReturn.OK
+        now = time.monotonic()
+        with self.stats_lock:
+            if key not in span.pending:
+                span.pending[key] = now
+                if len(span.pending) > span.max_pending:
+                    span.pending.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def __on_end(self, span, info):
+        key = span.key(info.get_buffer())
+        if key is None:
+            return Gst.PadProbeReturn.OK
+        now = time.monotonic()
+        with self.stats_lock:
+            started = span.pending.pop(key, None)
+            if started is not None:
+                self.histograms[span.name].observe(now - started)
+        return Gst.PadProbeReturn.OK
+
+    def snapshot(self):
+        """Returns {span name: copy of its metrics.Histogram}, consistent while the probes run.
+        """
+
+        with self.stats_lock:
+            return {name: h.copy() for name, h in self.histograms.items()}
+
+    def summary(self):
+        """Returns {span name: {"count", "avg", "p50", "p99"}} with durations in seconds.
+
+        The quantiles are the upper bounds of the buckets they fall in.
+        """
+
+        return {name: {"count": h.count, "avg": h.sum / h.count,
+                       "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                for name, h in self.snapshot().items() if h.count}
@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+
+import websockets
+
+logger = logging.getLogger("local_signalling")
+logger.setLevel(logging.INFO)
+
+"""In-process signalling connections
+
+The media sessions of the server used to reach the signalling server in the
+same process over ws://127.0.0.1, each with its own socket, websocket
+framing and HTTP upgrade. A LocalConnection pair stands in for both ends of
+such a websocket: messages are handed over as they are, strings or bytes,
+through a queue per direction. The server end is handled by
+WebRTCSimpleServer like any websocket, the client end is used by
+WebRTCSignalling in place of the one websockets.connect() returns.
+
+Closing either end closes both: recv() on them raises
+LocalConnectionClosed, a websockets.ConnectionClosed, and iterating over
+them stops, as with a websocket closed cleanly.
+
+    Usage example:
+    client, server_end = local_connection_pair()
+    loop.create_task(server.handle_connection(server_end))
+    await client.send('HELLO 1')
+
+"""
+
+# Address the server logs for local peers.
+LOCAL_ADDRESS = ("local", 0)
+
+
+class LocalConnectionClosed(websockets.ConnectionClosed):
+    def __init__(self, close_code, close_reason):
+        # ConnectionClosed wants the close frames of a real websocket, and
+        # their layout changed across websockets versions.
+        Exception.__init__(self, close_code, close_reason)
+        self.rcvd = self.sent = None
+        self.close_code = close_code
+        self.close_reason = close_reason
+
+    def __str__(self):
+        return "local connection closed: %d %s" % (self.close_code, self.close_reason)
+
+
+class LocalConnection:
+    def __init__(self, inbox, remote_address=LOCAL_ADDRESS):
+        """One end of an in-process connection, see local_connection_pair().
+
+        Arguments:
+            inbox {asyncio.Queue} -- messages sent to this end.
+            remote_address {tuple} -- address reported to the server.
+        """
+
+        self.inbox = inbox
+        self.remote_address = remote_address
+        self.other = None
+        self.close_code = None
+        self.close_reason = ''
+
+    @property
+    def closed(self):
+        return self.close_code is not None
+
+    async def send(self, msg):
+        if self.closed:
+            raise LocalConnectionClosed(self.close_code, self.close_reason)
+        self.other.inbox.put_nowait(msg)
+
+    async def recv(self):
+        if self.closed and self.inbox.empty():
+            raise LocalConnectionClosed(self.close_code, self.close_reason)
+        msg = await self.inbox.get()
+        if msg is None:
+            # Wake up other readers of this end, if any.
+            self.inbox.put_nowait(None)
+            raise LocalConnectionClosed(self.close_code, self.close_reason)
+        return msg
+
+    async def close(self, code=1000, reason=''):
+        for end in (self, self.other):
+            if not end.closed:
+                end.close_code = code
+                end.close_reason = reason
+                # Wakes up recv(), messages queued before are still delivered.
+                end.inbox.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except LocalConnectionClosed:
+            raise StopAsyncIteration
+
+
+def local_connection_pair(remote_address=LOCAL_ADDRESS):
+    """Returns the (client, server) ends of a new in-process connection.
+    """
+
+    client = LocalConnection(asyncio.Queue())
+    server = LocalConnection(asyncio.Queue(), remote_address)
+    client.other = server
+    server.other = client
+    return client, server
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import inspect
+import logging
+import threading
+
+logger = logging.getLogger("loop_bridge")
+logger.setLevel(logging.INFO)
+
+"""Bridge from GStreamer streaming threads to the asyncio event loop
+
+webrtcbin fires its signals and promise callbacks from its own threads. The
+dispatcher queues those callbacks and runs them on the event loop, so
+coroutines such as WebRTCSignalling.send_ice always use the websocket from
+the loop that owns it.
+
+Callbacks dispatched with the same key, such as the ones of one session, run
+in the order they were dispatched: an awaitable one is awaited before the
+next one of its key starts. Callbacks of different keys don't wait for each
+other, a session whose websocket is slow only holds up itself.
+
+A callback counts against maxsize from dispatch until it has run, awaited
+result included, so a stalled websocket fills the queue and the streaming
+threads wait or drop instead of piling up callbacks on the loop.
+
+    Usage example:
+    dispatcher = LoopDispatcher(loop)
+    webrtcbin.connect('on-ice-candidate',
+        lambda w, mlineindex, candidate: dispatcher.dispatch(on_ice, mlineindex, candidate, key=app))
+
+"""
+
+
+class LoopDispatcher:
+    def __init__(self, loop, maxsize=1024, put_timeout=1.0):
+        """Initialize the dispatcher.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop the callbacks are run on.
+            maxsize {integer} -- maximum number of callbacks dispatched and not done yet.
+            put_timeout {float} -- seconds a streaming thread waits for room in a full
+                                    queue before the callback is dropped.
+        """
+
+        self.loop = loop
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        # Callbacks dispatched but not picked up by the loop yet, shared by all threads.
+        self.pending = collections.deque()
+        # Callbacks dispatched and not done yet, guarded by lock.
+        self.size = 0
+        # True while a wakeup of the loop is already on its way.
+        self.scheduled = False
+        self.consumer = None
+        self.loop_thread_id = None
+        self.dropped = 0
+        # Format: {key: deque of (callback, args)} waiting for the awaitable
+        # callback of the key that is running. Only used on the loop.
+        self.waiting = dict()
+
+    def dispatch(self, callback, *args, key=None):
+        """Queues callback(*args) to run on the event loop. Thread safe.
+
+        If the callback returns an awaitable it is awaited before the next
+        callback of the same key runs. When the queue is full a streaming
+        thread waits up to put_timeout for room, the loop thread never waits.
+
+        Returns:
+            bool -- False if the callback was dropped because the queue stayed full.
+        """
+
+        on_loop_thread = threading.get_ident() == self.loop_thread_id
+        with self.lock:
+            if self.size >= self.maxsize and not on_loop_thread:
+                self.not_full.wait_for(lambda: self.size < self.maxsize, self.put_timeout)
+            if self.size >= self.maxsize:
+                self.dropped += 1
+                logger.warning("dispatch queue full, dropping callback %s (%d dropped)" % (callback, self.dropped))
+                return False
+            self.pending.append((callback, args, key))
+            self.size += 1
+            if self.scheduled:
+                return True
+            self.scheduled = True
+        # One wakeup of the loop per batch instead of one per callback.
+        self.loop.call_soon_threadsafe(self.__wakeup)
+        return True
+
+    def __wakeup(self):
+        self.loop_thread_id = threading.get_ident()
+        if self.consumer is None or self.consumer.done():
+            self.consumer = self.loop.create_task(self.__consume())
+
+    async def __consume(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.scheduled = False
+                    return
+                callback, args, key = self.pending.popleft()
+            waiting = self.waiting.get(key)
+            if waiting is not None:
+                # An awaitable callback of the key is still running.
+                waiting.append((callback, args))
+                continue
+            res = self.__call(callback, args)
+            if res is not None:
+                self.waiting[key] = collections.deque()
+                self.loop.create_task(self.__drain(key, callback, res))
+
+    def __call(self, callback, args):
+        """Runs a callback, returns its awaitable result or None if it's done already.
+        """
+
+        try:
+            res = callback(*args)
+            if inspect.isawaitable(res):
+                return res
+        except Exception as e:
+            logger.error("dispatched callback %s failed: %s" % (callback, e))
+        self.__release()
+        return None
+
+    def __release(self):
+        with self.lock:
+            self.size -= 1
+            self.not_full.notify()
+
+    async def __drain(self, key, callback, res):
+        """Awaits res, then runs the callbacks that queued up behind it for key, one at a time.
+        """
+
+        waiting = self.waiting[key]
+        while True:
+            try:
+                await res
+            except Exception as e:
+                logger.error("dispatched callback %s failed: %s" % (callback, e))
+            self.__release()
+            res = None
+            while res is None and waiting:
+                callback, args = waiting.popleft()
+                res = self.__call(callback, args)
+            if res is None:
+                del self.waiting[key]
+                return
@@ -2,16 +2,16 @@ from signalling import WebRTCSimpleServer
 
 import argparse
 import asyncio
-import json
 import logging
 import os
 import sys
 import time
-import urllib.parse
 import traceback
 
-from webrtc_signalling import WebRTCSignalling, WebRTCSignallingErrorNoPeer
-from gstwebrtc import GSTWebRTCApp
+from rtc_config import generate_rtc_config, parse_rtc_config
+from session_manager import SERVER_TURN_USER, WebRTCSessionManager
+from startup import startup_timer, wait_for_file
+from worker_pool import WebRTCWorkerPool
 
 logger = logging.getLogger("main")
 logger.setLevel(logging.INFO)
@@ -50,50 +50,11 @@ def make_turn_rtc_config_json(host, port, username, password, protocol='udp', tl
   "iceTransportPolicy": "all"
 }""" % (host, port, 'turns' if tls else 'turn', host, port, protocol, username, password)
 
-def parse_rtc_config(data):
-    ice_servers = json.loads(data)['iceServers']
-    stun_uris = []
-    turn_uris = []
-    for server in ice_servers:
-        for url in server.get("urls", []):
-            if url.startswith("stun:"):
-                stun_host = url.split(":")[1]
-                stun_port = url.split(":")[2].split("?")[0]
-                stun_uri = "stun://%s:%s" % (
-                    stun_host,
-                    stun_port
-                )
-                stun_uris.append(stun_uri)
-            elif url.startswith("turn:"):
-                turn_host = url.split(':')[1]
-                turn_port = url.split(':')[2].split('?')[0]
-                turn_user = server['username']
-                turn_password = server['credential']
-                turn_uri = "turn://%s:%s@%s:%s" % (
-                    urllib.parse.quote(turn_user, safe=""),
-                    urllib.parse.quote(turn_password, safe=""),
-                    turn_host,
-                    turn_port
-                )
-                turn_uris.append(turn_uri)
-            elif url.startswith("turns:"):
-                turn_host = url.split(':')[1]
-                turn_port = url.split(':')[2].split('?')[0]
-                turn_user = server['username']
-                turn_password = server['credential']
-                turn_uri = "turns://%s:%s@%s:%s" % (
-                    urllib.parse.quote(turn_user, safe=""),
-                    urllib.parse.quote(turn_password, safe=""),
-                    turn_host,
-                    turn_port
-                )
-                turn_uris.append(turn_uri)
-    return stun_uris, turn_uris, data
-
-def wait_for_app_ready(ready_file, app_auto_init = True):
+async def wait_for_app_ready(ready_file, app_auto_init = True):
     """Wait for streaming app ready signal.
 
     returns when either app_auto_init is True OR the file at ready_file exists.
+    The file is watched with inotify, see startup.wait_for_file().
 
     Keyword Arguments:
         app_auto_init {bool} -- skip wait for appready file (default: {True})
@@ -102,10 +63,11 @@ def wait_for_app_ready(ready_file, app_auto_init = True):
     logger.info("Waiting for streaming app ready")
     logging.debug("app_auto_init=%s, ready_file=%s" % (app_auto_init, ready_file))
 
-    while not (app_auto_init or os.path.exists(ready_file)):
-        time.sleep(0.2)
+    if not app_auto_init:
+        await wait_for_file(ready_file, asyncio.get_event_loop())
 
 def main():
+    startup_timer.record("imports", startup_timer.started, time.time())
     parser = argparse.ArgumentParser()
     parser.add_argument('--addr',
                         default=os.environ.get(
@@ -127,10 +89,21 @@ def main():
                         default=os.environ.get(
                             'BASIC_AUTH_PASSWORD', ''),
                         help='Password used when Basic authentication is set.')
+    parser.add_argument('--web_root',
+                        default=os.environ.get('WEB_ROOT', ''),
+                        help='Directory of the web client served by the web server, default: "" to serve no files')
     parser.add_argument('--rtc_config_json',
                         default=os.environ.get(
                             'RTC_CONFIG_JSON', '/tmp/rtc.json'),
                         help='JSON file with RTC config to use as alternative to coturn service, read periodically')
+    parser.add_argument('--turn_shared_secret',
+                        default=os.environ.get(
+                            'TURN_SHARED_SECRET', ''),
+                        help='Shared TURN secret used to generate short-lived HMAC credentials, also requires TURN_HOST and TURN_PORT.')
+    parser.add_argument('--turn_auth_header_name',
+                        default=os.environ.get(
+                            'TURN_AUTH_HEADER_NAME', 'x-auth-user'),
+                        help='Header with the username HMAC TURN credentials are generated for, when Basic authentication is not used.')
     parser.add_argument('--turn_username',
                         default=os.environ.get(
                             'TURN_USERNAME', ''),
@@ -161,6 +134,78 @@ def main():
     parser.add_argument('--app_ready_file',
                         default=os.environ.get('APP_READY_FILE', '/var/run/appconfig/appready'),
                         help='File set by sidecar used to indicate that app is initialized and ready')
+    parser.add_argument('--app_auto_init',
+                        default=os.environ.get('APP_AUTO_INIT', 'true'),
+                        help='Start without waiting for the app_ready_file, default: "true"')
+    parser.add_argument('--max_sessions',
+                        default=os.environ.get('MAX_SESSIONS', '0'),
+                        help='Maximum number of concurrent browser sessions, default: "0" for no limit')
+    parser.add_argument('--workers',
+                        default=os.environ.get('WEBRTC_WORKERS', '0'),
+                        help='Number of worker processes running the media sessions, default: "0" to run them in the signalling process')
+    parser.add_argument('--record_dir',
+                        default=os.environ.get('RECORD_DIR', ''),
+                        help='Directory the incoming H264 video of every session is recorded to as segmented MP4, default: "" to disable recording')
+    parser.add_argument('--record_segment_time',
+                        default=os.environ.get('RECORD_SEGMENT_TIME', '60'),
+                        help='Maximum duration of a recording segment in seconds, default: "60"')
+    parser.add_argument('--record_segment_size',
+                        default=os.environ.get('RECORD_SEGMENT_SIZE', '0'),
+                        help='Maximum size of a recording segment in bytes, default: "0" for no limit')
+    parser.add_argument('--frame_ring',
+                        default=os.environ.get('FRAME_RING', 'false'),
+                        help='Decode the video of every session and publish the frames in a shared memory ring named after the peer id, default: "false"')
+    parser.add_argument('--frame_ring_slots',
+                        default=os.environ.get('FRAME_RING_SLOTS', '4'),
+                        help='Number of frames kept in each shared memory ring, default: "4"')
+    parser.add_argument('--frame_ring_slot_size',
+                        default=os.environ.get('FRAME_RING_SLOT_SIZE', str(1920 * 1080 * 4)),
+                        help='Maximum size of a frame in the shared memory ring in bytes, larger frames are dropped, default: 1920x1080 RGBA')
+    parser.add_argument('--frame_ring_max_fps',
+                        default=os.environ.get('FRAME_RING_MAX_FPS', '0'),
+                        help='Maximum frame rate published in the shared memory ring, default: "0" for no limit')
+    parser.add_argument('--frame_ring_format',
+                        default=os.environ.get('FRAME_RING_FORMAT', 'RGB'),
+                        help='Colorspace of the frames in the shared memory ring, default: "RGB"')
+    parser.add_argument('--decode_policy',
+                        default=os.environ.get('DECODE_POLICY', 'all'),
+                        help='Frames of the shared memory ring that are decoded: "all", "keyframes", "every-nth" or "fps", default: "all"')
+    parser.add_argument('--decode_every_nth',
+                        default=os.environ.get('DECODE_EVERY_NTH', '1'),
+                        help='Deliver one of every N decoded frames with the "every-nth" decode policy, default: "1"')
+    parser.add_argument('--decode_fps',
+                        default=os.environ.get('DECODE_FPS', '1'),
+                        help='Keyframes requested and decoded per second with the "fps" decode policy, default: "1"')
+    parser.add_argument('--decode_keyframe_interval',
+                        default=os.environ.get('DECODE_KEYFRAME_INTERVAL', '0'),
+                        help='Seconds between keyframe requests with the "keyframes" decode policy, default: "0" to rely on the sender')
+    parser.add_argument('--stats_interval',
+                        default=os.environ.get('STATS_INTERVAL', '5'),
+                        help='Seconds between two collections of the RTP stats of a session served on /metrics, default: "5", "0" to disable')
+    parser.add_argument('--latency_sample_rate',
+                        default=os.environ.get('LATENCY_SAMPLE_RATE', '0'),
+                        help='Fraction of the sessions whose per-element receive latency is traced and served on /metrics, default: "0"')
+    parser.add_argument('--jitterbuffer_latency',
+                        default=os.environ.get('JITTERBUFFER_LATENCY', ''),
+                        help='Jitterbuffer latency in milliseconds, default: "" for the webrtcbin default of 200')
+    parser.add_argument('--jitterbuffer_drop_on_latency',
+                        default=os.environ.get('JITTERBUFFER_DROP_ON_LATENCY', 'false'),
+                        help='Drop packets that would exceed the jitterbuffer latency instead of waiting for them, default: "false"')
+    parser.add_argument('--jitterbuffer_adaptive',
+                        default=os.environ.get('JITTERBUFFER_ADAPTIVE', 'false'),
+                        help='Resize the jitterbuffers from the observed jitter and loss, default: "false"')
+    parser.add_argument('--jitterbuffer_min_latency',
+                        default=os.environ.get('JITTERBUFFER_MIN_LATENCY', '20'),
+                        help='Smallest adaptive jitterbuffer latency in milliseconds, default: "20"')
+    parser.add_argument('--jitterbuffer_max_latency',
+                        default=os.environ.get('JITTERBUFFER_MAX_LATENCY', '1000'),
+                        help='Largest adaptive jitterbuffer latency in milliseconds, default: "1000"')
+    parser.add_argument('--rtx_time',
+                        default=os.environ.get('RTX_TIME', '125'),
+                        help='rtx-time in milliseconds announced in the SDP answer, default: "125"')
+    parser.add_argument('--warm_pipelines',
+                        default=os.environ.get('WARM_PIPELINES', '0'),
+                        help='Pipelines kept built and ready for the next sessions, per worker, default: "0" to build them on demand')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug logging')
     args = parser.parse_args()
@@ -173,39 +218,27 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    # Peer id for this app, default is 0, expecting remote peer id to be 1
-    my_id = 0
-    peer_id = 1
-
-    # Initialize the signalling client
-    signalling = WebRTCSignalling('ws://127.0.0.1:%s/ws' % args.port, my_id, peer_id,
-        enable_basic_auth=args.enable_basic_auth.lower() == 'true',
-        basic_auth_user=args.basic_auth_user,
-        basic_auth_password=args.basic_auth_password)
-
-    # Handle errors from the signalling server.
-    async def on_signalling_error(e):
-       if isinstance(e, WebRTCSignallingErrorNoPeer):
-           # Waiting for peer to connect, retry in 2 seconds.
-           time.sleep(2)
-           await signalling.setup_call()
-       else:
-           logger.error("signalling error: %s", str(e))
-           app.stop_pipeline()
-    signalling.on_error = on_signalling_error
-
-    signalling.on_disconnect = lambda: app.stop_pipeline()
-
-    # After connecting, attempt to setup call to peer.
-    signalling.on_connect = signalling.setup_call
-
     # [START main_setup]
     # Fetch the TURN server and credentials
     rtc_config = None
+    stun_servers = None
+    turn_servers = None
+    turn_credentials = None
     turn_protocol = 'tcp' if args.turn_protocol.lower() == 'tcp' else 'udp'
     using_turn_tls = args.turn_tls.lower() == 'true'
 
-    if args.turn_username and args.turn_password:
+    if args.turn_shared_secret:
+        if not (args.turn_host and args.turn_port):
+            logger.error("missing turn host and turn port")
+            sys.exit(1)
+        # Credential of the server side, browsers get their own on /turn/.
+        # The sessions generate theirs from turn_credentials as they start.
+        turn_credentials = dict(turn_host=args.turn_host, turn_port=args.turn_port,
+                                shared_secret=args.turn_shared_secret, protocol=turn_protocol,
+                                turn_tls=using_turn_tls)
+        config_json = generate_rtc_config(args.turn_host, args.turn_port, args.turn_shared_secret, SERVER_TURN_USER, turn_protocol, using_turn_tls)
+        stun_servers, turn_servers, rtc_config = parse_rtc_config(config_json)
+    elif args.turn_username and args.turn_password:
         if not (args.turn_host and args.turn_port):
             logger.error("missing turn host and turn port")
             sys.exit(1)
@@ -215,26 +248,53 @@ def main():
 
     logger.info("initial server RTC config: {}".format(rtc_config))
 
-     # Create instance of app
-    app = GSTWebRTCApp(stun_servers, turn_servers, args.encoder)
+    # Create the session manager, every browser peer that registers gets
+    # its own signalling client and GSTWebRTCApp.
+    manager_args = ('ws://127.0.0.1:%s/ws' % args.port, stun_servers, turn_servers, args.encoder)
+    manager_kwargs = dict(
+        max_sessions=int(args.max_sessions),
+        enable_basic_auth=args.enable_basic_auth.lower() == 'true',
+        basic_auth_user=args.basic_auth_user,
+        basic_auth_password=args.basic_auth_password,
+        stats_interval=float(args.stats_interval),
+        latency_sample_rate=float(args.latency_sample_rate),
+        jitter_tuning=dict(
+            latency=int(args.jitterbuffer_latency) if args.jitterbuffer_latency else None,
+            drop_on_latency=args.jitterbuffer_drop_on_latency.lower() == 'true',
+            adaptive=args.jitterbuffer_adaptive.lower() == 'true',
+            min_latency=int(args.jitterbuffer_min_latency),
+            max_latency=int(args.jitterbuffer_max_latency),
+            rtx_time=int(args.rtx_time)),
+        warm_pipelines=int(args.warm_pipelines),
+        turn_credentials=turn_credentials)
+    if args.record_dir:
+        manager_kwargs['recording'] = dict(
+            directory=args.record_dir,
+            segment_time=int(args.record_segment_time),
+            segment_size=int(args.record_segment_size))
+    if args.frame_ring.lower() == 'true':
+        manager_kwargs['frames'] = dict(
+            max_fps=int(args.frame_ring_max_fps),
+            video_format=args.frame_ring_format)
+        manager_kwargs['frame_ring'] = dict(
+            slots=int(args.frame_ring_slots),
+            slot_size=int(args.frame_ring_slot_size))
+        manager_kwargs['decode_policy'] = dict(
+            mode=args.decode_policy,
+            every_nth=int(args.decode_every_nth),
+            fps=float(args.decode_fps),
+            keyframe_interval=float(args.decode_keyframe_interval))
+
+    num_workers = int(args.workers)
+    if num_workers > 0:
+        # Supervisor mode, the sessions run in worker processes.
+        manager = WebRTCWorkerPool(num_workers, manager_args, manager_kwargs,
+            log_level=logging.DEBUG if args.debug else logging.INFO)
+    else:
+        manager = WebRTCSessionManager(*manager_args, **manager_kwargs)
 
     # [END main_setup]
 
-    # Send the local sdp to signalling when offer is generated.
-    app.on_sdp = signalling.send_sdp
-
-    # Send ICE candidates to the signalling server.
-    app.on_ice = signalling.send_ice
-
-    # Set the remote SDP when received from signalling server.
-    signalling.on_sdp = app.set_sdp
-
-    # Set ICE candidates received from signalling server.
-    signalling.on_ice = app.set_ice
-
-    # Start the pipeline once the session is established.
-    signalling.on_session = app.start_pipeline
-
     # [START main_start]
     # Connect to the signalling server and process messages.
     loop = asyncio.get_event_loop()
@@ -247,8 +307,13 @@ def main():
     options.basic_auth_user = args.basic_auth_user
     options.basic_auth_password = args.basic_auth_password
     options.disable_ssl = True
+    options.reuse_port = False
     options.health = "/health"
+    options.metrics = "/metrics"
+    options.web_root = args.web_root
     options.keepalive_timeout = 30
+    options.relay_log_interval = 1000
+    options.outbox_size = 256
     options.cert_path = None
     options.cert_restart = False
     options.rtc_config_file = args.rtc_config_json
@@ -257,27 +322,53 @@ def main():
     options.turn_port = args.turn_port
     options.turn_protocol = turn_protocol
     options.turn_tls = using_turn_tls
+    options.turn_shared_secret = args.turn_shared_secret
+    options.turn_auth_header_name = args.turn_auth_header_name
     server = WebRTCSimpleServer(loop, options)
 
+    # Serve the RTC config file when it changes, new in-process sessions
+    # also use its STUN and TURN servers.
+    def on_rtc_config_change(data):
+        server.set_rtc_config(data)
+        if not isinstance(manager, WebRTCSessionManager):
+            logger.info("RTC config changed, running workers keep their STUN and TURN servers")
+            return
+        try:
+            manager.stun_servers, manager.turn_servers, _ = parse_rtc_config(data)
+            manager.turn_credentials = None
+        except (KeyError, IndexError, ValueError) as e:
+            logger.warning("failed to parse RTC config for the server: %s" % e)
+    if server.rtc_config_file is not None:
+        server.rtc_config_file.on_change = on_rtc_config_change
+
+    # Attach a media session to every browser peer that registers.
+    server.on_peer_registered = manager.on_peer_registered
+    server.on_peer_removed = manager.on_peer_removed
+    server.metrics_collectors.append(manager.metrics)
+    # In-process sessions skip the loopback websocket, workers can't.
+    if isinstance(manager, WebRTCSessionManager):
+        manager.local_server = server
+
+    exit_code = 0
     try:
-        server.run()
-
-        while True:
-            asyncio.ensure_future(app.handle_bus_calls(), loop=loop)
-
-            asyncio.ensure_future(app.check_property(), loop=loop)
-            
-            loop.run_until_complete(signalling.connect())
-            loop.run_until_complete(signalling.start())
-            
-            app.stop_pipeline()
+        # GStreamer is initialized and the pool filled meanwhile.
+        manager.start(loop)
+        with startup_timer.phase("app_ready"):
+            loop.run_until_complete(wait_for_app_ready(args.app_ready_file, args.app_auto_init.lower() == 'true'))
+        with startup_timer.phase("signalling"):
+            server.run()
+        startup_timer.ready()
+        loop.run_forever()
+        if manager.init_error is not None:
+            raise manager.init_error
     except Exception as e:
         logger.error("Caught exception: %s" % e)
         traceback.print_exc()
-        sys.exit(1)
+        exit_code = 1
     finally:
+        loop.run_until_complete(manager.stop())
         server.server.close()
-        sys.exit(0)
+        sys.exit(exit_code)
     # [END main_start]
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import bisect
+import logging
+import math
+
+logger = logging.getLogger("metrics")
+logger.setLevel(logging.INFO)
+
+"""Metrics in the Prometheus text exposition format
+
+Collectors return lists of MetricFamily, the families of all collectors are
+merged by name and rendered on the metrics path of the signalling server.
+Families are plain objects, so worker processes can send theirs to the
+supervisor over a pipe.
+
+    Usage example:
+    family = MetricFamily("webrtc_sessions", "gauge", "Active media sessions.")
+    family.add(len(sessions))
+    body = render_metrics([family])
+
+"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Upper bounds in seconds, from half a millisecond to two seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+class MetricFamily:
+    __slots__ = ("name", "type", "help", "samples")
+
+    def __init__(self, name, metric_type, help_text):
+        """Initialize a metric family.
+
+        Arguments:
+            name {string} -- metric name, such as webrtc_rtp_packets_received_total.
+            metric_type {string} -- COUNTER or GAUGE.
+            help_text {string} -- description of the metric.
+        """
+
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        # Format: [(labels dict or None, value)]
+        self.samples = []
+
+    def add(self, value, labels=None):
+        self.samples.append((labels, value))
+        return self
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialize an empty histogram, the value of the samples of a HISTOGRAM family.
+
+        Arguments:
+            buckets {tuple of float} -- sorted upper bounds of the buckets, +Inf is implied.
+        """
+
+        self.buckets = buckets
+        # Observations per bucket, the last one is +Inf. Not cumulative.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding quantile q, None if empty.
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels.items())
+
+
+def render_histogram(name, labels, histogram):
+    labels = labels or {}
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+        cumulative += count
+        lines.append("%s_bucket{%s} %d" % (name, format_labels(dict(labels, le=format_value(float(bound)))), cumulative))
+    suffix = "{%s}" % format_labels(labels) if labels else ""
+    lines.append("%s_sum%s %s" % (name, suffix, format_value(histogram.sum)))
+    lines.append("%s_count%s %d" % (name, suffix, histogram.count))
+    return lines
+
+
+def render_metrics(families):
+    """Renders metric families in the text exposition format.
+
+    Families with the same name, such as the ones of several workers, are
+    merged, the first one gives the type and help text.
+
+    Arguments:
+        families {iterable of MetricFamily} -- families to render.
+
+    Returns:
+        bytes -- the exposition, UTF-8 encoded.
+    """
+
+    merged = dict()
+    for family in families:
+        first = merged.get(family.name)
+        if first is None:
+            merged[family.name] = MetricFamily(family.name, family.type, family.help)
+            first = merged[family.name]
+        first.samples.extend(family.samples)
+
+    lines = []
+    for family in merged.values():
+        lines.append("# HELP %s %s" % (family.name, family.help.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE %s %s" % (family.name, family.type))
+        for labels, value in family.samples:
+            if family.type == HISTOGRAM:
+                lines.extend(render_histogram(family.name, labels, value))
+            elif labels:
+                lines.append("%s{%s} %s" % (family.name, format_labels(labels), format_value(value)))
+            else:
+                lines.append("%s %s" % (family.name, format_value(value)))
+    lines.append("")
+    return "\n".join(lines).encode()
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+logger = logging.getLogger("negotiation")
+logger.setLevel(logging.INFO)
+
+"""Awaitable offer/answer negotiation on top of Gst.Promise
+
+Every webrtcbin action is emitted with a promise whose reply is handed to
+the event loop as a future, and the duration of each phase is recorded.
+
+    Usage example:
+    negotiation = WebRTCNegotiation(webrtcbin, loop, session_id)
+    answer = await negotiation.answer(offer)
+    logger.info(negotiation.timings)
+
+"""
+
+PHASE_SET_REMOTE = "set-remote"
+PHASE_CREATE_ANSWER = "create-answer"
+PHASE_SET_LOCAL = "set-local"
+PHASE_TOTAL = "total"
+
+
+class WebRTCNegotiationError(Exception):
+    pass
+
+
+class NegotiationStats:
+    def __init__(self):
+        """Aggregated negotiation phase durations of all sessions in this process.
+        """
+
+        # Format: {phase: [count, total_seconds, max_seconds]}
+        self.phases = dict()
+
+    def record(self, phase, seconds):
+        stats = self.phases.setdefault(phase, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def summary(self):
+        """Returns {phase: {"count", "avg", "max"}} with durations in seconds.
+        """
+
+        return {phase: {"count": count, "avg": total / count, "max": max_seconds}
+                for phase, (count, total, max_seconds) in self.phases.items()}
+
+
+negotiation_stats = NegotiationStats()
+
+
+class WebRTCNegotiation:
+    def __init__(self, webrtcbin, loop, session_id=None, stats=negotiation_stats):
+        """Initialize a negotiation of a webrtcbin.
+
+        Arguments:
+            webrtcbin {GstWebRTCBin gobject} -- webrtcbin to negotiate.
+            loop {asyncio.AbstractEventLoop} -- loop the promise replies are delivered to.
+            session_id {string} -- id of the session, used for logging.
+            stats {NegotiationStats} -- aggregate the phase durations are added to.
+        """
+
+        self.webrtcbin = webrtcbin
+        self.loop = loop
+        self.session_id = session_id
+        self.stats = stats
+        # Format: {phase: seconds}
+        self.timings = dict()
+
+    def emit(self, phase, signal, *args):
+        """Emits a webrtcbin action signal with a promise as last argument.
+
+        Arguments:
+            phase {string} -- name the duration is recorded under.
+            signal {string} -- name of the action signal.
+
+        Returns:
+            asyncio.Future -- resolved with the promise reply structure.
+        """
+
+        future = self.loop.create_future()
+        started = time.monotonic()
+
+        def on_reply(promise):
+            # May run on a webrtcbin thread, only hand the result over.
+            elapsed = time.monotonic() - started
+            result = promise.wait()
+            reply = promise.get_reply()
+            self.loop.call_soon_threadsafe(self.__resolve, future, phase, elapsed, result, reply)
+
+        promise = Gst.Promise.new_with_change_func(on_reply)
+        self.webrtcbin.emit(signal, *args, promise)
+        return future
+
+    def __resolve(self, future, phase, elapsed, result, reply):
+        if future.done():
+            return
+        self.timings[phase] = elapsed
+        self.stats.record(phase, elapsed)
+        if result != Gst.PromiseResult.REPLIED:
+            future.set_exception(WebRTCNegotiationError("%s did not complete: %s" % (phase, result.value_nick)))
+        elif reply is not None and reply.has_field("error"):
+            future.set_exception(WebRTCNegotiationError("%s failed: %s" % (phase, reply.get_value("error"))))
+        else:
+            future.set_result(reply)
+
+    def answer(self, offer):
+        """Answers a remote offer: set-remote, create-answer and set-local.
+
+        set-remote-description is emitted before returning, so ICE candidates
+        added afterwards are always applied after the offer.
+
+        Arguments:
+            offer {GstWebRTC.WebRTCSessionDescription} -- the remote offer.
+
+        Returns:
+            asyncio.Task -- resolves to the local answer, a GstWebRTC.WebRTCSessionDescription.
+        """
+
+        started = time.monotonic()
+        remote_set = self.emit(PHASE_SET_REMOTE, 'set-remote-description', offer)
+        return self.loop.create_task(self.__complete_answer(started, remote_set))
+
+    async def __complete_answer(self, started, remote_set):
+        await remote_set
+
+        reply = await self.emit(PHASE_CREATE_ANSWER, 'create-answer', None)
+        answer = reply.get_value("answer")
+
+        await self.emit(PHASE_SET_LOCAL, 'set-local-description', answer)
+
+        elapsed = time.monotonic() - started
+        self.timings[PHASE_TOTAL] = elapsed
+        self.stats.record(PHASE_TOTAL, elapsed)
+        logger.info("session %s: negotiation took %s" % (self.session_id, ", ".join(
+            "%s %.1fms" % (phase, seconds * 1000) for phase, seconds in self.timings.items())))
+        return answer
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+
+import websockets
+
+logger = logging.getLogger("peer_outbox")
+logger.setLevel(logging.INFO)
+
+"""Bounded outbound queue of a signalling peer
+
+Broadcasts post into the outbox of every recipient without awaiting, each
+outbox has its own writer task, so all recipients are written to in
+parallel and a slow one only delays itself. A peer that lets its outbox
+overflow is disconnected.
+
+    Usage example:
+    outbox = PeerOutbox(ws, uid)
+    outbox.post('ROOM_PEER_JOINED 2')
+
+"""
+
+# Close code sent to peers that don't keep up: 1013 Try Again Later
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class PeerOutbox:
+    def __init__(self, ws, uid, maxsize=256):
+        """Initialize the outbox and start its writer task.
+
+        Arguments:
+            ws {WebSocketServerProtocol} -- websocket of the peer.
+            uid {string} -- ID of the peer, used for logging.
+            maxsize {integer} -- messages queued before the peer is disconnected.
+        """
+
+        self.ws = ws
+        self.uid = uid
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+        self.writer = asyncio.ensure_future(self.write_loop())
+
+    def post(self, msg):
+        """Queues msg for the peer without waiting.
+
+        Returns:
+            bool -- False if the outbox is closed or overflowed.
+        """
+
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            logger.warning("outbox of peer {!r} overflowed, disconnecting slow consumer".format(self.uid))
+            self.close()
+            asyncio.ensure_future(self.ws.close(code=SLOW_CONSUMER_CLOSE_CODE, reason='slow consumer'))
+            return False
+        return True
+
+    async def write_loop(self):
+        try:
+            while True:
+                msg = await self.queue.get()
+                await self.ws.send(msg)
+        except websockets.ConnectionClosed:
+            self.closed = True
+
+    def close(self):
+        """Stops the writer, queued messages are dropped.
+        """
+
+        self.closed = True
+        self.writer.cancel()
@@ -0,0 +1,320 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import abc
+import asyncio
+import base64
+import itertools
+import json
+import logging
+
+logger = logging.getLogger("peer_registry")
+logger.setLevel(logging.INFO)
+
+"""Peer registry and message bus shared by signalling workers
+
+Every WebRTCSimpleServer owns a registry client. The registry knows which
+worker a peer uid is connected to and carries the messages a worker sends to
+peers connected elsewhere. Messages are dicts with an "op" key, they are
+handed to WebRTCSimpleServer.handle_bus_message() of the owning worker:
+
+    {"op": "relay", "to": uid, "msg": frame}     -- relay a frame to a peer
+    {"op": "session", "to": uid, "peer": uid}    -- a remote peer started a session with a peer
+    {"op": "close", "to": uid}                   -- the session partner left, close the peer
+    {"op": "present", "to": uid, "peer": uid}    -- a peer watched by uid registered, see watch()
+
+Backends:
+    InMemoryPeerRegistry -- workers in the same process, the default.
+    UnixSocketPeerRegistry -- workers in separate processes, connected to a
+                              PeerRegistryHub listening on a unix socket.
+
+"""
+
+
+class PeerRegistryError(Exception):
+    pass
+
+
+class PeerRegistry(abc.ABC):
+    """Interface of the registry backends, one instance per signalling worker.
+    """
+
+    @abc.abstractmethod
+    async def attach(self, server):
+        """Connects the registry, bus messages are delivered to server.handle_bus_message().
+        """
+
+    @abc.abstractmethod
+    async def register(self, uid):
+        """Claims uid for this worker, returns False if it's already registered anywhere.
+        """
+
+    @abc.abstractmethod
+    async def unregister(self, uid):
+        """Releases uid, and the watches uid made.
+        """
+
+    @abc.abstractmethod
+    async def lookup(self, uid):
+        """Returns True if uid is registered on any worker.
+        """
+
+    @abc.abstractmethod
+    async def send(self, msg):
+        """Sends a bus message to the worker owning msg["to"], dropped if there is none.
+        """
+
+    @abc.abstractmethod
+    async def watch(self, uid, watcher):
+        """Returns True if uid is announced, or else sends watcher a present
+        message once it is. Watches end with the notification or when the
+        watcher unregisters.
+        """
+
+    @abc.abstractmethod
+    async def announce(self, uid):
+        """Notifies the watchers of uid that it can take sessions now.
+        """
+
+
+class RemoteRoute:
+    def __init__(self, registry, uid):
+        """Relay route to a peer connected to another worker.
+
+        Used in place of the peer's websocket in WebRTCSimpleServer.routes.
+
+        Arguments:
+            registry {PeerRegistry} -- registry carrying the frames.
+            uid {string} -- ID of the remote peer.
+        """
+
+        self.registry = registry
+        self.uid = uid
+
+    async def send(self, msg):
+        await self.registry.send({"op": "relay", "to": self.uid, "msg": msg})
+
+
+class InMemoryRegistryHub:
+    def __init__(self):
+        """Registry state shared by the InMemoryPeerRegistry of every worker in the process.
+        """
+
+        # Format: {uid: WebRTCSimpleServer}
+        self.owners = dict()
+        # Format: {watched uid: set of watcher uids}
+        self.watchers = dict()
+        # Announced uids, registered uids are announced once they can take sessions.
+        self.announced = set()
+
+
+def forget_watcher(watchers, watcher):
+    """Removes the watches of a watcher from a {watched uid: set of watcher uids} dict.
+    """
+
+    for uid in [uid for uid, uids in watchers.items() if watcher in uids]:
+        watchers[uid].discard(watcher)
+        if not watchers[uid]:
+            del watchers[uid]
+
+
+class InMemoryPeerRegistry(PeerRegistry):
+    def __init__(self, hub=None):
+        """Initialize the in-memory registry.
+
+        Arguments:
+            hub {InMemoryRegistryHub} -- state shared with other workers, a private one by default.
+        """
+
+        self.hub = hub or InMemoryRegistryHub()
+        self.server = None
+
+    async def attach(self, server):
+        self.server = server
+
+    async def register(self, uid):
+        if uid in self.hub.owners:
+            return False
+        self.hub.owners[uid] = self.server
+        return True
+
+    async def unregister(self, uid):
+        if self.hub.owners.get(uid) is self.server:
+            del self.hub.owners[uid]
+            self.hub.announced.discard(uid)
+            forget_watcher(self.hub.watchers, uid)
+
+    async def lookup(self, uid):
+        return uid in self.hub.owners
+
+    async def watch(self, uid, watcher):
+        if uid in self.hub.announced:
+            return True
+        self.hub.watchers.setdefault(uid, set()).add(watcher)
+        return False
+
+    async def announce(self, uid):
+        self.hub.announced.add(uid)
+        for watcher in self.hub.watchers.pop(uid, ()):
+            # A watcher that went away must not keep the others from hearing about uid.
+            try:
+                await self.send({"op": "present", "to": watcher, "peer": uid})
+            except Exception as e:
+                logger.warning("failed to announce %s to %s: %s" % (uid, watcher, e))
+
+    async def send(self, msg):
+        server = self.hub.owners.get(msg["to"])
+        if server is not None:
+            await server.handle_bus_message(msg)
+
+
+def encode_line(msg):
+    if isinstance(msg.get("msg"), bytes):
+        msg = dict(msg, msg=base64.b64encode(msg["msg"]).decode("ascii"), binary=True)
+    return json.dumps(msg).encode() + b"\n"
+
+
+def decode_line(line):
+    msg = json.loads(line)
+    if msg.pop("binary", False):
+        msg["msg"] = base64.b64decode(msg["msg"])
+    return msg
+
+
+class PeerRegistryHub:
+    def __init__(self, path):
+        """Registry and bus server the UnixSocketPeerRegistry of each worker connects to.
+
+        Arguments:
+            path {string} -- path of the unix socket to listen on.
+        """
+
+        self.path = path
+        self.server = None
+        # Format: {uid: StreamWriter of the owning worker}
+        self.owners = dict()
+        # Format: {watched uid: set of watcher uids}
+        self.watchers = dict()
+        self.announced = set()
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle_worker, path=self.path)
+        logger.info("peer registry hub listening on %s" % self.path)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_worker(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                op = msg["op"]
+                if op == "register":
+                    ok = msg["uid"] not in self.owners
+                    if ok:
+                        self.owners[msg["uid"]] = writer
+                    writer.write(encode_line({"op": "reply", "id": msg["id"], "result": ok}))
+                elif op == "unregister":
+                    if self.owners.get(msg["uid"]) is writer:
+                        del self.owners[msg["uid"]]
+                        self.announced.discard(msg["uid"])
+                        forget_watcher(self.watchers, msg["uid"])
+                elif op == "lookup":
+                    writer.write(encode_line({"op": "reply", "id": msg["id"], "result": msg["uid"] in self.owners}))
+                elif op == "watch":
+                    present = msg["uid"] in self.announced
+                    if not present:
+                        self.watchers.setdefault(msg["uid"], set()).add(msg["watcher"])
+                    writer.write(encode_line({"op": "reply", "id": msg["id"], "result": present}))
+                elif op == "announce":
+                    self.announced.add(msg["uid"])
+                    for watcher in self.watchers.pop(msg["uid"], ()):
+                        owner = self.owners.get(watcher)
+                        if owner is not None:
+                            owner.write(encode_line({"op": "present", "to": watcher, "peer": msg["uid"]}))
+                else:
+                    # Bus message, forwarded as it is to the owning worker.
+                    owner = self.owners.get(msg["to"])
+                    if owner is not None:
+                        owner.write(line)
+        finally:
+            # The worker is gone, and with it all of its peers.
+            for uid in [uid for uid, owner in self.owners.items() if owner is writer]:
+                del self.owners[uid]
+                self.announced.discard(uid)
+                forget_watcher(self.watchers, uid)
+            writer.close()
+
+
+class UnixSocketPeerRegistry(PeerRegistry):
+    def __init__(self, path):
+        """Initialize the registry client.
+
+        Arguments:
+            path {string} -- path of the unix socket of the PeerRegistryHub.
+        """
+
+        self.path = path
+        self.server = None
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.request_ids = itertools.count()
+        # Format: {request_id: Future}
+        self.pending = dict()
+
+    async def attach(self, server):
+        self.server = server
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                logger.error("lost connection to peer registry hub at %s" % self.path)
+                for future in self.pending.values():
+                    future.set_exception(PeerRegistryError("registry hub connection lost"))
+                self.pending.clear()
+                return
+            msg = decode_line(line)
+            if msg["op"] == "reply":
+                future = self.pending.pop(msg["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(msg["result"])
+            else:
+                try:
+                    await self.server.handle_bus_message(msg)
+                except Exception as e:
+                    logger.error("failed to handle bus message %s: %s" % (msg["op"], e))
+
+    async def request(self, op, uid, **fields):
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_line(dict(fields, op=op, id=request_id, uid=uid)))
+        return await future
+
+    async def register(self, uid):
+        return await self.request("register", uid)
+
+    async def unregister(self, uid):
+        self.writer.write(encode_line({"op": "unregister", "uid": uid}))
+
+    async def lookup(self, uid):
+        return await self.request("lookup", uid)
+
+    async def watch(self, uid, watcher):
+        return await self.request("watch", uid, watcher=watcher)
+
+    async def announce(self, uid):
+        self.writer.write(encode_line({"op": "announce", "uid": uid}))
+
+    async def send(self, msg):
+        self.writer.write(encode_line(msg))
+        await self.writer.drain()
@@ -0,0 +1,249 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+
+logger = logging.getLogger("peer_table")
+logger.setLevel(logging.INFO)
+
+"""Peers, sessions and rooms of a signalling server
+
+Records use __slots__ to keep the per-connection footprint small, and the
+table keeps them indexed by status and by room so lookups don't scan the
+peers. Every status change goes through the table to keep the indexes
+consistent.
+
+    Usage example:
+    table = PeerTable()
+    peer = table.add(uid, ws, ws.remote_address)
+    room = table.join_room(uid, 'lobby')
+    ws.send('ROOM_PEER_LIST {}'.format(room.peer_list(exclude=uid)))
+
+"""
+
+STATUS_IDLE = 'idle'
+STATUS_SESSION = 'session'
+STATUS_ROOM = 'room'
+
+
+class Peer:
+    __slots__ = ('uid', 'ws', 'raddr', 'status', 'room', 'route', 'outbox')
+
+    def __init__(self, uid, ws, raddr):
+        """A connected peer.
+
+        Arguments:
+            uid {string} -- ID of the peer.
+            ws {WebSocketServerProtocol} -- websocket of the peer.
+            raddr {tuple} -- remote address of the peer.
+        """
+
+        self.uid = uid
+        self.ws = ws
+        self.raddr = raddr
+        self.status = STATUS_IDLE
+        # Room the peer is in, when status is STATUS_ROOM.
+        self.room = None
+        # Where frames are relayed to when status is STATUS_SESSION: the
+        # websocket of the other peer, or a RemoteRoute.
+        self.route = None
+        # PeerOutbox, created on the first room message sent to the peer.
+        self.outbox = None
+
+
+class Session:
+    __slots__ = ('caller_id', 'callee_id')
+
+    def __init__(self, caller_id, callee_id):
+        self.caller_id = caller_id
+        self.callee_id = callee_id
+
+    def other(self, uid):
+        """Returns the ID of the other peer of the session.
+        """
+
+        return self.callee_id if uid == self.caller_id else self.caller_id
+
+
+class Room:
+    __slots__ = ('room_id', 'members', 'members_text')
+
+    def __init__(self, room_id):
+        """A room with its members in joining order.
+
+        The space separated member list sent in ROOM_OK and ROOM_PEER_LIST is
+        kept up to date as peers join, and rebuilt once after a peer leaves.
+        """
+
+        self.room_id = room_id
+        # Format: {uid: None}, a dict to keep the joining order.
+        self.members = dict()
+        self.members_text = ''
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, uid):
+        return uid in self.members
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def add(self, uid):
+        self.members[uid] = None
+        if self.members_text is not None:
+            self.members_text = self.members_text + ' ' + uid if self.members_text else uid
+
+    def remove(self, uid):
+        del self.members[uid]
+        self.members_text = None
+
+    def peer_list(self, exclude=None):
+        """Returns the space separated IDs of the members.
+
+        Arguments:
+            exclude {string} -- optional member left out of the list.
+        """
+
+        if self.members_text is None:
+            self.members_text = ' '.join(self.members)
+        if exclude is None or exclude not in self.members:
+            return self.members_text
+        # IDs contain no whitespace, so ' uid ' only matches that member.
+        text = ' ' + self.members_text + ' '
+        i = text.index(' ' + exclude + ' ')
+        return (text[:i] + text[i + len(exclude) + 1:]).strip()
+
+
+class PeerTable:
+    def __init__(self):
+        """Initialize an empty table.
+        """
+
+        # Format: {uid: Peer}
+        self.peers = dict()
+        # Format: {uid: Session}
+        # Both local peers of a session map to the same record, a session
+        # with a peer of another worker only has the local peer.
+        self.sessions = dict()
+        # Format: {room_id: Room}
+        # Rooms are removed when their last member leaves.
+        self.rooms = dict()
+        # Format: {status: {uid, ...}}
+        self.by_status = {STATUS_IDLE: set(), STATUS_SESSION: set(), STATUS_ROOM: set()}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, uid):
+        return uid in self.peers
+
+    def __getitem__(self, uid):
+        return self.peers[uid]
+
+    def get(self, uid):
+        return self.peers.get(uid)
+
+    def partner(self, uid):
+        """Returns the ID of the peer uid is in a session with, or None.
+        """
+
+        session = self.sessions.get(uid)
+        return session.other(uid) if session is not None else None
+
+    def count(self, status):
+        """Returns the number of peers with a status, in O(1).
+        """
+
+        return len(self.by_status[status])
+
+    def add(self, uid, ws, raddr):
+        peer = self.peers[uid] = Peer(uid, ws, raddr)
+        self.by_status[STATUS_IDLE].add(uid)
+        return peer
+
+    def remove(self, uid):
+        """Removes a peer, it leaves its room but its session is left alone.
+
+        Returns:
+            Peer -- the removed peer, or None if it wasn't in the table.
+        """
+
+        peer = self.peers.pop(uid, None)
+        if peer is None:
+            return None
+        if peer.status == STATUS_ROOM:
+            self.leave_room(peer)
+        self.by_status[peer.status].discard(uid)
+        return peer
+
+    def set_status(self, peer, status):
+        self.by_status[peer.status].discard(peer.uid)
+        peer.status = status
+        self.by_status[status].add(peer.uid)
+
+    def join_room(self, uid, room_id):
+        """Moves a peer into a room, the room is created if required.
+
+        Returns:
+            Room -- the joined room.
+        """
+
+        peer = self.peers[uid]
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = Room(room_id)
+        room.add(uid)
+        peer.room = room
+        self.set_status(peer, STATUS_ROOM)
+        return room
+
+    def leave_room(self, peer):
+        """Takes a peer out of its room.
+
+        Returns:
+            Room -- the room the peer left, with the remaining members.
+        """
+
+        room = peer.room
+        room.remove(peer.uid)
+        if not room.members:
+            del self.rooms[room.room_id]
+        peer.room = None
+        self.set_status(peer, STATUS_IDLE)
+        return room
+
+    def start_session(self, uid, other_id):
+        """Registers a session of uid with other_id, either may be a remote peer.
+        """
+
+        session = Session(uid, other_id)
+        for pid in (uid, other_id):
+            peer = self.peers.get(pid)
+            if peer is not None:
+                self.sessions[pid] = session
+                self.set_status(peer, STATUS_SESSION)
+        return session
+
+    def end_session(self, uid):
+        """Removes the session of uid, for both peers.
+
+        The routes are cleared, the status of the peers is left as it is
+        since they are disconnected right after.
+
+        Returns:
+            Session -- the removed session, or None if uid had none.
+        """
+
+        session = self.sessions.pop(uid, None)
+        if session is None:
+            return None
+        other_id = session.other(uid)
+        if self.sessions.get(other_id) is session:
+            del self.sessions[other_id]
+        for pid in (uid, other_id):
+            peer = self.peers.get(pid)
+            if peer is not None:
+                peer.route = None
+        return session
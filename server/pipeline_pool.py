@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from metrics import Histogram, MetricFamily, COUNTER, GAUGE, HISTOGRAM, LATENCY_BUCKETS
+from startup import startup_timer
+
+logger = logging.getLogger("pipeline_pool")
+logger.setLevel(logging.INFO)
+
+"""Pool of pre-built pipelines, ready to negotiate
+
+Building a pipeline with a webrtcbin and setting it to PLAYING takes a
+while, and used to happen only once the session was set up. The pool keeps
+a few idle pipelines built ahead of time, GSTWebRTCApp.start_pipeline()
+takes one and only connects its signals and sets the session's servers.
+The pool is refilled in the background, on an executor thread so the event
+loop isn't held up by the builds. When it's empty a session builds its own
+pipeline as before.
+
+startup_stats records how long start_pipeline() took and the time from the
+start of a session to its first media buffer, for pre-built and new
+pipelines separately.
+
+    Usage example:
+    pool = PipelinePool(2, build_idle_pipeline)
+    pool.start(loop)
+    app = GSTWebRTCApp(pipeline_pool=pool)
+
+"""
+
+# Upper bounds in seconds of the time to first frame.
+FIRST_FRAME_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+
+class StartupStats:
+    def __init__(self):
+        """Session startup durations of all sessions in this process, by pipeline origin.
+        """
+
+        self.start = {True: Histogram(LATENCY_BUCKETS), False: Histogram(LATENCY_BUCKETS)}
+        self.first_frame = {True: Histogram(FIRST_FRAME_BUCKETS), False: Histogram(FIRST_FRAME_BUCKETS)}
+
+    def record_start(self, warm, seconds):
+        self.start[warm].observe(seconds)
+
+    def record_first_frame(self, warm, seconds):
+        self.first_frame[warm].observe(seconds)
+
+    def families(self):
+        start = MetricFamily("webrtc_pipeline_start_seconds", HISTOGRAM,
+                             "Time start_pipeline() took, by pipeline origin.")
+        first_frame = MetricFamily("webrtc_time_to_first_frame_seconds", HISTOGRAM,
+                                   "Time from the start of a session to its first media buffer, by pipeline origin.")
+        for warm in (True, False):
+            labels = {"pipeline": "pre-built" if warm else "new"}
+            start.add(self.start[warm], labels)
+            first_frame.add(self.first_frame[warm], labels)
+        return [start, first_frame]
+
+
+startup_stats = StartupStats()
+
+
+class WarmPipeline:
+    __slots__ = ("pipeline", "webrtcbin")
+
+    def __init__(self, pipeline, webrtcbin):
+        self.pipeline = pipeline
+        self.webrtcbin = webrtcbin
+
+
+class PipelinePool:
+    def __init__(self, size, build):
+        """Initialize the pool.
+
+        Arguments:
+            size {integer} -- number of idle pipelines kept ready.
+            build {function} -- builds an idle pipeline from a name suffix, returns
+                                    (Gst.Pipeline, webrtcbin), see gstwebrtc.build_idle_pipeline.
+        """
+
+        self.size = size
+        self.build = build
+        self.loop = None
+        self.idle = []
+        self.fill_task = None
+        self.built = 0
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, loop):
+        """Starts filling the pool.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop the pool is used from.
+        """
+
+        self.loop = loop
+        self.refill()
+
+    def refill(self):
+        if self.loop is None or len(self.idle) >= self.size:
+            return
+        if self.fill_task is None or self.fill_task.done():
+            self.fill_task = self.loop.create_task(self.__fill())
+
+    async def __fill(self):
+        first_fill = self.built == 0
+        began = time.time()
+        while len(self.idle) < self.size:
+            self.built += 1
+            name = "warm%d" % self.built
+            started = time.monotonic()
+            try:
+                pipeline, webrtcbin = await self.loop.run_in_executor(None, self.build, name)
+            except Exception as e:
+                logger.error("failed to build an idle pipeline: %s" % e)
+                return
+            logger.debug("built idle pipeline %s in %.1fms" % (name, (time.monotonic() - started) * 1000))
+            self.idle.append(WarmPipeline(pipeline, webrtcbin))
+        if first_fill:
+            startup_timer.record("pipeline_pool", began, time.time())
+
+    def acquire(self):
+        """Takes an idle pipeline, and starts refilling the pool.
+
+        Returns:
+            WarmPipeline -- None if the pool is empty.
+        """
+
+        warm = self.idle.pop(0) if self.idle else None
+        if warm is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # Only state changes were posted while it was idle.
+            bus = warm.pipeline.get_bus()
+            while bus.pop() is not None:
+                pass
+        self.refill()
+        return warm
+
+    def stop(self):
+        """Stops refilling and disposes of the idle pipelines.
+        """
+
+        if self.fill_task is not None:
+            self.fill_task.cancel()
+            self.fill_task = None
+        self.loop = None
+        for warm in self.idle:
+            warm.pipeline.set_state(Gst.State.NULL)
+        self.idle = []
+
+    def families(self):
+        return [
+            MetricFamily("webrtc_pipeline_pool_idle", GAUGE, "Pre-built pipelines ready to be used.").add(len(self.idle)),
+            MetricFamily("webrtc_pipeline_pool_acquired_total", COUNTER,
+                         "Pipelines requested from the pool, by outcome.").add(
+                             self.hits, {"outcome": "hit"}).add(self.misses, {"outcome": "miss"}),
+        ]
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import os
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+logger = logging.getLogger("recording")
+logger.setLevel(logging.INFO)
+
+"""Recording of the incoming H264 stream to segmented fragmented MP4
+
+The RTP stream is depayloaded, parsed and muxed as it is, nothing is decoded
+or re-encoded:
+
+    webrtcbin -> queue -> rtph264depay -> h264parse -> splitmuxsink(mp4mux)
+
+The queue gives the branch its own streaming thread, so file writes never
+block the webrtcbin receive thread; if the disk stalls for longer than the
+queue holds, the oldest packets are dropped instead. splitmuxsink starts a
+new segment at the first keyframe past the segment limits and finalizes the
+previous one asynchronously, asking the sender for a keyframe on time.
+The MP4 is fragmented, so a segment cut short by a crash stays playable.
+
+    Usage example:
+    app = GSTWebRTCApp(receive_branch=SegmentedRecorder('/recordings', session_id))
+
+"""
+
+
+class RecordingError(Exception):
+    pass
+
+
+class SegmentedRecorder:
+    # Plugins of the elements used by the branch, checked by GSTWebRTCApp.
+    required_plugins = ["coreelements", "rtp", "videoparsersbad", "multifile", "isomp4"]
+
+    def __init__(self, directory, session_id=None, segment_time=60, segment_size=0,
+                 fragment_duration=1000, max_queue_time=2):
+        """Initialize the recorder.
+
+        Arguments:
+            directory {string} -- directory the segments are written to, created if required.
+            session_id {string} -- id of the session, used in the segment file names.
+            segment_time {integer} -- maximum duration of a segment in seconds, 0 for no limit.
+            segment_size {integer} -- maximum size of a segment in bytes, 0 for no limit.
+            fragment_duration {integer} -- duration of the MP4 fragments in milliseconds.
+            max_queue_time {integer} -- seconds of stream buffered while the disk is busy.
+        """
+
+        self.directory = directory
+        self.session_id = session_id
+        self.segment_time = segment_time
+        self.segment_size = segment_size
+        self.fragment_duration = fragment_duration
+        self.max_queue_time = max_queue_time
+        self.elements = []
+        self.splitmuxsink = None
+
+        # Segment events, fired from the bus watch on the event loop.
+        self.on_segment_closed = lambda location: logger.info("recorded segment %s" % location)
+
+    def accepts(self, caps):
+        """Returns True if the branch can handle a webrtcbin src pad with these caps.
+        """
+
+        s = caps.get_structure(0)
+        return s.get_value("media") == "video" and s.get_value("encoding-name") == "H264"
+
+    def location(self):
+        name = "%s_%s_%%05d.mp4" % (self.session_id or "session", time.strftime("%Y%m%d-%H%M%S"))
+        return os.path.join(self.directory, name)
+
+    def link(self, pipeline, pad, element_name):
+        """Builds the recording branch and links it to a webrtcbin src pad.
+
+        Arguments:
+            pipeline {Gst.Pipeline} -- pipeline of the webrtcbin.
+            pad {Gst.Pad} -- the webrtcbin src pad carrying the H264 RTP stream.
+            element_name {function} -- returns a name unique to the session for an element name.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        queue = Gst.ElementFactory.make("queue", element_name("record_queue"))
+        queue.set_property("max-size-time", self.max_queue_time * Gst.SECOND)
+        queue.set_property("max-size-buffers", 0)
+        queue.set_property("max-size-bytes", 0)
+        queue.set_property("leaky", "downstream")
+
+        depay = Gst.ElementFactory.make("rtph264depay", element_name("record_depay"))
+        parse = Gst.ElementFactory.make("h264parse", element_name("record_parse"))
+        # Repeat SPS/PPS before every keyframe, so each segment starts decodable.
+        parse.set_property("config-interval", -1)
+
+        self.splitmuxsink = Gst.ElementFactory.make("splitmuxsink", element_name("record_sink"))
+        self.splitmuxsink.set_property("location", self.location())
+        self.splitmuxsink.set_property("max-size-time", self.segment_time * Gst.SECOND)
+        self.splitmuxsink.set_property("max-size-bytes", self.segment_size)
+        # Request a keyframe from the sender when a segment is due, the
+        # request travels upstream and is sent as RTCP PLI by the rtpsession.
+        self.splitmuxsink.set_property("send-keyframe-requests", True)
+        # Switch to the next segment right away and finalize the previous
+        # one in the background.
+        self.splitmuxsink.set_property("async-finalize", True)
+        self.splitmuxsink.set_property("muxer-factory", "mp4mux")
+        self.splitmuxsink.set_property("muxer-properties",
+            Gst.Structure.new_from_string("properties,fragment-duration=%d" % self.fragment_duration))
+        self.splitmuxsink.set_property("sink-properties",
+            Gst.Structure.new_from_string("properties,sync=false,async=false"))
+
+        self.elements = [queue, depay, parse, self.splitmuxsink]
+        for element in self.elements:
+            pipeline.add(element)
+        if pad.link(queue.get_static_pad("sink")) != Gst.PadLinkReturn.OK:
+            raise RecordingError("Failed to link webrtcbin -> record queue")
+        if not (queue.link(depay) and depay.link(parse) and parse.link(self.splitmuxsink)):
+            raise RecordingError("Failed to link the recording branch")
+        for element in self.elements:
+            element.sync_state_with_parent()
+
+        logger.info("recording session %s to %s" % (self.session_id, self.splitmuxsink.get_property("location")))
+
+    def handle_message(self, message):
+        """Handles the splitmuxsink element messages of the pipeline bus.
+
+        Returns:
+            bool -- True if the message was from this branch.
+        """
+
+        if self.splitmuxsink is None or message.src != self.splitmuxsink:
+            return False
+        s = message.get_structure()
+        if s is not None and s.get_name() == "splitmuxsink-fragment-closed":
+            self.on_segment_closed(s.get_value("location"))
+        return True
+
+    def release(self):
+        """Forgets the elements, they are disposed of with the pipeline.
+        """
+
+        self.elements = []
+        self.splitmuxsink = None
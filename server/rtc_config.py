@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import base64
+import hmac
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+from hashlib import sha1
+
+logger = logging.getLogger("rtc_config")
+logger.setLevel(logging.INFO)
+
+"""RTC configurations handed to browsers on /turn/
+
+TurnCredentialCache generates short-lived TURN credentials from a shared
+secret, as in the TURN REST API used by coturn's use-auth-secret, and keeps
+the serialized config of each user until shortly before it expires.
+RTCConfigFile watches a JSON config file and keeps its last valid content
+as bytes.
+
+    Usage example:
+    credentials = TurnCredentialCache(turn_host, turn_port, shared_secret)
+    body = credentials.get(username)
+
+    config_file = RTCConfigFile('/tmp/rtc.json')
+    config_file.on_change = lambda data: server.set_rtc_config(data)
+    asyncio.ensure_future(config_file.watch())
+
+"""
+
+# Lifetime of generated TURN credentials in seconds.
+DEFAULT_CREDENTIAL_TTL = 24 * 3600
+
+
+def generate_rtc_config(turn_host, turn_port, shared_secret, user, protocol='udp', turn_tls=False,
+                        ttl=DEFAULT_CREDENTIAL_TTL, now=None):
+    """Generates an RTC config with an HMAC TURN credential for a user.
+
+    Arguments:
+        turn_host {string} -- TURN server host, also used as STUN server.
+        turn_port {string} -- TURN server port.
+        shared_secret {string} -- secret shared with the TURN server.
+        user {string} -- user the credential is generated for.
+        protocol {string} -- TURN transport, "udp" or "tcp".
+        turn_tls {bool} -- use turns: URIs.
+        ttl {integer} -- seconds the credential is valid for.
+        now {float} -- current time, time.time() by default.
+
+    Returns:
+        string -- the RTC config JSON.
+    """
+
+    # The username is "<expiry>:<user>", a ':' in user would be ambiguous.
+    user = user.replace(":", "-")
+    expiry = int(now if now is not None else time.time()) + ttl
+    username = "{}:{}".format(expiry, user)
+    hashed = hmac.new(bytes(shared_secret, "utf-8"), bytes(username, "utf-8"), sha1).digest()
+    password = base64.b64encode(hashed).decode()
+
+    rtc_config = {
+        "lifetimeDuration": "{}s".format(ttl),
+        "blockStatus": "NOT_BLOCKED",
+        "iceTransportPolicy": "all",
+        "iceServers": [
+            {
+                "urls": [
+                    "stun:{}:{}".format(turn_host, turn_port)
+                ]
+            },
+            {
+                "urls": [
+                    "{}:{}:{}?transport={}".format('turns' if turn_tls else 'turn', turn_host, turn_port, protocol)
+                ],
+                "username": username,
+                "credential": password
+            }
+        ]
+    }
+    return json.dumps(rtc_config, indent=2)
+
+
+def parse_rtc_config(data):
+    """Returns the STUN and TURN server URIs of an RTC config in the form webrtcbin takes them.
+
+    Returns:
+        tuple -- ([stun uris], [turn uris], data)
+    """
+
+    ice_servers = json.loads(data)['iceServers']
+    stun_uris = []
+    turn_uris = []
+    for server in ice_servers:
+        for url in server.get("urls", []):
+            if url.startswith("stun:"):
+                stun_host = url.split(":")[1]
+                stun_port = url.split(":")[2].split("?")[0]
+                stun_uri = "stun://%s:%s" % (
+                    stun_host,
+                    stun_port
+                )
+                stun_uris.append(stun_uri)
+            elif url.startswith("turn:"):
+                turn_host = url.split(':')[1]
+                turn_port = url.split(':')[2].split('?')[0]
+                turn_user = server['username']
+                turn_password = server['credential']
+                turn_uri = "turn://%s:%s@%s:%s" % (
+                    urllib.parse.quote(turn_user, safe=""),
+                    urllib.parse.quote(turn_password, safe=""),
+                    turn_host,
+                    turn_port
+                )
+                turn_uris.append(turn_uri)
+            elif url.startswith("turns:"):
+                turn_host = url.split(':')[1]
+                turn_port = url.split(':')[2].split('?')[0]
+                turn_user = server['username']
+                turn_password = server['credential']
+                turn_uri = "turns://%s:%s@%s:%s" % (
+                    urllib.parse.quote(turn_user, safe=""),
+                    urllib.parse.quote(turn_password, safe=""),
+                    turn_host,
+                    turn_port
+                )
+                turn_uris.append(turn_uri)
+    return stun_uris, turn_uris, data
+
+
+class TurnCredentialCache:
+    def __init__(self, turn_host, turn_port, shared_secret, protocol='udp', turn_tls=False,
+                 ttl=DEFAULT_CREDENTIAL_TTL, refresh_margin=3600, max_users=10000):
+        """Initialize the cache.
+
+        Arguments:
+            refresh_margin {integer} -- seconds before expiry a new credential is generated,
+                                    so a client never gets one that's about to expire.
+            max_users {integer} -- number of users kept, the oldest entries are dropped first.
+
+        See generate_rtc_config() for the other arguments.
+        """
+
+        self.turn_host = turn_host
+        self.turn_port = turn_port
+        self.shared_secret = shared_secret
+        self.protocol = protocol
+        self.turn_tls = turn_tls
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl // 2)
+        self.max_users = max_users
+        # Format: {user: (refresh_at, config bytes)}
+        self.configs = dict()
+
+    def get(self, user):
+        """Returns the serialized RTC config of a user, generated on first use.
+
+        Returns:
+            bytes -- the RTC config JSON.
+        """
+
+        now = time.time()
+        entry = self.configs.get(user)
+        if entry is not None and now < entry[0]:
+            return entry[1]
+
+        data = generate_rtc_config(self.turn_host, self.turn_port, self.shared_secret, user,
+            self.protocol, self.turn_tls, self.ttl, now).encode()
+        self.configs.pop(user, None)
+        if len(self.configs) >= self.max_users:
+            self.evict(now)
+        self.configs[user] = (now + self.ttl - self.refresh_margin, data)
+        return data
+
+    def evict(self, now):
+        for user in [user for user, (refresh_at, _) in self.configs.items() if refresh_at <= now]:
+            del self.configs[user]
+        # Entries are kept in insertion order, the first ones are the oldest.
+        while len(self.configs) >= self.max_users:
+            del self.configs[next(iter(self.configs))]
+
+
+class RTCConfigFile:
+    def __init__(self, path, check_interval=1.0):
+        """Initialize the watcher, the file is read by check() or watch().
+
+        Arguments:
+            path {string} -- path of the JSON RTC config file.
+            check_interval {float} -- seconds between mtime checks.
+        """
+
+        self.path = path
+        self.check_interval = check_interval
+        # Last valid content of the file.
+        self.data = None
+        self.mtime = None
+
+        self.on_change = lambda data: logger.warn("unhandled on_change")
+
+    def check(self):
+        """Reads the file if it changed since the last check.
+
+        Returns:
+            bool -- True if new content was loaded.
+        """
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            json.loads(data)
+        except (OSError, ValueError) as e:
+            logger.warning("ignoring invalid RTC config file %s: %s" % (self.path, e))
+            return False
+        if data == self.data:
+            return False
+        self.data = data
+        logger.info("loaded RTC config from %s" % self.path)
+        self.on_change(data)
+        return True
+
+    async def watch(self):
+        """Checks the file every check_interval seconds, until cancelled.
+        """
+
+        while True:
+            self.check()
+            await asyncio.sleep(self.check_interval)
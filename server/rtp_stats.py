@@ -0,0 +1,228 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import Gst
+from gi.repository import GstWebRTC
+
+from metrics import MetricFamily, COUNTER, GAUGE
+
+logger = logging.getLogger("rtp_stats")
+logger.setLevel(logging.INFO)
+
+"""Periodic RTP statistics of every session, from webrtcbin get-stats
+
+Every interval the collector asks the webrtcbin of each session for its
+stats. The requests are spread over the interval rather than sent in one
+burst, and each is a promise: webrtcbin builds the reply on its own thread,
+where only the inbound-rtp fields below are picked out, and a small dict is
+handed to the event loop. The loop never waits on a webrtcbin, so relaying
+signalling messages isn't delayed by the collection.
+
+The jitterbuffers of the session's rtpbin are read at the same time for the
+retransmission counts, and the FrameTap decode policy for decoded frames.
+
+    Usage example:
+    collector = RTPStatsCollector(interval=5)
+    collector.start(loop, lambda: {peer_id: s.app for peer_id, s in sessions.items()})
+    body = render_metrics(collector.families())
+
+"""
+
+# Fields of the inbound-rtp stats, summed over the streams of a session,
+# except for the jitter which is the worst one.
+INBOUND_RTP_FIELDS = (
+    ("packets-received", "webrtc_rtp_packets_received_total", COUNTER, "RTP packets received."),
+    ("bytes-received", "webrtc_rtp_bytes_received_total", COUNTER, "RTP bytes received."),
+    ("packets-lost", "webrtc_rtp_packets_lost_total", COUNTER, "RTP packets lost, as reported in RTCP."),
+    ("jitter", "webrtc_rtp_jitter_seconds", GAUGE, "Interarrival jitter of the worst stream."),
+    ("nack-count", "webrtc_rtp_nacks_sent_total", COUNTER, "NACKs sent to the browser."),
+    ("pli-count", "webrtc_rtp_plis_sent_total", COUNTER, "PLIs sent to the browser."),
+    ("fir-count", "webrtc_rtp_firs_sent_total", COUNTER, "FIRs sent to the browser."),
+)
+
+# Fields of the rtpjitterbuffer stats property, summed over the jitterbuffers.
+JITTERBUFFER_FIELDS = (
+    ("rtx-count", "webrtc_rtp_rtx_requests_total", COUNTER, "Retransmissions requested by the jitterbuffers."),
+    ("rtx-success-count", "webrtc_rtp_rtx_recovered_total", COUNTER, "Packets recovered by retransmission."),
+    ("num-late", "webrtc_rtp_packets_late_total", COUNTER, "Packets that arrived too late to be played."),
+    ("num-duplicates", "webrtc_rtp_packets_duplicated_total", COUNTER, "Duplicate packets received."),
+)
+
+# Counters of the FrameTap decode policy.
+DECODE_FIELDS = (
+    ("frames_decoded", "webrtc_frames_decoded_total", COUNTER, "Video frames decoded."),
+    ("frames_delivered", "webrtc_frames_delivered_total", COUNTER, "Decoded frames delivered to consumers."),
+)
+
+
+def parse_inbound_rtp(reply):
+    """Picks the inbound-rtp fields out of a get-stats reply.
+
+    Arguments:
+        reply {Gst.Structure} -- reply of the webrtcbin get-stats action.
+
+    Returns:
+        dict -- {field: value} of INBOUND_RTP_FIELDS.
+    """
+
+    values = dict.fromkeys((field for field, _, _, _ in INBOUND_RTP_FIELDS), 0)
+    for i in range(reply.n_fields()):
+        stats = reply.get_value(reply.nth_field_name(i))
+        if not isinstance(stats, Gst.Structure) or not stats.has_field("type"):
+            continue
+        if stats.get_value("type") != GstWebRTC.WebRTCStatsType.INBOUND_RTP:
+            continue
+        for field in values:
+            if not stats.has_field(field):
+                continue
+            if field == "jitter":
+                values[field] = max(values[field], stats.get_value(field))
+            else:
+                values[field] += stats.get_value(field)
+    return values
+
+
+class SessionRTPStats:
+    __slots__ = ("values", "collected_at", "bitrate")
+
+    def __init__(self, values, collected_at, bitrate):
+        self.values = values
+        self.collected_at = collected_at
+        # Received bits per second since the previous collection.
+        self.bitrate = bitrate
+
+
+class RTPStatsCollector:
+    def __init__(self, interval=5.0):
+        """Initialize the collector.
+
+        Arguments:
+            interval {float} -- seconds between two collections of the same session.
+        """
+
+        self.interval = interval
+        self.loop = None
+        self.task = None
+        # Format: {session_id: SessionRTPStats}
+        self.sessions = dict()
+
+        # Cost of the collection, the parsing runs on the webrtcbin threads
+        # and its duration is added up on the loop with the values.
+        self.collections = 0
+        self.parse_seconds = 0.0
+
+    def start(self, loop, get_apps):
+        """Starts collecting.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop the replies are handed to.
+            get_apps {function} -- returns {session_id: GSTWebRTCApp} of the current sessions.
+        """
+
+        if self.task is not None:
+            return
+        self.loop = loop
+        self.task = loop.create_task(self.run(get_apps))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self, get_apps):
+        while True:
+            apps = get_apps()
+            for session_id in list(self.sessions):
+                if session_id not in apps:
+                    del self.sessions[session_id]
+            if not apps:
+                await asyncio.sleep(self.interval)
+                continue
+            # Spread the requests over the interval.
+            delay = self.interval / len(apps)
+            for session_id, app in list(apps.items()):
+                try:
+                    self.request(session_id, app)
+                except Exception as e:
+                    logger.warning("session %s: failed to request stats: %s" % (session_id, e))
+                await asyncio.sleep(delay)
+
+    def request(self, session_id, app):
+        """Asks the webrtcbin of an app for its stats, the reply is stored when it arrives.
+        """
+
+        webrtcbin = app.webrtcbin
+        if webrtcbin is None:
+            return
+
+        # Read on the loop: a property read and a few counters.
+        extra = dict()
+        for jitterbuffer in list(app.jitterbuffers):
+            jb_stats = jitterbuffer.get_property("stats")
+            for field, _, _, _ in JITTERBUFFER_FIELDS:
+                if jb_stats is not None and jb_stats.has_field(field):
+                    extra[field] = extra.get(field, 0) + jb_stats.get_value(field)
+        decode_policy = getattr(app.receive_branch, "decode_policy", None)
+        if decode_policy is not None:
+            for field, _, _, _ in DECODE_FIELDS:
+                extra[field] = getattr(decode_policy, field)
+
+        def on_reply(promise):
+            # Runs on a webrtcbin thread.
+            started = time.perf_counter()
+            if promise.wait() != Gst.PromiseResult.REPLIED or promise.get_reply() is None:
+                return
+            values = parse_inbound_rtp(promise.get_reply())
+            values.update(extra)
+            self.loop.call_soon_threadsafe(self.__store, session_id, values, time.perf_counter() - started)
+
+        promise = Gst.Promise.new_with_change_func(on_reply)
+        webrtcbin.emit('get-stats', None, promise)
+
+    def __store(self, session_id, values, parse_seconds):
+        self.parse_seconds += parse_seconds
+        now = time.monotonic()
+        bitrate = 0.0
+        previous = self.sessions.get(session_id)
+        if previous is not None and now > previous.collected_at:
+            received = values["bytes-received"] - previous.values["bytes-received"]
+            if received >= 0:
+                bitrate = received * 8 / (now - previous.collected_at)
+        self.sessions[session_id] = SessionRTPStats(values, now, bitrate)
+        self.collections += 1
+
+    def forget(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def families(self):
+        """Returns the latest stats of every session as metric families, labelled by session.
+        """
+
+        families = []
+        for fields in (INBOUND_RTP_FIELDS, JITTERBUFFER_FIELDS, DECODE_FIELDS):
+            for field, name, metric_type, help_text in fields:
+                family = MetricFamily(name, metric_type, help_text)
+                for session_id, stats in self.sessions.items():
+                    if field in stats.values:
+                        family.add(stats.values[field], {"session": session_id})
+                families.append(family)
+
+        bitrate = MetricFamily("webrtc_rtp_receive_bitrate_bps", GAUGE,
+                               "Received bitrate over the last collection interval.")
+        for session_id, stats in self.sessions.items():
+            bitrate.add(stats.bitrate, {"session": session_id})
+        families.append(bitrate)
+
+        families.append(MetricFamily("webrtc_stats_collections_total", COUNTER,
+                                     "get-stats replies collected.").add(self.collections))
+        families.append(MetricFamily("webrtc_stats_parse_seconds_total", COUNTER,
+                                     "Time spent picking fields out of get-stats replies.").add(self.parse_seconds))
+        return families
@@ -0,0 +1,220 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+
+logger = logging.getLogger("sdp_munger")
+logger.setLevel(logging.INFO)
+
+"""Declarative SDP munging
+
+Rules describe edits of a=fmtp parameters and are applied in a single pass
+over the SDP text. Only the a=fmtp lines a rule can apply to are rewritten,
+their parameters are edited in place with string searches instead of being
+parsed, everything else is left byte for byte as it was. A munger remembers
+what it did to each distinct a=fmtp line: webrtcbin writes the same ones for
+every session, so after the first negotiation a line costs a lookup.
+
+    Usage example:
+    munger = SDPMunger([FmtpRule("rtx-time", "125", when=("apt", None), after="apt", overwrite=True)])
+    sdp_text = munger.munge(sdp_text)
+
+"""
+
+# Distinct a=fmtp lines an SDPMunger remembers the result for.
+MAX_CACHED_LINES = 256
+
+
+def find_param(padded, name):
+    """Returns the index of the ";" in front of the first parameter called name.
+
+    Arguments:
+        padded {string} -- parameters of an a=fmtp line between a leading and a trailing ";".
+        name {string} -- name of the parameter.
+
+    Returns:
+        integer -- the index, or -1 if there is no such parameter.
+    """
+
+    token = ';' + name
+    end = len(token)
+    i = padded.find(token)
+    while i >= 0:
+        # A name without a value is followed by ";", the padding guarantees one.
+        if padded[i + end] in '=;':
+            return i
+        i = padded.find(token, i + 1)
+    return -1
+
+
+def param_value(padded, i, name):
+    """Returns the value of the parameter found at i by find_param(), None if it has none.
+    """
+
+    start = i + 1 + len(name)
+    if padded[start] == ';':
+        return None
+    return padded[start + 1:padded.find(';', start)]
+
+
+class FmtpRule:
+    def __init__(self, param, value, when, before=None, after=None, overwrite=False):
+        """Sets a parameter on every a=fmtp line matching a condition.
+
+        Arguments:
+            param {string} -- name of the parameter to set.
+            value {string} -- value of the parameter.
+            when {tuple} -- (name, value) the line must contain, a value of None matches any value.
+            before {string} -- optional parameter the new one is inserted in front of.
+            after {string} -- optional parameter the new one is inserted behind.
+            overwrite {bool} -- replace a different existing value, otherwise lines
+                                    that already have the parameter are left alone.
+        """
+
+        self.param = param
+        self.value = value
+        self.when_param, self.when_value = when
+        self.before = before
+        self.after = after
+        self.overwrite = overwrite
+
+    def matches(self, padded):
+        i = find_param(padded, self.when_param)
+        if i < 0:
+            return False
+        return self.when_value is None or param_value(padded, i, self.when_param) == self.when_value
+
+    def apply(self, padded):
+        """Applies the rule to the parameters of one a=fmtp line.
+
+        Arguments:
+            padded {string} -- parameters of the line between a leading and a trailing ";".
+
+        Returns:
+            string -- the new padded parameters, padded itself if the rule didn't change them.
+        """
+
+        if not self.matches(padded):
+            return padded
+
+        i = find_param(padded, self.param)
+        if i >= 0:
+            if not self.overwrite or param_value(padded, i, self.param) == self.value:
+                return padded
+            return padded[:i + 1] + self.param + '=' + self.value + padded[padded.find(';', i + 1):]
+
+        param = self.param + '=' + self.value + ';'
+        if self.before is not None:
+            i = find_param(padded, self.before)
+            if i >= 0:
+                return padded[:i + 1] + param + padded[i + 1:]
+        if self.after is not None:
+            i = find_param(padded, self.after)
+            if i >= 0:
+                end = padded.find(';', i + 1) + 1
+                return padded[:end] + param + padded[end:]
+        return padded + param
+
+
+class SDPMunger:
+    def __init__(self, rules):
+        """Initialize the munger.
+
+        Arguments:
+            rules {[list of FmtpRule]} -- rules applied in order to every a=fmtp line.
+        """
+
+        self.rules = list(rules)
+        # Lines without any of these substrings can't match a rule and are
+        # left alone without being looked at further.
+        self.triggers = tuple(set(rule.when_param for rule in self.rules))
+        # Format: {parameters of an a=fmtp line: rewritten parameters, or None if unchanged}
+        # Offers are munged on GStreamer threads: the entries only depend on
+        # their key, a race at worst computes one twice.
+        self.cache = dict()
+
+    def munge(self, sdp_text):
+        """Returns sdp_text with the rules applied.
+        """
+
+        out = []
+        # Text up to pos has been copied to out, unchanged lines are copied
+        # in one slice together with the next changed one.
+        pos = 0
+        find = sdp_text.find
+        cache = self.cache
+        line_end = 0
+        while True:
+            start = find('a=fmtp:', line_end)
+            if start < 0:
+                break
+            line_end = find('\n', start)
+            if line_end < 0:
+                line_end = len(sdp_text)
+            params_start = find(' ', start, line_end) + 1
+            if params_start <= 0:
+                # a=fmtp line without parameters
+                continue
+            params_end = line_end - 1 if sdp_text[line_end - 1] == '\r' else line_end
+
+            text = sdp_text[params_start:params_end]
+            try:
+                params = cache[text]
+            except KeyError:
+                params = self.__munge_params(sdp_text[start + 7:params_start - 1], text)
+                if len(cache) >= MAX_CACHED_LINES:
+                    cache.clear()
+                cache[text] = params
+            if params is not None:
+                out.append(sdp_text[pos:params_start])
+                out.append(params)
+                pos = params_end
+        if not out:
+            return sdp_text
+        out.append(sdp_text[pos:])
+        return ''.join(out)
+
+    def __munge_params(self, pt, text):
+        """Returns the rewritten parameters of one a=fmtp line, or None if no rule changed them.
+        """
+
+        for trigger in self.triggers:
+            if trigger in text:
+                break
+        else:
+            return None
+
+        padded = ';' + text + ';'
+        changed = padded
+        for rule in self.rules:
+            if rule.when_param not in changed:
+                continue
+            munged = rule.apply(changed)
+            if munged is not changed:
+                logger.debug("payload %s: setting %s=%s" % (pt, rule.param, rule.value))
+                changed = munged
+        if changed is padded:
+            return None
+        return changed[1:-1]
+
+
+def rtx_time_rules(rtx_time):
+    """Returns the rules setting rtx-time on the RTX payloads, none if rtx_time is None.
+    """
+
+    if rtx_time is None:
+        return []
+    return [FmtpRule("rtx-time", str(rtx_time), when=("apt", None), after="apt", overwrite=True)]
+
+
+# rtx-time needs to be set to 125 milliseconds for optimal performance
+RTX_TIME_RULES = rtx_time_rules(125)
+
+# Firefox needs profile-level-id=42e01f, but webrtcbin does not add this.
+# TODO: Remove when fixed in webrtcbin.
+# https://gitlab.freedesktop.org/gstreamer/gstreamer/-/issues/1106
+H264_RULES = [
+    FmtpRule("profile-level-id", "42e01f", when=("packetization-mode", "1"), before="packetization-mode"),
+    FmtpRule("level-asymmetry-allowed", "1", when=("packetization-mode", "1"), before="packetization-mode"),
+]
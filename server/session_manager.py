@@ -0,0 +1,442 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import random
+
+import websockets
+
+from webrtc_signalling import Backoff, WebRTCSignalling, WebRTCSignallingErrorNoPeer
+from gstwebrtc import GSTWebRTCApp, build_idle_pipeline, prepare_gstreamer
+from jitter_tuning import JitterBufferTuning
+from loop_bridge import LoopDispatcher
+from metrics import MetricFamily, COUNTER, GAUGE, HISTOGRAM
+from negotiation import negotiation_stats
+from pipeline_pool import PipelinePool, startup_stats
+from rtp_stats import RTPStatsCollector
+from startup import startup_timer
+from decode_policy import DecodePolicy
+from frame_ring import FrameRingWriter
+from frame_tap import FrameTap
+from recording import SegmentedRecorder
+from rtc_config import TurnCredentialCache, parse_rtc_config
+
+logger = logging.getLogger("session_manager")
+logger.setLevel(logging.INFO)
+
+"""Session manager for concurrent browser publishers
+
+Every browser peer that registers with the signalling server gets its own
+media session: a signalling client registered as <prefix><peer id> and a
+GSTWebRTCApp with its own pipeline and webrtcbin.
+
+    Usage example:
+    manager = WebRTCSessionManager('ws://127.0.0.1:8080/ws')
+    server.on_peer_registered = manager.on_peer_registered
+    server.on_peer_removed = manager.on_peer_removed
+    manager.local_server = server
+
+"""
+
+# Seconds stop() waits for the sessions to wind down before cancelling them.
+SESSION_STOP_TIMEOUT = 5
+
+# User of the server side TURN credentials, browsers get their own on /turn/.
+SERVER_TURN_USER = "webrtc-server"
+
+
+class WebRTCSession:
+    def __init__(self, peer_id, signalling, app):
+        """Media session bound to a single browser peer.
+
+        Arguments:
+            peer_id {string} -- ID of the browser peer publishing the stream.
+            signalling {WebRTCSignalling} -- signalling client used by this session.
+            app {GSTWebRTCApp} -- app receiving the stream of this session.
+        """
+
+        self.peer_id = peer_id
+        self.signalling = signalling
+        self.app = app
+        self.running = True
+        self.task = None
+        # Spaces out reconnections, reset once the server answers HELLO.
+        self.backoff = Backoff()
+        # Optional FrameRingWriter fed by the app, removed when the session ends.
+        self.frame_ring = None
+
+    async def run(self):
+        """Runs the session until stop() is called.
+
+        The signalling client is reconnected with exponential backoff
+        whenever its connection drops while the session is still running,
+        or the app fails on what the browser sent, such as an SDP that isn't
+        an offer.
+        """
+
+        try:
+            while self.running:
+                try:
+                    await self.signalling.connect()
+                    await self.signalling.start()
+                except (websockets.ConnectionClosed, OSError) as e:
+                    logger.warning("session %s: signalling connection lost: %s" % (self.peer_id, e))
+                except Exception as e:
+                    logger.error("session %s: failed: %s" % (self.peer_id, e))
+                    # Register again from scratch, the server still has the old connection.
+                    if self.signalling.conn is not None:
+                        await self.signalling.stop()
+                finally:
+                    self.app.stop_pipeline()
+                if self.running:
+                    await self.backoff.wait()
+        finally:
+            # Also when cancelled, the ring's shared memory outlives the process.
+            if self.frame_ring is not None:
+                self.frame_ring.close()
+                self.frame_ring = None
+        logger.info("session %s: stopped" % self.peer_id)
+
+    async def stop(self):
+        """Stops the session and closes its signalling connection.
+        """
+
+        self.running = False
+        if self.signalling.conn is not None:
+            await self.signalling.stop()
+
+
+class WebRTCSessionManager:
+    def __init__(self, server, stun_servers=None, turn_servers=None, encoder=None,
+                 server_peer_prefix='gst-', max_sessions=0,
+                 enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None,
+                 recording=None, frames=None, frame_ring=None, decode_policy=None,
+                 stats_interval=5, latency_sample_rate=0, jitter_tuning=None, warm_pipelines=0,
+                 turn_credentials=None):
+        """Initialize the session manager.
+
+        Arguments:
+            server {string} -- websocket URI of the signalling server, example: ws://127.0.0.1:8080/ws
+            stun_servers {[list of string]} -- Optional STUN server uris passed to every app.
+            turn_servers {[list of string]} -- Optional TURN server uris passed to every app.
+            encoder {string} -- GStreamer encoder plugin name passed to every app.
+            server_peer_prefix {string} -- prefix of the ids the server side registers with,
+                                    peers with this prefix never get a session of their own.
+            max_sessions {integer} -- maximum number of concurrent sessions, 0 for no limit.
+            recording {dict} -- Optional SegmentedRecorder arguments, records the video of every session.
+            frames {dict} -- Optional FrameTap arguments, decodes the video of every session
+                                    and hands the frames to on_frames.
+            frame_ring {dict} -- Optional FrameRingWriter arguments, publishes the decoded frames
+                                    of every session in shared memory instead of on_frames.
+            decode_policy {dict} -- Optional DecodePolicy arguments, selects the frames decoded
+                                    for frames and frame_ring.
+            stats_interval {float} -- seconds between two collections of the RTP stats of a
+                                    session, 0 to disable them.
+            latency_sample_rate {float} -- fraction of the new sessions whose receive path
+                                    latency is traced, see set_latency_tracing().
+            jitter_tuning {dict} -- Optional JitterBufferTuning arguments of every session,
+                                    see tune_session().
+            warm_pipelines {integer} -- pipelines kept built ahead of the sessions, see
+                                    pipeline_pool. Filled once start() is called.
+            turn_credentials {dict} -- Optional TurnCredentialCache arguments, every session gets
+                                    the STUN and TURN servers of a credential generated from
+                                    them instead of stun_servers and turn_servers.
+        """
+
+        if (frame_ring or decode_policy) and frames is None:
+            frames = dict()
+        if recording and frames is not None:
+            raise ValueError("recording and frames can't be used together")
+
+        self.server = server
+        self.stun_servers = stun_servers
+        self.turn_servers = turn_servers
+        # Renews the server's credential before it expires, a long running
+        # server would otherwise hand expired ones to its new sessions.
+        self.turn_credentials = TurnCredentialCache(**turn_credentials) if turn_credentials else None
+        self.encoder = encoder
+        self.server_peer_prefix = server_peer_prefix
+        self.max_sessions = max_sessions
+        self.enable_basic_auth = enable_basic_auth
+        self.basic_auth_user = basic_auth_user
+        self.basic_auth_password = basic_auth_password
+        self.recording = recording
+        self.frames = frames
+        self.frame_ring = frame_ring
+        self.decode_policy = decode_policy
+        # WebRTCSimpleServer running in this process, the sessions connect to
+        # it in process rather than on server when set, see local_signalling.
+        self.local_server = None
+
+        # Decoded frame batches of all sessions, fired on the streaming
+        # thread of each session, see frame_tap.
+        self.on_frames = lambda session_id, frames: logger.warn("unhandled frames")
+
+        # Format: {browser_peer_id: WebRTCSession}
+        self.sessions = dict()
+
+        # Runs the webrtcbin callbacks of all sessions on the event loop.
+        self.dispatcher = None
+
+        # RTP stats of all sessions, see rtp_stats.
+        self.stats_collector = RTPStatsCollector(stats_interval) if stats_interval else None
+        self.latency_sample_rate = latency_sample_rate
+        self.jitter_tuning = jitter_tuning or {}
+        # Fail on bad settings now rather than for every session.
+        JitterBufferTuning(**self.jitter_tuning)
+        self.pipeline_pool = PipelinePool(warm_pipelines, build_idle_pipeline) if warm_pipelines else None
+        # Exception GStreamer failed to initialize with, the loop is stopped
+        # and the process should exit when set.
+        self.init_error = None
+
+    def create_session(self, peer_id):
+        """Creates a session with its own signalling client and app for a browser peer.
+
+        Arguments:
+            peer_id {string} -- ID of the browser peer.
+        """
+
+        signalling = WebRTCSignalling(self.server, self.server_peer_prefix + peer_id, peer_id,
+            enable_basic_auth=self.enable_basic_auth,
+            basic_auth_user=self.basic_auth_user,
+            basic_auth_password=self.basic_auth_password,
+            local_server=self.local_server)
+        if self.dispatcher is None:
+            self.dispatcher = LoopDispatcher(asyncio.get_event_loop())
+        receive_branch = None
+        if self.recording:
+            receive_branch = SegmentedRecorder(session_id=peer_id, **self.recording)
+        elif self.frames is not None:
+            policy = DecodePolicy(session_id=peer_id, **(self.decode_policy or {}))
+            receive_branch = FrameTap(session_id=peer_id, decode_policy=policy, **self.frames)
+            receive_branch.on_frames = lambda frames: self.on_frames(peer_id, frames)
+        stun_servers, turn_servers = self.stun_servers, self.turn_servers
+        if self.turn_credentials is not None:
+            stun_servers, turn_servers, _ = parse_rtc_config(self.turn_credentials.get(SERVER_TURN_USER))
+        app = GSTWebRTCApp(stun_servers, turn_servers, self.encoder,
+            session_id=peer_id, dispatcher=self.dispatcher, receive_branch=receive_branch,
+            jitter_tuning=JitterBufferTuning(session_id=peer_id, **self.jitter_tuning),
+            pipeline_pool=self.pipeline_pool)
+        session = WebRTCSession(peer_id, signalling, app)
+        if self.latency_sample_rate and random.random() < self.latency_sample_rate:
+            app.latency_tracer.enable()
+
+        # Consumers in other processes attach to the ring by peer id.
+        if self.frame_ring:
+            session.frame_ring = FrameRingWriter(peer_id, **self.frame_ring)
+            receive_branch.on_frames = session.frame_ring.write_frames
+
+        # Handle errors from the signalling server.
+        async def on_signalling_error(e):
+            if isinstance(e, WebRTCSignallingErrorNoPeer):
+                # Peer went away before the session was set up, the server
+                # tells us as soon as it registers again.
+                if session.running:
+                    await signalling.watch_peer()
+            else:
+                logger.error("session %s: signalling error: %s" % (peer_id, str(e)))
+                app.stop_pipeline()
+        signalling.on_error = on_signalling_error
+
+        signalling.on_disconnect = lambda: app.stop_pipeline()
+
+        # After connecting, attempt to setup call to peer.
+        async def on_connect():
+            session.backoff.reset()
+            await signalling.setup_call()
+        signalling.on_connect = on_connect
+
+        async def on_peer_present():
+            if session.running:
+                await signalling.setup_call()
+        signalling.on_peer_present = on_peer_present
+
+        # Send the local sdp and ICE candidates to signalling.
+        app.on_sdp = signalling.send_sdp
+        app.on_ice = signalling.send_ice
+
+        # Set the remote SDP and ICE candidates received from signalling.
+        signalling.on_sdp = app.set_sdp
+        signalling.on_ice = app.set_ice
+
+        # Start the pipeline once the session is established.
+        signalling.on_session = app.start_pipeline
+
+        # Tear the pipeline down as soon as it posts an error.
+        app.on_bus_error = lambda err: app.stop_pipeline()
+
+        return session
+
+    def start(self, loop):
+        """Initializes GStreamer and builds the idle pipelines of the pool ahead of the first session.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop the sessions run on.
+        """
+
+        # On an executor thread, the signalling server comes up meanwhile.
+        prepared = loop.run_in_executor(None, prepare_gstreamer)
+        prepared.add_done_callback(lambda future: self.on_gstreamer_prepared(loop, future))
+        if self.pipeline_pool is not None:
+            self.pipeline_pool.start(loop)
+
+    def on_gstreamer_prepared(self, loop, future):
+        """Stops the loop if GStreamer couldn't be initialized, no session could ever start.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop the sessions run on.
+            future {asyncio.Future} -- result of prepare_gstreamer().
+        """
+
+        if future.cancelled() or future.exception() is None:
+            return
+        self.init_error = future.exception()
+        logger.error("failed to initialize GStreamer: %s" % self.init_error)
+        loop.stop()
+
+    def on_peer_registered(self, uid):
+        """Starts a session for a newly registered browser peer.
+
+        Arguments:
+            uid {string} -- ID of the registered peer.
+        """
+
+        if uid.startswith(self.server_peer_prefix) or uid in self.sessions:
+            return
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            logger.warning("not starting session for peer %s, limit of %d sessions reached" % (uid, self.max_sessions))
+            return
+
+        logger.info("starting session for peer %s" % uid)
+        session = self.create_session(uid)
+        self.sessions[uid] = session
+        session.task = asyncio.ensure_future(session.run())
+        session.task.add_done_callback(lambda task: self.on_session_done(uid, session, task))
+        if self.stats_collector is not None:
+            self.stats_collector.start(asyncio.get_event_loop(),
+                                       lambda: {peer_id: s.app for peer_id, s in self.sessions.items()})
+
+    def on_session_done(self, uid, session, task):
+        """Forgets a session whose task ended while the peer was still registered.
+
+        Frees its max_sessions slot, and the peer gets a new session the
+        next time it registers.
+        """
+
+        if self.sessions.get(uid) is not session:
+            return
+        del self.sessions[uid]
+        if self.stats_collector is not None:
+            self.stats_collector.forget(uid)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("session %s: ended with %s" % (uid, task.exception()))
+
+    def on_peer_removed(self, uid):
+        """Stops the session of a browser peer that left.
+
+        Arguments:
+            uid {string} -- ID of the removed peer.
+        """
+
+        session = self.sessions.pop(uid, None)
+        if session is None:
+            return
+        logger.info("stopping session for peer %s" % uid)
+        if self.stats_collector is not None:
+            self.stats_collector.forget(uid)
+        session.running = False
+        asyncio.ensure_future(session.stop())
+
+    def set_latency_tracing(self, peer_id, enabled):
+        """Switches the latency tracing of a running session on or off.
+
+        Returns:
+            bool -- False if there is no session for the peer.
+        """
+
+        session = self.sessions.get(peer_id)
+        if session is None:
+            return False
+        if enabled:
+            session.app.latency_tracer.enable()
+        else:
+            session.app.latency_tracer.disable()
+        return True
+
+    def tune_session(self, peer_id, **settings):
+        """Changes the jitterbuffer settings of a running session, see GSTWebRTCApp.tune().
+
+        Returns:
+            bool -- False if there is no session for the peer.
+        """
+
+        session = self.sessions.get(peer_id)
+        if session is None:
+            return False
+        session.app.tune(**settings)
+        return True
+
+    def metrics(self):
+        """Returns the metric families of the sessions of this manager.
+        """
+
+        families = [
+            MetricFamily("webrtc_sessions", GAUGE, "Active media sessions.").add(len(self.sessions)),
+            MetricFamily("webrtc_dispatch_dropped_total", COUNTER,
+                         "webrtcbin callbacks dropped because the dispatch queue was full.").add(
+                             self.dispatcher.dropped if self.dispatcher is not None else 0),
+        ]
+        count = MetricFamily("webrtc_negotiation_total", COUNTER, "Negotiation phases completed.")
+        avg = MetricFamily("webrtc_negotiation_avg_seconds", GAUGE, "Average duration of a negotiation phase.")
+        longest = MetricFamily("webrtc_negotiation_max_seconds", GAUGE, "Longest duration of a negotiation phase.")
+        for phase, summary in negotiation_stats.summary().items():
+            count.add(summary["count"], {"phase": phase})
+            avg.add(summary["avg"], {"phase": phase})
+            longest.add(summary["max"], {"phase": phase})
+        families.extend((count, avg, longest))
+        latency = MetricFamily("webrtc_latency_seconds", HISTOGRAM,
+                               "Time buffers spend in each element of the receive path of traced sessions.")
+        for peer_id, session in self.sessions.items():
+            for span, histogram in session.app.latency_tracer.snapshot().items():
+                if histogram.count:
+                    latency.add(histogram, {"session": peer_id, "span": span})
+        families.append(latency)
+        jitterbuffer = MetricFamily("webrtc_jitterbuffer_latency_seconds", GAUGE,
+                                    "Configured jitterbuffer latency, adjusted in adaptive mode.")
+        for peer_id, session in self.sessions.items():
+            app = session.app
+            if app.adaptive_latency is not None:
+                jitterbuffer.add(app.adaptive_latency.latency / 1000.0, {"session": peer_id})
+            elif app.jitter_tuning.latency is not None:
+                jitterbuffer.add(app.jitter_tuning.latency / 1000.0, {"session": peer_id})
+        families.append(jitterbuffer)
+        families.extend(startup_stats.families())
+        families.extend(startup_timer.families())
+        if self.pipeline_pool is not None:
+            families.extend(self.pipeline_pool.families())
+        if self.stats_collector is not None:
+            families.extend(self.stats_collector.families())
+        return families
+
+    async def stop(self):
+        """Stops all sessions.
+        """
+
+        if self.stats_collector is not None:
+            self.stats_collector.stop()
+        if self.pipeline_pool is not None:
+            self.pipeline_pool.stop()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.stop()
+        # run() releases the frame ring on its way out, wait for it. A
+        # session sleeping out its reconnect backoff is cancelled instead.
+        tasks = [session.task for session in sessions if session.task is not None]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=SESSION_STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -23,9 +23,9 @@ import basicauth
 import time
 import argparse
 import http
-import concurrent
 import functools
 import json
+import multiprocessing
 
 from hashlib import sha1
 import hmac
@@ -33,6 +33,14 @@ import base64
 
 from http import HTTPStatus
 
+from local_signalling import local_connection_pair
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricFamily, COUNTER, GAUGE, render_metrics
+from peer_outbox import PeerOutbox
+from peer_registry import InMemoryPeerRegistry, PeerRegistryHub, RemoteRoute, UnixSocketPeerRegistry
+from peer_table import PeerTable, STATUS_IDLE, STATUS_ROOM, STATUS_SESSION
+from rtc_config import RTCConfigFile, TurnCredentialCache
+from static_cache import StaticAssetCache
+
 logger = logging.getLogger("signaling")
 web_logger = logging.getLogger("web")
 
@@ -45,20 +53,17 @@ MIME_TYPES = {
 
 class WebRTCSimpleServer(object):
 
-    def __init__(self, loop, options):
+    def __init__(self, loop, options, registry=None):
         ############### Global data ###############
 
-        # Format: {uid: (Peer WebSocketServerProtocol,
-        #                remote_address,
-        #                <'session'|room_id|None>)}
-        self.peers = dict()
-        # Format: {caller_uid: callee_uid,
-        #          callee_uid: caller_uid}
-        # Bidirectional mapping between the two peers
-        self.sessions = dict()
-        # Format: {room_id: {peer1_id, peer2_id, peer3_id, ...}}
-        # Room dict with a set of peers in each room
-        self.rooms = dict()
+        # Peers, sessions and rooms, indexed by status and room. The relay
+        # route and the outbound queue of a peer are kept on its Peer record.
+        # See peer_table.
+        self.peers = PeerTable()
+
+        # Registry of the peers of all signalling workers, also carries the
+        # messages for peers connected to another worker. See peer_registry.
+        self.registry = registry or InMemoryPeerRegistry()
 
         # Event loop
         self.loop = loop
@@ -72,13 +77,28 @@ class WebRTCSimpleServer(object):
         self.cert_restart = options.cert_restart
         self.cert_path = options.cert_path
         self.disable_ssl = options.disable_ssl
+        self.reuse_port = options.reuse_port
         self.health_path = options.health
+        self.metrics_path = options.metrics
+
+        # Relayed messages are only logged every relay_log_interval messages,
+        # 0 disables it. Each message is logged at DEBUG level.
+        self.relay_log_interval = options.relay_log_interval
+        self.relayed_messages = 0
+
+        # Room messages queued for a peer before it's disconnected as a slow consumer
+        self.outbox_size = options.outbox_size
 
         # Certificate mtime, used to detect when to restart the server
         self.cert_mtime = -1
 
+        # Files of the web root are served from memory, their mtime is
+        # checked at most every cache_ttl seconds. See static_cache.
+        self.web_root = options.web_root
         self.cache_ttl = 60
-        self.http_cache = {}
+        self.http_cache = None
+        if self.web_root:
+            self.http_cache = StaticAssetCache(self.web_root, MIME_TYPES, check_interval=self.cache_ttl)
 
         # TURN options
         self.turn_host = options.turn_host
@@ -87,13 +107,40 @@ class WebRTCSimpleServer(object):
         if self.turn_protocol != 'tcp':
             self.turn_protocol = 'udp'
         self.turn_tls = options.turn_tls
+        self.turn_shared_secret = options.turn_shared_secret
+        self.turn_auth_header_name = options.turn_auth_header_name
+
+        # HMAC TURN credentials, memoized per user until shortly before they expire.
+        self.turn_credentials = None
+        if self.turn_shared_secret:
+            if not (self.turn_host and self.turn_port):
+                raise Exception("missing turn_host and turn_port when using turn_shared_secret option.")
+            self.turn_credentials = TurnCredentialCache(self.turn_host, self.turn_port, self.turn_shared_secret,
+                                                        self.turn_protocol, self.turn_tls)
 
         # Basic Auth options.
         self.enable_basic_auth = str(options.enable_basic_auth).lower() == 'true'
         self.basic_auth_user = options.basic_auth_user
         self.basic_auth_password = options.basic_auth_password
 
-        self.rtc_config = options.rtc_config
+        # RTC config served on /turn/ when there is no TURN shared secret,
+        # kept as bytes. Replaced whenever the rtc_config_file changes.
+        self.rtc_config = None
+        self.set_rtc_config(options.rtc_config)
+        self.rtc_config_file = None
+        self.rtc_config_task = None
+        if options.rtc_config_file:
+            self.rtc_config_file = RTCConfigFile(options.rtc_config_file)
+            self.rtc_config_file.on_change = self.set_rtc_config
+
+        # Peer presence callbacks, used by the session manager to attach a
+        # media session to every browser peer that registers.
+        self.on_peer_registered = lambda uid: None
+        self.on_peer_removed = lambda uid: None
+
+        # Functions returning lists of metrics.MetricFamily, rendered on the
+        # metrics path. The session manager adds its own.
+        self.metrics_collectors = [self.metrics]
 
         # Validate basic auth args
         if self.enable_basic_auth:
@@ -103,7 +150,9 @@ class WebRTCSimpleServer(object):
     ############### Helper functions ###############
 
     def set_rtc_config(self, rtc_config):
-        self.rtc_config = rtc_config
+        if isinstance(rtc_config, str):
+            rtc_config = rtc_config.encode()
+        self.rtc_config = rtc_config or None
 
 
     async def process_request(self, path, request_headers):
@@ -129,178 +178,272 @@ class WebRTCSimpleServer(object):
         if path == self.health_path:
             return http.HTTPStatus.OK, response_headers, b"OK\n"
 
+        if self.metrics_path and path == self.metrics_path:
+            families = []
+            for collect in self.metrics_collectors:
+                try:
+                    families.extend(collect())
+                except Exception as e:
+                    web_logger.error("HTTP GET {} metrics collector failed: {}".format(path, e))
+            response_headers.append(('Content-Type', METRICS_CONTENT_TYPE))
+            response_headers.append(('Cache-Control', 'no-store'))
+            return http.HTTPStatus.OK, response_headers, render_metrics(families)
+
         if path == '/turn/':
-            # if self.turn_shared_secret:
-            #     # Get username from auth header.
-            #     if not username:
-            #         username = request_headers.get(self.turn_auth_header_name, "")
-            #         if not username:
-            #             web_logger.warning("HTTP GET {} 401 Unauthorized - missing auth header: {}".format(path, self.turn_auth_header_name))
-            #             return HTTPStatus.UNAUTHORIZED, response_headers, b'401 Unauthorized - missing auth header'
-            #     web_logger.info("Generating HMAC credential for user: {}".format(username))
-            #     rtc_config = generate_rtc_config(self.turn_host, self.turn_port, self.turn_shared_secret, username, self.turn_protocol, self.turn_tls)
-            #    return http.HTTPStatus.OK, response_headers, str.encode(rtc_config)
+            if self.turn_credentials is not None:
+                # Get username from auth header.
+                if not username:
+                    username = request_headers.get(self.turn_auth_header_name, "")
+                    if not username:
+                        web_logger.warning("HTTP GET {} 401 Unauthorized - missing auth header: {}".format(path, self.turn_auth_header_name))
+                        return HTTPStatus.UNAUTHORIZED, response_headers, b'401 Unauthorized - missing auth header'
+                response_headers.append(('Content-Type', 'application/json'))
+                response_headers.append(('Cache-Control', 'no-store'))
+                return http.HTTPStatus.OK, response_headers, self.turn_credentials.get(username)
 
             if self.rtc_config:
-                data = self.rtc_config
-                if type(data) == str:
-                    data = str.encode(data)
                 response_headers.append(('Content-Type', 'application/json'))
-                return http.HTTPStatus.OK, response_headers, data
+                return http.HTTPStatus.OK, response_headers, self.rtc_config
             else:
                 web_logger.warning("HTTP GET {} 404 NOT FOUND - Missing RTC config".format(path))
                 return HTTPStatus.NOT_FOUND, response_headers, b'404 NOT FOUND'
 
+        if self.http_cache is None:
+            web_logger.info("HTTP GET {} 200 OK".format(path))
+            return HTTPStatus.OK, response_headers, b'Nopoeeee'
+
+        asset = self.http_cache.get(path)
+        if asset is None:
+            web_logger.warning("HTTP GET {} 404 NOT FOUND".format(path))
+            return HTTPStatus.NOT_FOUND, response_headers, b'404 NOT FOUND'
+
+        encoding, body = asset.variant(request_headers.get('Accept-Encoding', ''))
+        response_headers.append(('ETag', asset.etag_for(encoding)))
+        # Browsers revalidate every time and get a 304 while the file is unchanged.
+        response_headers.append(('Cache-Control', 'no-cache'))
+        response_headers.append(('Vary', 'Accept-Encoding'))
+        if asset.matches(request_headers.get('If-None-Match', '')):
+            web_logger.info("HTTP GET {} 304 NOT MODIFIED".format(path))
+            return HTTPStatus.NOT_MODIFIED, response_headers, b''
+
+        response_headers.append(('Content-Type', asset.mime_type))
+        if encoding != 'identity':
+            response_headers.append(('Content-Encoding', encoding))
         web_logger.info("HTTP GET {} 200 OK".format(path))
-        return HTTPStatus.OK, response_headers, b'Nopoeeee'
-
-    async def recv_msg_ping(self, ws, raddr):
-        '''
-        Wait for a message forever, and send a regular ping to prevent bad routers
-        from closing the connection.
-        '''
-        msg = None
-        while msg is None:
-            try:
-                msg = await asyncio.wait_for(ws.recv(), self.keepalive_timeout)
-            except (asyncio.TimeoutError, concurrent.futures._base.TimeoutError):
-                web_logger.info('Sending keepalive ping to {!r} in recv'.format(raddr))
-                await ws.ping()
-        return msg
+        return HTTPStatus.OK, response_headers, body
+
+    def metrics(self):
+        """Returns the metric families of the signalling server.
+        """
+
+        peers = MetricFamily("webrtc_signalling_peers", GAUGE, "Connected peers by status.")
+        for status in (STATUS_IDLE, STATUS_SESSION, STATUS_ROOM):
+            peers.add(self.peers.count(status), {"status": status})
+        return [
+            peers,
+            MetricFamily("webrtc_signalling_rooms", GAUGE, "Open rooms.").add(len(self.peers.rooms)),
+            MetricFamily("webrtc_signalling_relayed_messages_total", COUNTER,
+                         "Messages relayed between peers.").add(self.relayed_messages),
+        ]
 
     async def cleanup_session(self, uid):
-        if uid in self.sessions:
-            other_id = self.sessions[uid]
-            del self.sessions[uid]
-            logger.info("Cleaned up {} session".format(uid))
-            if other_id in self.sessions:
-                del self.sessions[other_id]
-                logger.info("Also cleaned up {} session".format(other_id))
-                # If there was a session with this peer, also
-                # close the connection to reset its state.
-                if other_id in self.peers:
-                    logger.info("Closing connection to {}".format(other_id))
-                    wso, oaddr, _ = self.peers[other_id]
-                    del self.peers[other_id]
-                    await wso.close()
-
-    async def cleanup_room(self, uid, room_id):
-        room_peers = self.rooms[room_id]
-        if uid not in room_peers:
+        session = self.peers.end_session(uid)
+        if session is None:
             return
-        room_peers.remove(uid)
-        for pid in room_peers:
-            wsp, paddr, _ = self.peers[pid]
-            msg = 'ROOM_PEER_LEFT {}'.format(uid)
-            logger.info('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-            await wsp.send(msg)
+        other_id = session.other(uid)
+        logger.info("Cleaned up {} session".format(uid))
+        if other_id in self.peers:
+            logger.info("Also cleaned up {} session".format(other_id))
+            # If there was a session with this peer, also
+            # close the connection to reset its state.
+            logger.info("Closing connection to {}".format(other_id))
+            wso = self.peers.remove(other_id).ws
+            await wso.close()
+        else:
+            # The other peer is connected to another worker.
+            logger.info("Closing remote connection to {}".format(other_id))
+            await self.registry.send({"op": "close", "to": other_id})
+
+    async def handle_bus_message(self, msg):
+        """Handles a message sent by another worker to a peer of this worker.
+
+        See peer_registry for the message format.
+        """
+
+        peer = self.peers.get(msg["to"])
+        if peer is None:
+            return
+        op = msg["op"]
+        if op == "relay":
+            await self.send_to(peer, msg["msg"])
+        elif op == "session":
+            other_id = msg["peer"]
+            logger.info("Session from remote {!r} to {!r}".format(other_id, peer.uid))
+            self.peers.start_session(peer.uid, other_id)
+            peer.route = RemoteRoute(self.registry, other_id)
+        elif op == "present":
+            await self.send_to(peer, 'PRESENT {}'.format(msg["peer"]))
+        elif op == "close":
+            # The session partner left, close the connection to reset its state.
+            logger.info("Remote session of {} ended, closing connection".format(peer.uid))
+            self.peers.end_session(peer.uid)
+            self.peers.remove(peer.uid)
+            await peer.ws.close()
+
+    def cleanup_room(self, peer):
+        room = self.peers.leave_room(peer)
+        self.broadcast_room(room, 'ROOM_PEER_LEFT {}'.format(peer.uid))
+
+    def outbox(self, peer):
+        """Returns the outbound queue of a local peer, created on first use.
+        """
+
+        if peer.outbox is None:
+            peer.outbox = PeerOutbox(peer.ws, peer.uid, self.outbox_size)
+        return peer.outbox
+
+    async def send_to(self, peer, msg):
+        """Sends msg to a local peer.
+
+        Once the peer has an outbox everything goes through it, so replies
+        can't overtake the room messages queued before them.
+        """
+
+        if peer.outbox is not None:
+            peer.outbox.post(msg)
+        else:
+            await peer.ws.send(msg)
+
+    def broadcast_room(self, room, msg, exclude=None):
+        """Posts msg to every peer in a room, without waiting for any of them.
+
+        Each peer is written to by its own outbox writer, peers that can't
+        keep up are disconnected when their outbox overflows.
+        """
+
+        logger.info('room {}: -> {} peers: {}'.format(room.room_id, len(room), msg))
+        for pid in room:
+            peer = self.peers.get(pid)
+            if pid != exclude and peer is not None:
+                self.outbox(peer).post(msg)
 
     async def remove_peer(self, uid):
         await self.cleanup_session(uid)
-        if uid in self.peers:
-            ws, raddr, status = self.peers[uid]
-            if status and status != 'session':
-                await self.cleanup_room(uid, status)
-            del self.peers[uid]
-            await ws.close()
-            logger.info("Disconnected from peer {!r} at {!r}".format(uid, raddr))
+        peer = self.peers.get(uid)
+        if peer is not None:
+            if peer.status == STATUS_ROOM:
+                self.cleanup_room(peer)
+            self.peers.remove(uid)
+            await peer.ws.close()
+            logger.info("Disconnected from peer {!r} at {!r}".format(uid, peer.raddr))
+            if peer.outbox is not None:
+                peer.outbox.close()
+        await self.registry.unregister(uid)
+        self.on_peer_removed(uid)
 
     ############### Handler functions ###############
 
     
     async def connection_handler(self, ws, uid):
         raddr = ws.remote_address
-        peer_status = None
-        self.peers[uid] = [ws, raddr, peer_status]
+        peer = self.peers.add(uid, ws, raddr)
         logger.info("Registered peer {!r} at {!r}".format(uid, raddr))
+        self.on_peer_registered(uid)
+        # Only now can it take sessions, tell the peers waiting for it.
+        await self.registry.announce(uid)
         while True:
-            # Receive command, wait forever if necessary
-            msg = await self.recv_msg_ping(ws, raddr)
-            # Update current status
-            peer_status = self.peers[uid][2]
-            # We are in a session or a room, messages must be relayed
-            if peer_status is not None:
-                # We're in a session, route message to connected peer
-                if peer_status == 'session':
-                    other_id = self.sessions[uid]
-                    wso, oaddr, status = self.peers[other_id]
-                    assert(status == 'session')
-                    logger.info("{} -> {}: {}".format(uid, other_id, msg))
-                    await wso.send(msg)
-                # We're in a room, accept room-specific commands
-                elif peer_status:
-                    # ROOM_PEER_MSG peer_id MSG
-                    if msg.startswith('ROOM_PEER_MSG'):
-                        _, other_id, msg = msg.split(maxsplit=2)
-                        if other_id not in self.peers:
-                            await ws.send('ERROR peer {!r} not found'
-                                          ''.format(other_id))
-                            continue
-                        wso, oaddr, status = self.peers[other_id]
-                        if status != room_id:
-                            await ws.send('ERROR peer {!r} is not in the room'
-                                          ''.format(other_id))
-                            continue
-                        msg = 'ROOM_PEER_MSG {} {}'.format(uid, msg)
-                        logger.info('room {}: {} -> {}: {}'.format(room_id, uid, other_id, msg))
-                        await wso.send(msg)
-                    elif msg == 'ROOM_PEER_LIST':
-                        room_id = self.peers[peer_id][2]
-                        room_peers = ' '.join([pid for pid in self.rooms[room_id] if pid != peer_id])
-                        msg = 'ROOM_PEER_LIST {}'.format(room_peers)
-                        logger.info('room {}: -> {}: {}'.format(room_id, uid, msg))
-                        await ws.send(msg)
-                    else:
-                        await ws.send('ERROR invalid msg, already in room')
+            # Receive command, wait forever if necessary. Keepalive pings are
+            # sent by the websocket server, see ping_interval in run().
+            msg = await ws.recv()
+            # Fast path, we're in a session: forward the frame as it is,
+            # text or binary, to the connected peer.
+            wso = peer.route
+            if wso is not None:
+                self.relayed_messages += 1
+                if self.relay_log_interval and self.relayed_messages % self.relay_log_interval == 0:
+                    logger.info("relayed %d messages, last %s -> %s: %d bytes",
+                                self.relayed_messages, uid, self.peers.partner(uid), len(msg))
+                elif logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s -> %s: %d bytes", uid, self.peers.partner(uid), len(msg))
+                await wso.send(msg)
+                continue
+            if isinstance(msg, bytes):
+                logger.info("Ignoring binary message from {!r}".format(uid))
+                continue
+            # We are in a room, messages must be relayed
+            if peer.status == STATUS_ROOM:
+                room = peer.room
+                # ROOM_PEER_MSG peer_id MSG
+                if msg.startswith('ROOM_PEER_MSG'):
+                    _, other_id, msg = msg.split(maxsplit=2)
+                    other = self.peers.get(other_id)
+                    if other is None:
+                        await self.send_to(peer, 'ERROR peer {!r} not found'
+                                           ''.format(other_id))
+                        continue
+                    if other.room is not room:
+                        await self.send_to(peer, 'ERROR peer {!r} is not in the room'
+                                           ''.format(other_id))
                         continue
+                    msg = 'ROOM_PEER_MSG {} {}'.format(uid, msg)
+                    logger.info('room {}: {} -> {}: {}'.format(room.room_id, uid, other_id, msg))
+                    self.outbox(other).post(msg)
+                elif msg == 'ROOM_PEER_LIST':
+                    msg = 'ROOM_PEER_LIST {}'.format(room.peer_list(exclude=uid))
+                    logger.info('room {}: -> {}: {}'.format(room.room_id, uid, msg))
+                    await self.send_to(peer, msg)
                 else:
-                    raise AssertionError('Unknown peer status {!r}'.format(peer_status))
+                    await self.send_to(peer, 'ERROR invalid msg, already in room')
+                    continue
+            elif peer.status == STATUS_SESSION:
+                # The session is being torn down, there is no route anymore.
+                continue
             # Requested a session with a specific peer
             elif msg.startswith('SESSION'):
                 logger.info("{!r} command {!r}".format(uid, msg))
                 _, callee_id = msg.split(maxsplit=1)
-                if callee_id not in self.peers:
-                    await ws.send('ERROR peer {!r} not found'.format(callee_id))
+                callee = self.peers.get(callee_id)
+                if callee is None and not await self.registry.lookup(callee_id):
+                    await self.send_to(peer, 'ERROR peer {!r} not found'.format(callee_id))
+                    continue
+                if peer.status != STATUS_IDLE:
+                    await self.send_to(peer, 'ERROR peer {!r} busy'.format(callee_id))
                     continue
-                if peer_status is not None:
-                    await ws.send('ERROR peer {!r} busy'.format(callee_id))
+                if callee is None:
+                    # Callee is connected to another worker, relay over the registry bus.
+                    await self.send_to(peer, 'SESSION_OK')
+                    logger.info('Session from {!r} ({!r}) to remote {!r}'.format(uid, raddr, callee_id))
+                    self.peers.start_session(uid, callee_id)
+                    peer.route = RemoteRoute(self.registry, callee_id)
+                    await self.registry.send({"op": "session", "to": callee_id, "peer": uid})
                     continue
-                await ws.send('SESSION_OK')
-                wsc = self.peers[callee_id][0]
+                await self.send_to(peer, 'SESSION_OK')
                 logger.info('Session from {!r} ({!r}) to {!r} ({!r})'
-                      ''.format(uid, raddr, callee_id, wsc.remote_address))
+                      ''.format(uid, raddr, callee_id, callee.raddr))
                 # Register session
-                self.peers[uid][2] = peer_status = 'session'
-                self.sessions[uid] = callee_id
-                self.peers[callee_id][2] = 'session'
-                self.sessions[callee_id] = uid
+                self.peers.start_session(uid, callee_id)
+                # Precompute the routes used by the relay fast path.
+                peer.route = callee.ws
+                callee.route = ws
+            # Asked to be told when a peer registers, instead of polling with SESSION
+            elif msg.startswith('WATCH'):
+                logger.info("{!r} command {!r}".format(uid, msg))
+                _, watched_id = msg.split(maxsplit=1)
+                if await self.registry.watch(watched_id, uid):
+                    await self.send_to(peer, 'PRESENT {}'.format(watched_id))
             # Requested joining or creation of a room
             elif msg.startswith('ROOM'):
                 logger.info('{!r} command {!r}'.format(uid, msg))
                 _, room_id = msg.split(maxsplit=1)
                 # Room name cannot be 'session', empty, or contain whitespace
                 if room_id == 'session' or room_id.split() != [room_id]:
-                    await ws.send('ERROR invalid room id {!r}'.format(room_id))
+                    await self.send_to(peer, 'ERROR invalid room id {!r}'.format(room_id))
                     continue
-                if room_id in self.rooms:
-                    if uid in self.rooms[room_id]:
-                        raise AssertionError('How did we accept a ROOM command '
-                                             'despite already being in a room?')
-                else:
-                    # Create room if required
-                    self.rooms[room_id] = set()
-                room_peers = ' '.join([pid for pid in self.rooms[room_id]])
-                await ws.send('ROOM_OK {}'.format(room_peers))
+                room = self.peers.rooms.get(room_id)
+                await self.send_to(peer, 'ROOM_OK {}'.format(room.peer_list() if room is not None else ''))
                 # Enter room
-                self.peers[uid][2] = peer_status = room_id
-                self.rooms[room_id].add(uid)
-                for pid in self.rooms[room_id]:
-                    if pid == uid:
-                        continue
-                    wsp, paddr, _ = self.peers[pid]
-                    msg = 'ROOM_PEER_JOINED {}'.format(uid)
-                    logger.info('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-                    await wsp.send(msg)
+                room = self.peers.join_room(uid, room_id)
+                self.broadcast_room(room, 'ROOM_PEER_JOINED {}'.format(uid), exclude=uid)
             else:
                 logger.info('Ignoring unknown message {!r} from {!r}'.format(msg, uid))
 
@@ -317,8 +460,16 @@ class WebRTCSimpleServer(object):
         if not uid or uid in self.peers or uid.split() != [uid]: # no whitespace
             await ws.close(code=1002, reason='invalid peer uid')
             raise Exception("Invalid uid {!r} from {!r}".format(uid, raddr))
-        # Send back a HELLO
-        await ws.send('HELLO')
+        # The uid must also be unique across all signalling workers.
+        if not await self.registry.register(uid):
+            await ws.close(code=1002, reason='invalid peer uid')
+            raise Exception("Duplicate uid {!r} from {!r}".format(uid, raddr))
+        # Send back a HELLO, the uid must not stay claimed if the peer is gone.
+        try:
+            await ws.send('HELLO')
+        except BaseException:
+            await self.registry.unregister(uid)
+            raise
         return uid
 
     def get_ssl_certs(self):
@@ -347,21 +498,30 @@ class WebRTCSimpleServer(object):
         sslctx.verify_mode = ssl.CERT_NONE
         return sslctx
 
-    def run(self):
-        async def handler(ws, path):
-            '''
-            All incoming messages are handled here. @path is unused.
-            '''
-            raddr = ws.remote_address
-            logger.info("Connected to {!r}".format(raddr))
-            peer_id = await self.hello_peer(ws)
-            try:
-                await self.connection_handler(ws, peer_id)
-            except websockets.ConnectionClosed:
-                logger.info("Connection to peer {!r} closed, exiting handler".format(raddr))
-            finally:
-                await self.remove_peer(peer_id)
+    async def handle_connection(self, ws, path=None):
+        '''
+        All incoming messages are handled here. @path is unused.
+        '''
+        raddr = ws.remote_address
+        logger.info("Connected to {!r}".format(raddr))
+        peer_id = await self.hello_peer(ws)
+        try:
+            await self.connection_handler(ws, peer_id)
+        except websockets.ConnectionClosed:
+            logger.info("Connection to peer {!r} closed, exiting handler".format(raddr))
+        finally:
+            await self.remove_peer(peer_id)
+
+    def connect_local(self):
+        '''
+        Opens an in-process connection, handled like a websocket connection
+        without going through the network. See local_signalling.
+        '''
+        client, server_end = local_connection_pair()
+        self.loop.create_task(self.handle_connection(server_end))
+        return client
 
+    def run(self):
         sslctx = self.get_ssl_ctx()
 
         # Setup logging
@@ -374,13 +534,24 @@ class WebRTCSimpleServer(object):
             logger.info("Listening on https://{}:{}".format(self.addr, self.port))
         # Websocket and HTTP server
         http_handler = functools.partial(self.process_request)
-        wsd = websockets.serve(handler, self.addr, self.port, ssl=sslctx, process_request=http_handler,
+        wsd = websockets.serve(self.handle_connection, self.addr, self.port, ssl=sslctx, process_request=http_handler,
                                # Maximum number of messages that websockets will pop
                                # off the asyncio and OS buffers per connection. See:
                                # https://websockets.readthedocs.io/en/stable/api.html#websockets.protocol.WebSocketCommonProtocol
-                               max_queue=16)
+                               max_queue=16,
+                               # Keepalive ping to prevent bad routers from closing
+                               # idle connections, a missing pong never closes it.
+                               ping_interval=self.keepalive_timeout, ping_timeout=None,
+                               # Lets several signalling workers share the port.
+                               reuse_port=self.reuse_port)
+
+        # Load the RTC config file and reload it when it changes.
+        if self.rtc_config_file is not None and self.rtc_config_task is None:
+            self.rtc_config_file.check()
+            self.rtc_config_task = self.loop.create_task(self.rtc_config_file.watch())
 
         # Run the server
+        self.loop.run_until_complete(self.registry.attach(self))
         self.server = self.loop.run_until_complete(wsd)
         logger.info("websocket server started")
         # Stop the server if certificate changes
@@ -416,12 +587,23 @@ class WebRTCSimpleServer(object):
                 return
 
 
+def run_worker(options):
+    """Runs one signalling worker registered with the peer registry hub.
+    """
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    r = WebRTCSimpleServer(loop, options, registry=UnixSocketPeerRegistry(options.registry_socket))
+    r.run()
+    loop.run_forever()
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # See: host, port in https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.create_server
     parser.add_argument('--addr', default='', help='Address to listen on (default: all interfaces, both ipv4 and ipv6)')
     parser.add_argument('--port', default=8443, type=int, help='Port to listen on')
-    parser.add_argument('--web_root', default=os.getcwd(), type=str, help='Path to web root')
+    parser.add_argument('--web_root', default='', type=str, help='Path to web root, empty to serve no files')
     parser.add_argument('--rtc_config_file', default="/tmp/rtc.json", type=str, help='Path to json rtc config file')
     parser.add_argument('--rtc_config', default="", type=str, help='JSON rtc config data')
     parser.add_argument('--turn_shared_secret', default="", type=str, help='shared secret for generating TURN HMAC credentials')
@@ -431,18 +613,40 @@ def main():
     parser.add_argument('--enable_turn_tls', default=False, dest='turn_tls', action='store_true', help='enable TURN over TLS (for the TCP protocol) or TURN over DTLS (for the UDP protocol), valid TURN server certificate required.')
     parser.add_argument('--turn_auth_header_name', default="x-auth-user", type=str, help='auth header for turn credentials')
     parser.add_argument('--keepalive-timeout', dest='keepalive_timeout', default=30, type=int, help='Timeout for keepalive (in seconds)')
+    parser.add_argument('--relay_log_interval', default=1000, type=int, help='Log one relayed message every N messages, 0 to disable')
+    parser.add_argument('--outbox_size', default=256, type=int, help='Room messages queued for a peer before it is disconnected as a slow consumer')
     parser.add_argument('--cert-path', default=os.path.dirname(__file__))
     parser.add_argument('--disable-ssl', default=False, help='Disable ssl', action='store_true')
     parser.add_argument('--health', default='/health', help='Health check route')
+    parser.add_argument('--metrics', default='/metrics', help='Metrics route in the Prometheus text format, empty to disable')
     parser.add_argument('--restart-on-cert-change', default=False, dest='cert_restart', action='store_true', help='Automatically restart if the SSL certificate changes')
     parser.add_argument('--enable_basic_auth', default="false", help="Use basic auth, must also set basic_auth_user, and basic_auth_password args")
     parser.add_argument('--basic_auth_user', default="", help='Username for basic auth.')
     parser.add_argument('--basic_auth_password', default="", help='Password for basic auth, if not set, no authorization will be enforced.')
+    parser.add_argument('--reuse_port', default=False, action='store_true', help='Set SO_REUSEPORT on the listening socket')
+    parser.add_argument('--workers', default=1, type=int, help='Number of signalling worker processes sharing the port')
+    parser.add_argument('--registry_socket', default='/tmp/webrtc-signalling-registry.sock', type=str, help='Unix socket of the peer registry shared by the workers')
 
     options = parser.parse_args(sys.argv[1:])
 
     loop = asyncio.get_event_loop()
 
+    if options.workers > 1:
+        # The workers share the port with SO_REUSEPORT, the kernel spreads the
+        # connections over them and the registry hub relays between them.
+        options.reuse_port = True
+        if os.path.exists(options.registry_socket):
+            os.unlink(options.registry_socket)
+        hub = PeerRegistryHub(options.registry_socket)
+        loop.run_until_complete(hub.start())
+        ctx = multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_worker, args=(options,), daemon=True) for _ in range(options.workers)]
+        for worker in workers:
+            worker.start()
+        print('Started {} signalling workers...'.format(options.workers))
+        loop.run_forever()
+        return
+
     r = WebRTCSimpleServer(loop, options)
 
     print('Starting server...')
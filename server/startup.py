@@ -0,0 +1,396 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import platform
+import threading
+import time
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from metrics import MetricFamily, GAUGE
+
+logger = logging.getLogger("startup")
+logger.setLevel(logging.INFO)
+
+"""Cold start of the server: GStreamer init, plugin checks and readiness
+
+Importing the server used to initialize GStreamer, and every GSTWebRTCApp
+initialized it again and looked its plugins up in the registry. Now
+init_gstreamer() runs Gst.init once, the first time something needs it,
+usually on an executor thread started by WebRTCSessionManager.start() while
+the signalling server comes up. A supervisor process never initializes it.
+
+PluginCache remembers which plugins are installed in a JSON file, keyed by
+the path and mtime of the GStreamer registry and the plugin path variables:
+GStreamer rewrites the registry when plugins change, so a restart with the
+same plugins checks them without initializing GStreamer at all.
+
+wait_for_file() waits for a file with inotify on its nearest existing
+directory instead of polling, and falls back to polling where inotify isn't
+available. startup_timer records how long each step took since the process
+started, and logs a report once the server is ready.
+
+    Usage example:
+    with startup_timer.phase("app_ready"):
+        await wait_for_file("/var/run/appconfig/appready", loop)
+    missing = plugin_cache.missing(["webrtc", "nice"])
+    init_gstreamer()
+    startup_timer.ready()
+
+"""
+
+GST_INSTALL_HELP = """
+ERROR: could not find working gst-python installation.
+
+If GStreamer is installed at a certain location, set its path to the environment variable $GSTREAMER_PATH, then make sure your environment is set correctly using the below commands:
+
+export PATH=${GSTREAMER_PATH}/bin:${PATH}
+export LD_LIBRARY_PATH=${GSTREAMER_PATH}/lib/x86_64-linux-gnu:${LD_LIBRARY_PATH}
+export GI_TYPELIB_PATH=${GSTREAMER_PATH}/lib/x86_64-linux-gnu/girepository-1.0:/usr/lib/x86_64-linux-gnu/girepository-1.0:${GI_TYPELIB_PATH}
+GST_PY_PATH=$(find ${GSTREAMER_PATH}/lib -type d -name "python3.*")
+export PYTHONPATH=${GST_PY_PATH}/site-packages:${GSTREAMER_PATH}/lib/python3/dist-packages:${PYTHONPATH}
+"""
+
+# Environment variables changing the set of plugins GStreamer loads.
+PLUGIN_PATH_VARIABLES = ("GST_PLUGIN_PATH", "GST_PLUGIN_PATH_1_0", "GST_PLUGIN_SYSTEM_PATH",
+                         "GST_PLUGIN_SYSTEM_PATH_1_0")
+
+# inotify(7) constants.
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+
+class GStreamerInitError(Exception):
+    pass
+
+
+def process_start_time():
+    """Returns the wall clock time this process started at, from /proc where available.
+    """
+
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name can contain spaces, the fields start after it.
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class StartupTimer:
+    def __init__(self, started=None):
+        """Initialize the timer of this process.
+
+        Arguments:
+            started {float} -- wall clock time of the start of the process, from /proc by default.
+        """
+
+        self.started = started if started is not None else process_start_time()
+        self.lock = threading.Lock()
+        # Format: {phase name: (seconds since start when it began, duration in seconds)}
+        self.phases = collections.OrderedDict()
+        self.ready_after = None
+
+    def record(self, name, began, ended):
+        """Records a phase from wall clock times, and logs it if it ended after the report.
+        """
+
+        with self.lock:
+            self.phases[name] = (began - self.started, ended - began)
+            late = self.ready_after is not None
+        if late:
+            logger.info("startup: %s took %.3fs, done %.3fs after start" % (name, ended - began, ended - self.started))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, began, time.time())
+
+    def ready(self):
+        """Marks the process as ready to accept sessions, and logs the report.
+        """
+
+        with self.lock:
+            if self.ready_after is not None:
+                return
+            self.ready_after = time.time() - self.started
+        logger.info(self.report())
+
+    def report(self):
+        with self.lock:
+            phases = list(self.phases.items())
+            ready_after = self.ready_after
+        lines = ["startup timing (seconds since process start):"]
+        for name, (began, duration) in sorted(phases, key=lambda p: p[1][0]):
+            lines.append("  %-16s %7.3fs  at %7.3fs" % (name, duration, began))
+        if ready_after is not None:
+            lines.append("  %-16s %7.3fs" % ("ready", ready_after))
+        return "\n".join(lines)
+
+    def families(self):
+        with self.lock:
+            phases = list(self.phases.items())
+            ready_after = self.ready_after
+        durations = MetricFamily("webrtc_startup_phase_seconds", GAUGE, "Duration of each startup phase.")
+        for name, (began, duration) in phases:
+            durations.add(duration, {"phase": name})
+        families = [durations]
+        if ready_after is not None:
+            families.append(MetricFamily("webrtc_startup_ready_seconds", GAUGE,
+                                         "Time from the start of the process until it accepted sessions.").add(ready_after))
+        return families
+
+
+startup_timer = StartupTimer()
+
+gst_init_lock = threading.Lock()
+gst_initialized = False
+
+
+def init_gstreamer():
+    """Initializes GStreamer once per process, safe to call from any thread.
+
+    Raises:
+        GStreamerInitError -- if GStreamer can't be initialized.
+    """
+
+    global gst_initialized
+    if gst_initialized:
+        return
+    with gst_init_lock:
+        if gst_initialized:
+            return
+        with startup_timer.phase("gst_init"):
+            try:
+                Gst.init(None)
+            except Exception as e:
+                logger.error(GST_INSTALL_HELP)
+                raise GStreamerInitError("failed to initialize GStreamer: %s" % e)
+        gst_initialized = True
+        logger.info("initialized %s" % Gst.version_string())
+
+
+def user_cache_dir():
+    return os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+
+def registry_path():
+    """Returns the path of the GStreamer registry file, as GStreamer picks it.
+    """
+
+    path = os.environ.get("GST_REGISTRY_1_0") or os.environ.get("GST_REGISTRY")
+    if path:
+        return path
+    return os.path.join(user_cache_dir(), "gstreamer-1.0", "registry.%s.bin" % platform.machine())
+
+
+def default_plugin_cache_path():
+    return os.path.join(user_cache_dir(), "selkies-gstreamer", "plugins.json")
+
+
+class PluginCache:
+    def __init__(self, path=None):
+        """Initialize the cache, the file is read on the first check.
+
+        Arguments:
+            path {string} -- path of the JSON cache file, see default_plugin_cache_path().
+        """
+
+        self.path = path or default_plugin_cache_path()
+        # Sessions check their plugins from GStreamer threads and the
+        # executor, the lock guards plugins and the cache file.
+        self.lock = threading.Lock()
+        # Format: {plugin name: bool}, valid for the registry of this process.
+        self.plugins = None
+
+    def key(self):
+        """Returns what the cached results depend on, None if there is no registry yet.
+        """
+
+        path = registry_path()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return {
+            "registry": path,
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "env": {name: os.environ.get(name) for name in PLUGIN_PATH_VARIABLES},
+        }
+
+    def load(self):
+        key = self.key()
+        if key is None:
+            return dict()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        if data.get("key") != key:
+            logger.info("GStreamer registry changed, checking plugins again")
+            return dict()
+        return data.get("plugins", dict())
+
+    def save(self):
+        key = self.key()
+        if key is None:
+            return
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"key": key, "plugins": self.plugins}, f)
+            # Atomic, so workers starting together never read half a file.
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("failed to save the plugin cache %s: %s" % (self.path, e))
+
+    def missing(self, required):
+        """Returns the required plugins that aren't installed.
+
+        Only the plugins that aren't cached as installed are looked up in
+        the registry, which initializes GStreamer.
+
+        Arguments:
+            required {list of string} -- names of the plugins.
+
+        Returns:
+            list of string -- the missing plugins, in the order of required.
+        """
+
+        with self.lock:
+            first = self.plugins is None
+            if first:
+                self.plugins = self.load()
+            # Only installed plugins are trusted, a missing one may have been
+            # installed since without the registry being rebuilt yet.
+            unknown = [p for p in required if not self.plugins.get(p)]
+            if unknown:
+                with startup_timer.phase("plugin_check"):
+                    init_gstreamer()
+                    registry = Gst.Registry.get()
+                    for p in unknown:
+                        self.plugins[p] = registry.find_plugin(p) is not None
+                self.save()
+            elif first:
+                logger.info("plugins found in cache %s" % self.path)
+            return [p for p in required if not self.plugins[p]]
+
+
+plugin_cache = PluginCache()
+
+
+class Inotify:
+    def __init__(self):
+        """Opens an inotify instance.
+
+        Raises:
+            OSError -- if inotify isn't available.
+        """
+
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on %s" % path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def drain(self):
+        """Reads all pending events, only their arrival matters here.
+        """
+
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    return
+            except BlockingIOError:
+                return
+
+    def close(self):
+        os.close(self.fd)
+
+
+def nearest_directory(path):
+    """Returns the deepest existing directory on the way to path.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return directory
+
+
+async def wait_for_file(path, loop, poll_interval=0.2):
+    """Returns once the file at path exists.
+
+    Watches the deepest existing directory on the way to the file with
+    inotify, and moves down as the missing directories are created.
+
+    Arguments:
+        path {string} -- path of the file.
+        loop {asyncio.AbstractEventLoop} -- loop to wait on.
+        poll_interval {float} -- seconds between checks where inotify isn't available.
+    """
+
+    try:
+        inotify = Inotify()
+    except OSError as e:
+        logger.info("inotify unavailable (%s), polling for %s" % (e, path))
+        while not os.path.exists(path):
+            await asyncio.sleep(poll_interval)
+        return
+
+    try:
+        while True:
+            directory = nearest_directory(path)
+            wd = inotify.add_watch(directory, IN_CREATE | IN_MOVED_TO | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+            try:
+                # Checked after the watch is in place so a file created in between isn't missed.
+                if os.path.exists(path):
+                    return
+                readable = loop.create_future()
+                loop.add_reader(inotify.fd, lambda: readable.done() or readable.set_result(None))
+                try:
+                    await readable
+                finally:
+                    loop.remove_reader(inotify.fd)
+                inotify.drain()
+            finally:
+                inotify.rm_watch(wd)
+    finally:
+        inotify.close()
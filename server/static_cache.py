@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import gzip
+import hashlib
+import logging
+import os
+import posixpath
+import time
+import urllib.parse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger("static_cache")
+logger.setLevel(logging.INFO)
+
+"""In-memory cache of the web root served by the signalling server
+
+A file is read, hashed and compressed the first time it's requested and
+served from memory afterwards. Its mtime is checked at most once every
+check_interval seconds, a changed file is loaded again. gzip variants are
+always precomputed, brotli ones when the brotli module is installed.
+
+    Usage example:
+    cache = StaticAssetCache(web_root, mime_types=MIME_TYPES)
+    asset = cache.get('/app.js')
+    encoding, body = asset.variant(request_headers.get('Accept-Encoding', ''))
+
+"""
+
+# Content types worth compressing, others are served as they are.
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Smaller bodies don't shrink enough to be worth a Content-Encoding.
+MIN_COMPRESS_SIZE = 256
+
+
+class StaticAsset:
+    __slots__ = ('path', 'mtime', 'size', 'mime_type', 'etag', 'variants', 'checked')
+
+    def __init__(self, path, mime_type):
+        """A cached file with its precompressed variants.
+
+        Arguments:
+            path {string} -- path of the file on disk.
+            mime_type {string} -- Content-Type of the file.
+        """
+
+        self.path = path
+        self.mime_type = mime_type
+        self.load()
+
+    def load(self):
+        st = os.stat(self.path)
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        # Format: {encoding: body}, "identity" is the file as it is.
+        self.variants = {"identity": body}
+        if self.mime_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= MIN_COMPRESS_SIZE:
+            self.add_variant("gzip", gzip.compress(body, compresslevel=9, mtime=0))
+            if brotli is not None:
+                self.add_variant("br", brotli.compress(body, quality=11))
+        self.checked = time.monotonic()
+
+    def add_variant(self, encoding, body):
+        if len(body) < len(self.variants["identity"]):
+            self.variants[encoding] = body
+
+    def changed(self):
+        """Returns True if the file on disk differs from the cached one.
+
+        Raises:
+            OSError -- if the file can't be accessed anymore.
+        """
+
+        st = os.stat(self.path)
+        self.checked = time.monotonic()
+        return st.st_mtime_ns != self.mtime or st.st_size != self.size
+
+    def etag_for(self, encoding):
+        """Returns the ETag of a variant, each encoding has its own.
+        """
+
+        if encoding == "identity":
+            return self.etag
+        return self.etag[:-1] + '-' + encoding + '"'
+
+    def matches(self, if_none_match):
+        """Returns True if an If-None-Match header matches a variant of the file.
+        """
+
+        if if_none_match.strip() == '*':
+            return True
+        tags = set(tag.strip().replace('W/', '', 1) for tag in if_none_match.split(','))
+        return any(self.etag_for(encoding) in tags for encoding in self.variants)
+
+    def variant(self, accept_encoding):
+        """Picks the compressed variant the client accepts, brotli before gzip.
+
+        Arguments:
+            accept_encoding {string} -- value of the Accept-Encoding header.
+
+        Returns:
+            tuple -- (encoding, body), encoding is "identity" for the plain file.
+        """
+
+        accepted = set()
+        for item in accept_encoding.lower().split(','):
+            coding, _, params = item.partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(coding.strip())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+
+class StaticAssetCache:
+    def __init__(self, web_root, mime_types, check_interval=60, index="index.html"):
+        """Initialize an empty cache.
+
+        Arguments:
+            web_root {string} -- directory the files are served from.
+            mime_types {dict} -- {extension: Content-Type}, files with other extensions aren't served.
+            check_interval {float} -- seconds between mtime checks of a cached file, 0 checks on every request.
+            index {string} -- file served for directory paths.
+        """
+
+        self.web_root = os.path.realpath(web_root)
+        self.mime_types = mime_types
+        self.check_interval = check_interval
+        self.index = index
+        # Format: {normalized path: StaticAsset}
+        self.assets = dict()
+
+    def normalize(self, url_path):
+        """Returns the decoded request path without query, '.' and '..' segments.
+        """
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url_path).path)
+        if path.endswith('/'):
+            path += self.index
+        return posixpath.normpath('/' + path.lstrip('/'))
+
+    def resolve(self, path):
+        """Maps a normalized request path to a file under the web root.
+
+        Only files with an extension of mime_types are served, and none under
+        a hidden directory or hidden themselves, such as .git.
+
+        Returns:
+            string -- the path of the file, or None if it's outside the web root, not a file
+                                    or not a client asset.
+        """
+
+        if any(part.startswith('.') for part in path.split('/') if part):
+            return None
+        full_path = os.path.realpath(os.path.join(self.web_root, path.lstrip('/')))
+        if os.path.commonpath((self.web_root, full_path)) != self.web_root:
+            return None
+        if os.path.splitext(full_path)[1].lstrip('.') not in self.mime_types:
+            return None
+        if not os.path.isfile(full_path):
+            return None
+        return full_path
+
+    def get(self, url_path):
+        """Returns the cached file of a request path, loading it if required.
+
+        Returns:
+            StaticAsset -- the file, or None if there is no such file.
+        """
+
+        path = self.normalize(url_path)
+        asset = self.assets.get(path)
+        if asset is not None:
+            if time.monotonic() - asset.checked < self.check_interval:
+                return asset
+            try:
+                if not asset.changed():
+                    return asset
+                logger.info("reloading changed file %s" % asset.path)
+                asset.load()
+                return asset
+            except OSError:
+                del self.assets[path]
+
+        full_path = self.resolve(path)
+        if full_path is None:
+            return None
+        extension = os.path.splitext(full_path)[1].lstrip('.')
+        mime_type = self.mime_types[extension]
+        try:
+            asset = StaticAsset(full_path, mime_type)
+        except OSError as e:
+            logger.warning("failed to load %s: %s" % (full_path, e))
+            return None
+        self.assets[path] = asset
+        logger.info("cached %s: %d bytes, variants: %s" % (
+            full_path, asset.size, ", ".join("%s %d" % (k, len(v)) for k, v in asset.variants.items())))
+        return asset
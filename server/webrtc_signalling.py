@@ -19,9 +19,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import asyncio
 import base64
 import json
 import logging
+import random
 import websockets
 
 logger = logging.getLogger("signalling")
@@ -38,6 +40,11 @@ Interfaces with signalling server found at:
     signalling.connect()
     signalling.start()
 
+When the peer isn't registered yet, watch_peer() asks the server to send
+PRESENT <peer_id> as soon as it is, on_peer_present then fires and the call
+can be set up right away instead of retrying on a timer. Backoff spaces out
+reconnection attempts without blocking the event loop.
+
 """
 
 
@@ -49,14 +56,50 @@ class WebRTCSignallingErrorNoPeer(Exception):
     pass
 
 
+class Backoff:
+    def __init__(self, initial=0.1, maximum=10.0, factor=2.0, jitter=0.2):
+        """Exponential backoff between retries.
+
+        Arguments:
+            initial {float} -- seconds before the first retry.
+            maximum {float} -- upper bound of the delay in seconds.
+            factor {float} -- growth of the delay after each attempt.
+            jitter {float} -- fraction of the delay randomized, so clients
+                                    that failed together don't retry together.
+        """
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def delay(self):
+        """Returns the delay before the next attempt and counts the attempt.
+        """
+
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+    async def wait(self):
+        await asyncio.sleep(self.delay())
+
+
 class WebRTCSignalling:
-    def __init__(self, server, id, peer_id, enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None):
+    def __init__(self, server, id, peer_id, enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None,
+                 local_server=None):
         """Initialize the signalling instnance
 
         Arguments:
             server {string} -- websocket URI to connect to, example: ws://127.0.0.1:8080
-            id {integer} -- ID of this client when registering.
-            peer_id {integer} -- ID of peer to connect to.
+            id {string} -- ID of this client when registering.
+            peer_id {string} -- ID of peer to connect to.
+            local_server {WebRTCSimpleServer} -- Optional server in this process, connected to
+                                    in process instead of on server, see local_signalling.
         """
 
         self.server = server
@@ -65,6 +108,7 @@ class WebRTCSignalling:
         self.enable_basic_auth = enable_basic_auth
         self.basic_auth_user = basic_auth_user
         self.basic_auth_password = basic_auth_password
+        self.local_server = local_server
         self.conn = None
 
         self.on_ice = lambda mlineindex, candidate: logger.warn(
@@ -73,6 +117,7 @@ class WebRTCSignalling:
         self.on_connect = lambda: logger.warn('unhandled on_connect callback')
         self.on_disconnect = lambda: logger.warn('unhandled on_disconnect callback')
         self.on_session = lambda: logger.warn('unhandled on_session callback')
+        self.on_peer_present = lambda: logger.warn('unhandled on_peer_present callback')
         self.on_error = lambda v: logger.warn(
             'unhandled on_error callback: %s', v)
 
@@ -83,7 +128,16 @@ class WebRTCSignalling:
 
         """
         logger.debug("setting up call")
-        await self.conn.send('SESSION %d' % self.peer_id)
+        await self.conn.send('SESSION %s' % self.peer_id)
+
+    async def watch_peer(self):
+        """Asks the server to send PRESENT once the peer is registered
+
+        The server replies right away if the peer is already registered.
+
+        """
+        logger.debug("watching for peer %s" % self.peer_id)
+        await self.conn.send('WATCH %s' % self.peer_id)
 
     async def connect(self):
         """Connects to and registers id with signalling server
@@ -92,6 +146,10 @@ class WebRTCSignalling:
 
         """
         try:
+            if self.local_server is not None:
+                self.conn = self.local_server.connect_local()
+                await self.conn.send('HELLO %s' % self.id)
+                return
             headers = None
             if self.enable_basic_auth:
                 auth64 = base64.b64encode(bytes("{}:{}".format(self.basic_auth_user, self.basic_auth_password), "ascii")).decode("ascii")
@@ -99,7 +157,7 @@ class WebRTCSignalling:
                     ("Authorization", "Basic {}".format(auth64))
                 ]
             self.conn = await websockets.connect(self.server, extra_headers=headers)
-            await self.conn.send('HELLO %d' % self.id)
+            await self.conn.send('HELLO %s' % self.id)
         except websockets.ConnectionClosed:
             self.on_disconnect()
        
@@ -138,6 +196,7 @@ class WebRTCSignalling:
 
         Message types:
           HELLO: response from server indicating peer is registered.
+          PRESENT: the watched peer is registered, see watch_peer().
           ERROR*: error messages from server.
           {"sdp": ...}: JSON SDP message
           {"ice": ...}: JSON ICE message
@@ -146,6 +205,7 @@ class WebRTCSignalling:
 
         on_connect: fired when HELLO is received.
         on_session: fired after setup_call() succeeds and SESSION_OK is received.
+        on_peer_present: fired after watch_peer() once the peer is registered.
         on_error(WebRTCSignallingErrorNoPeer): fired when setup_call() failes and peer not found message is received.
         on_error(WebRTCSignallingError): fired when message parsing failes or unexpected message is received.
 
@@ -157,6 +217,9 @@ class WebRTCSignalling:
             elif message == 'SESSION_OK':
                 logger.info("started session with peer: %s", self.peer_id)
                 self.on_session()
+            elif message == 'PRESENT %s' % self.peer_id:
+                logger.info("peer %s is present" % self.peer_id)
+                await self.on_peer_present()
             elif message.startswith('ERROR'):
                 if message == "ERROR peer '%s' not found" % self.peer_id:
                     await self.on_error(WebRTCSignallingErrorNoPeer("'%s' not found" % self.peer_id))
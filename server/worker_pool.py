@@ -0,0 +1,324 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import multiprocessing
+import sys
+
+from jitter_tuning import JitterBufferTuning
+from metrics import MetricFamily, GAUGE
+from session_manager import WebRTCSessionManager
+from startup import GStreamerInitError, startup_timer
+
+logger = logging.getLogger("worker_pool")
+logger.setLevel(logging.INFO)
+
+"""Process pool running the media sessions outside of the signalling process
+
+The supervisor keeps the signalling server in the main process and places
+every new browser session on the least loaded worker process. Each worker
+runs its own event loop and WebRTCSessionManager, so a stalled pipeline or a
+GIL heavy callback only affects the sessions of that worker.
+
+Commands are sent to the workers over a multiprocessing pipe, SDP and ICE
+are relayed by the workers' signalling clients over the local websocket.
+The workers send their metrics back over the same pipe every stats
+interval.
+
+    Usage example:
+    pool = WebRTCWorkerPool(4, manager_args, manager_kwargs)
+    pool.start(loop)
+    server.on_peer_registered = pool.on_peer_registered
+    server.on_peer_removed = pool.on_peer_removed
+
+"""
+
+CMD_START = 'start'
+CMD_STOP = 'stop'
+CMD_EXIT = 'exit'
+CMD_TRACE_ON = 'trace-on'
+CMD_TRACE_OFF = 'trace-off'
+CMD_TUNE = 'tune'
+
+MSG_METRICS = 'metrics'
+
+# Exit code of a worker that couldn't initialize GStreamer, it isn't restarted.
+WORKER_INIT_FAILED = 3
+
+
+def worker_main(conn, manager_args, manager_kwargs, log_level):
+    """Entry point of a worker process.
+
+    Runs a WebRTCSessionManager and starts or stops sessions as commands
+    arrive from the supervisor.
+
+    Arguments:
+        conn {multiprocessing.connection.Connection} -- command pipe from the supervisor.
+        manager_args {tuple} -- positional arguments of WebRTCSessionManager.
+        manager_kwargs {dict} -- keyword arguments of WebRTCSessionManager.
+        log_level {integer} -- logging level of the worker.
+    """
+
+    logging.basicConfig(level=log_level)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    manager = WebRTCSessionManager(*manager_args, **manager_kwargs)
+    manager.start(loop)
+
+    def on_command():
+        try:
+            while conn.poll():
+                cmd, peer_id, args = conn.recv()
+                if cmd == CMD_START:
+                    manager.on_peer_registered(peer_id)
+                elif cmd == CMD_STOP:
+                    manager.on_peer_removed(peer_id)
+                elif cmd in (CMD_TRACE_ON, CMD_TRACE_OFF):
+                    manager.set_latency_tracing(peer_id, cmd == CMD_TRACE_ON)
+                elif cmd == CMD_TUNE:
+                    try:
+                        manager.tune_session(peer_id, **args)
+                    except Exception as e:
+                        logger.error("session %s: failed to tune: %s" % (peer_id, e))
+                elif cmd == CMD_EXIT:
+                    loop.stop()
+                    return
+        except EOFError:
+            # Supervisor went away, nothing left to serve.
+            loop.stop()
+
+    async def send_metrics(interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                conn.send((MSG_METRICS, manager.metrics()))
+            except (BrokenPipeError, OSError):
+                return
+
+    loop.add_reader(conn.fileno(), on_command)
+    # Ready once commands are read, GStreamer may still be initializing.
+    loop.call_soon(startup_timer.ready)
+    stats_interval = manager_kwargs.get('stats_interval', 5)
+    if stats_interval:
+        loop.create_task(send_metrics(stats_interval))
+    try:
+        loop.run_forever()
+    finally:
+        loop.remove_reader(conn.fileno())
+        loop.run_until_complete(manager.stop())
+        loop.close()
+    if manager.init_error is not None:
+        sys.exit(WORKER_INIT_FAILED)
+
+
+class WebRTCWorker:
+    def __init__(self, index, process, conn):
+        """Supervisor side handle of a worker process.
+
+        Arguments:
+            index {integer} -- index of the worker in the pool.
+            process {multiprocessing.Process} -- the worker process.
+            conn {multiprocessing.connection.Connection} -- command pipe to the worker.
+        """
+
+        self.index = index
+        self.process = process
+        self.conn = conn
+        # Browser peer ids with a session on this worker.
+        self.peers = set()
+        # Latest metric families sent by the worker.
+        self.metrics = []
+
+    def send(self, cmd, peer_id=None, args=None):
+        self.conn.send((cmd, peer_id, args))
+
+
+class WebRTCWorkerPool:
+    def __init__(self, num_workers, manager_args, manager_kwargs=None, log_level=logging.INFO):
+        """Initialize the worker pool.
+
+        Arguments:
+            num_workers {integer} -- number of worker processes to start.
+            manager_args {tuple} -- positional arguments of each worker's WebRTCSessionManager.
+            manager_kwargs {dict} -- keyword arguments of each worker's WebRTCSessionManager.
+            log_level {integer} -- logging level of the workers.
+        """
+
+        if num_workers < 1:
+            raise ValueError("worker pool needs at least one worker")
+
+        self.num_workers = num_workers
+        self.manager_args = tuple(manager_args)
+        self.manager_kwargs = dict(manager_kwargs or {})
+        self.log_level = log_level
+        self.server_peer_prefix = self.manager_kwargs.get('server_peer_prefix', 'gst-')
+        # Limit of the whole pool, the workers never see more sessions than that.
+        self.max_sessions = self.manager_kwargs.get('max_sessions', 0)
+
+        # GStreamer is not fork safe, always start workers from a fresh interpreter.
+        self.ctx = multiprocessing.get_context('spawn')
+        self.loop = None
+        self.workers = []
+        # Format: {browser_peer_id: WebRTCWorker}
+        self.placements = dict()
+        self.stopping = False
+        # Set when a worker couldn't initialize GStreamer, the others would
+        # fail the same way so the supervisor's loop is stopped.
+        self.init_error = None
+
+    def spawn_worker(self, index):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=worker_main, name="webrtc-worker-%d" % index,
+            args=(child_conn, self.manager_args, self.manager_kwargs, self.log_level),
+            daemon=True)
+        process.start()
+        child_conn.close()
+        worker = WebRTCWorker(index, process, parent_conn)
+        self.loop.add_reader(process.sentinel, self.on_worker_exit, worker)
+        self.loop.add_reader(parent_conn.fileno(), self.on_worker_message, worker)
+        logger.info("started worker %d (pid %d)" % (index, process.pid))
+        return worker
+
+    def start(self, loop):
+        """Starts the worker processes, each fills its own pipeline pool.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop of the supervisor, used to watch the workers.
+        """
+
+        self.loop = loop
+        self.workers = [self.spawn_worker(i) for i in range(self.num_workers)]
+
+    def least_loaded_worker(self):
+        return min(self.workers, key=lambda w: len(w.peers))
+
+    def place(self, peer_id):
+        worker = self.least_loaded_worker()
+        worker.peers.add(peer_id)
+        self.placements[peer_id] = worker
+        worker.send(CMD_START, peer_id)
+        logger.info("placed session %s on worker %d (%d sessions)" % (peer_id, worker.index, len(worker.peers)))
+
+    def on_worker_exit(self, worker):
+        """Replaces a worker that exited and moves its sessions to the remaining workers.
+        """
+
+        self.loop.remove_reader(worker.process.sentinel)
+        self.loop.remove_reader(worker.conn.fileno())
+        worker.process.join()
+        worker.conn.close()
+        if self.stopping:
+            return
+        if worker.process.exitcode == WORKER_INIT_FAILED:
+            self.init_error = GStreamerInitError("worker %d failed to initialize GStreamer" % worker.index)
+            logger.error("%s, stopping" % self.init_error)
+            self.loop.stop()
+            return
+
+        logger.error("worker %d exited with code %s, restarting" % (worker.index, worker.process.exitcode))
+        orphans = list(worker.peers)
+        self.workers[worker.index] = self.spawn_worker(worker.index)
+        for peer_id in orphans:
+            self.place(peer_id)
+
+    def on_worker_message(self, worker):
+        try:
+            while worker.conn.poll():
+                kind, payload = worker.conn.recv()
+                if kind == MSG_METRICS:
+                    worker.metrics = payload
+        except (EOFError, OSError):
+            # The worker exited, on_worker_exit cleans up.
+            self.loop.remove_reader(worker.conn.fileno())
+
+    def set_latency_tracing(self, peer_id, enabled):
+        """Switches the latency tracing of a session on or off on its worker.
+
+        Returns:
+            bool -- False if the session isn't placed on a worker.
+        """
+
+        worker = self.placements.get(peer_id)
+        if worker is None:
+            return False
+        worker.send(CMD_TRACE_ON if enabled else CMD_TRACE_OFF, peer_id)
+        return True
+
+    def tune_session(self, peer_id, **settings):
+        """Changes the jitterbuffer settings of a session on its worker, see GSTWebRTCApp.tune().
+
+        The settings are checked here, errors on the worker are only logged.
+
+        Returns:
+            bool -- False if the session isn't placed on a worker.
+        """
+
+        JitterBufferTuning(**dict(self.manager_kwargs.get('jitter_tuning') or {}, **settings))
+        worker = self.placements.get(peer_id)
+        if worker is None:
+            return False
+        worker.send(CMD_TUNE, peer_id, settings)
+        return True
+
+    def metrics(self):
+        """Returns the latest metric families of all workers, labelled by worker.
+        """
+
+        families = [MetricFamily("webrtc_workers", GAUGE, "Live worker processes.").add(
+            sum(1 for worker in self.workers if worker.process.is_alive()))]
+        # The supervisor's own startup, the workers report theirs.
+        families.extend(startup_timer.families())
+        for worker in self.workers:
+            for family in worker.metrics:
+                labelled = MetricFamily(family.name, family.type, family.help)
+                for labels, value in family.samples:
+                    labelled.add(value, dict(labels or {}, worker=worker.index))
+                families.append(labelled)
+        return families
+
+    def on_peer_registered(self, uid):
+        """Places a session for a newly registered browser peer on the least loaded worker.
+
+        Arguments:
+            uid {string} -- ID of the registered peer.
+        """
+
+        if uid.startswith(self.server_peer_prefix) or uid in self.placements:
+            return
+        if self.max_sessions and len(self.placements) >= self.max_sessions:
+            # Refused here so the peer is neither placed nor counted on a worker.
+            logger.warning("not starting session for peer %s, limit of %d sessions reached" % (uid, self.max_sessions))
+            return
+        self.place(uid)
+
+    def on_peer_removed(self, uid):
+        """Stops the session of a browser peer that left.
+
+        Arguments:
+            uid {string} -- ID of the removed peer.
+        """
+
+        worker = self.placements.pop(uid, None)
+        if worker is None:
+            return
+        worker.peers.discard(uid)
+        worker.send(CMD_STOP, uid)
+
+    async def stop(self):
+        """Asks all workers to exit and waits for them.
+        """
+
+        self.stopping = True
+        for worker in self.workers:
+            try:
+                worker.send(CMD_EXIT)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            await self.loop.run_in_executor(None, worker.process.join, 5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.placements.clear()
@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Tests of the declarative SDP munging
+
+    python3 -m unittest discover -s tests
+"""
+
+import glob
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from sdp_munger import FmtpRule, SDPMunger, RTX_TIME_RULES, H264_RULES, rtx_time_rules
+
+
+def sdp(*media_lines):
+    """Returns an SDP with the session header and the given media lines, CRLF terminated.
+    """
+
+    lines = [
+        "v=0",
+        "o=- 8187665582175022798 0 IN IP4 0.0.0.0",
+        "s=-",
+        "t=0 0",
+        "a=group:BUNDLE video0",
+        "m=video 9 UDP/TLS/RTP/SAVPF 96 97 98 99",
+        "c=IN IP4 0.0.0.0",
+    ] + list(media_lines)
+    return "\r\n".join(lines) + "\r\n"
+
+
+def fmtp_lines(sdp_text):
+    return [line for line in sdp_text.split("\r\n") if line.startswith("a=fmtp:")]
+
+
+class RtxTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.munger = SDPMunger(RTX_TIME_RULES)
+
+    def test_missing_rtx_time_is_added_after_apt(self):
+        munged = self.munger.munge(sdp("a=rtpmap:97 rtx/90000", "a=fmtp:97 apt=96"))
+        self.assertEqual(fmtp_lines(munged), ["a=fmtp:97 apt=96;rtx-time=125"])
+
+    def test_different_rtx_time_is_overwritten(self):
+        munged = self.munger.munge(sdp("a=fmtp:97 apt=96;rtx-time=3000"))
+        self.assertEqual(fmtp_lines(munged), ["a=fmtp:97 apt=96;rtx-time=125"])
+
+    def test_rtx_time_without_value_is_overwritten(self):
+        munged = self.munger.munge(sdp("a=fmtp:97 rtx-time;apt=96"))
+        self.assertEqual(fmtp_lines(munged), ["a=fmtp:97 rtx-time=125;apt=96"])
+
+    def test_matching_rtx_time_is_left_alone(self):
+        sdp_text = sdp("a=fmtp:97 apt=96;rtx-time=125")
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+    def test_every_rtx_payload_is_munged(self):
+        # One payload with the right rtx-time used to stop the others from getting it.
+        munged = self.munger.munge(sdp(
+            "a=fmtp:97 apt=96;rtx-time=125",
+            "a=fmtp:99 apt=98",
+            "a=fmtp:101 apt=100;rtx-time=200",
+        ))
+        self.assertEqual(fmtp_lines(munged), [
+            "a=fmtp:97 apt=96;rtx-time=125",
+            "a=fmtp:99 apt=98;rtx-time=125",
+            "a=fmtp:101 apt=100;rtx-time=125",
+        ])
+
+    def test_lines_without_apt_are_left_alone(self):
+        sdp_text = sdp("a=fmtp:96 minptime=10;useinbandfec=1", "a=fmtp:98 adapt=1;rtx-time=5")
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+    def test_configured_rtx_time(self):
+        munged = SDPMunger(rtx_time_rules(50)).munge(sdp("a=fmtp:97 apt=96;rtx-time=125"))
+        self.assertEqual(fmtp_lines(munged), ["a=fmtp:97 apt=96;rtx-time=50"])
+
+    def test_no_rtx_time_rules(self):
+        sdp_text = sdp("a=fmtp:97 apt=96")
+        self.assertIs(SDPMunger(rtx_time_rules(None)).munge(sdp_text), sdp_text)
+
+
+class H264Test(unittest.TestCase):
+    def setUp(self):
+        self.munger = SDPMunger(H264_RULES)
+
+    def test_missing_parameters_are_added_before_packetization_mode(self):
+        munged = self.munger.munge(sdp("a=fmtp:96 packetization-mode=1"))
+        self.assertEqual(fmtp_lines(munged), [
+            "a=fmtp:96 profile-level-id=42e01f;level-asymmetry-allowed=1;packetization-mode=1"])
+
+    def test_existing_profile_level_id_is_kept(self):
+        munged = self.munger.munge(sdp("a=fmtp:96 packetization-mode=1;profile-level-id=4d001f"))
+        self.assertEqual(fmtp_lines(munged), [
+            "a=fmtp:96 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=4d001f"])
+
+    def test_existing_level_asymmetry_allowed_is_kept(self):
+        munged = self.munger.munge(sdp("a=fmtp:96 packetization-mode=1;level-asymmetry-allowed=0"))
+        self.assertEqual(fmtp_lines(munged), [
+            "a=fmtp:96 profile-level-id=42e01f;packetization-mode=1;level-asymmetry-allowed=0"])
+
+    def test_existing_parameters_on_one_payload_dont_stop_the_others(self):
+        munged = self.munger.munge(sdp(
+            "a=fmtp:96 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42001f",
+            "a=fmtp:98 packetization-mode=1",
+        ))
+        self.assertEqual(fmtp_lines(munged), [
+            "a=fmtp:96 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42001f",
+            "a=fmtp:98 profile-level-id=42e01f;level-asymmetry-allowed=1;packetization-mode=1",
+        ])
+
+    def test_packetization_mode_0_is_left_alone(self):
+        sdp_text = sdp("a=fmtp:96 packetization-mode=0", "a=fmtp:98 packetization-mode=10")
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+
+class SDPMungerTest(unittest.TestCase):
+    def setUp(self):
+        self.munger = SDPMunger(RTX_TIME_RULES + H264_RULES)
+
+    def test_sdp_without_fmtp_lines_is_unchanged(self):
+        sdp_text = sdp("a=rtpmap:96 H264/90000", "a=rtcp-fb:96 nack pli")
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+    def test_empty_sdp(self):
+        self.assertEqual(self.munger.munge(""), "")
+
+    def test_fmtp_line_without_parameters_is_unchanged(self):
+        sdp_text = sdp("a=fmtp:96")
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+    def test_other_lines_are_kept_byte_for_byte(self):
+        sdp_text = sdp("a=rtpmap:96 H264/90000", "a=fmtp:96 packetization-mode=1", "a=fmtp:97 apt=96",
+                       "a=ssrc:1 cname:user@host")
+        munged = self.munger.munge(sdp_text)
+        self.assertEqual(munged, sdp_text
+                         .replace("96 packetization-mode=1",
+                                  "96 profile-level-id=42e01f;level-asymmetry-allowed=1;packetization-mode=1")
+                         .replace("apt=96", "apt=96;rtx-time=125"))
+
+    def test_lf_line_endings_and_last_line_without_newline(self):
+        munged = self.munger.munge("v=0\na=fmtp:96 packetization-mode=1\na=fmtp:97 apt=96")
+        self.assertEqual(munged, "v=0\na=fmtp:96 profile-level-id=42e01f;level-asymmetry-allowed=1;"
+                                 "packetization-mode=1\na=fmtp:97 apt=96;rtx-time=125")
+
+    def test_munging_again_gives_the_same_result(self):
+        # The second run takes the lines from the cache of the munger.
+        sdp_text = sdp("a=fmtp:96 packetization-mode=1", "a=fmtp:97 apt=96", "a=fmtp:99 apt=98;rtx-time=125")
+        first = self.munger.munge(sdp_text)
+        self.assertEqual(self.munger.munge(sdp_text), first)
+        self.assertEqual(SDPMunger(RTX_TIME_RULES + H264_RULES).munge(sdp_text), first)
+
+    def test_munged_sdp_is_left_alone(self):
+        sdp_text = self.munger.munge(sdp("a=fmtp:96 packetization-mode=1", "a=fmtp:97 apt=96"))
+        self.assertIs(self.munger.munge(sdp_text), sdp_text)
+
+    def test_rules_apply_in_order(self):
+        munger = SDPMunger([
+            FmtpRule("b", "2", when=("a", None), after="a"),
+            FmtpRule("c", "3", when=("b", "2"), before="b"),
+        ])
+        munged = munger.munge(sdp("a=fmtp:96 a=1;d=4"))
+        self.assertEqual(fmtp_lines(munged), ["a=fmtp:96 a=1;c=3;b=2;d=4"])
+
+    def test_captured_sdps(self):
+        paths = sorted(glob.glob(os.path.join(ROOT, 'sdp', '*', '*.txt')))
+        self.assertTrue(paths)
+        for path in paths:
+            with open(path) as f:
+                sdp_text = f.read()
+            with self.subTest(path=os.path.relpath(path, ROOT)):
+                munged = self.munger.munge(sdp_text)
+                for line in fmtp_lines(munged):
+                    params = line.split(" ", 1)[1].split(";")
+                    if any(p.startswith("apt=") for p in params):
+                        self.assertIn("rtx-time=125", params)
+                    if "packetization-mode=1" in params:
+                        self.assertTrue(any(p.startswith("profile-level-id=") for p in params))
+                        self.assertTrue(any(p.startswith("level-asymmetry-allowed=") for p in params))
+                self.assertEqual(len(munged.split("\n")), len(sdp_text.split("\n")))
+
+
+if __name__ == '__main__':
+    unittest.main()